@@ -0,0 +1,212 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+"""
+Maintain aggregate tables of APC spending over apc_de.csv.
+
+This script keeps materialized group-by tables (count, sum, mean, median
+and quantiles of the euro column) for the groupings defined in
+AGGREGATE_TABLES. The tables are stored in a state file together with the
+processed length of the CSV file. If rows have been appended to the CSV file
+since the last run, only those rows are added; the tables are only computed
+from scratch if earlier content of the file has changed.
+The tables are exported as CSV files and as a single JSON file.
+"""
+
+import argparse
+from bisect import bisect_left, insort
+from collections import OrderedDict
+import hashlib
+import json
+import os
+from StringIO import StringIO
+
+import openapc_toolkit as oat
+
+# Table name -> grouping columns
+AGGREGATE_TABLES = OrderedDict([
+    ("institution", ["institution"]),
+    ("period", ["period"]),
+    ("publisher", ["publisher"]),
+    ("journal", ["journal_full_title"]),
+    ("is_hybrid", ["is_hybrid"]),
+    ("institution_period", ["institution", "period"]),
+    ("publisher_period", ["publisher", "period"]),
+    ("period_is_hybrid", ["period", "is_hybrid"])
+])
+
+# Quantiles of the euro column in addition to the median
+QUANTILES = [0.1, 0.25, 0.75, 0.9]
+
+STAT_COLUMNS = (["count", "sum", "mean", "median"] +
+                ["q" + str(int(q * 100)) for q in QUANTILES])
+
+def quantile(sorted_values, q):
+    """
+    Compute a quantile by linear interpolation (like R's default type 7).
+    """
+    pos = (len(sorted_values) - 1) * q
+    lower = int(pos)
+    if lower + 1 >= len(sorted_values):
+        return sorted_values[lower]
+    fraction = pos - lower
+    return (sorted_values[lower] +
+            (sorted_values[lower + 1] - sorted_values[lower]) * fraction)
+
+class AggregateEngine(object):
+    """
+    Materialized aggregate tables which can be updated incrementally.
+
+    For every group the euro values are kept in sorted order, so median
+    and quantiles can be read off without sorting. Adding or removing a row
+    finds its position by binary search, but shifting the list makes it
+    O(n) in the size of the group. Exact quantiles need all values, so the
+    state file holds every euro value once per table.
+    """
+
+    def __init__(self, tables=AGGREGATE_TABLES):
+        self.tables = tables
+        self.groups = {name: {} for name in tables}
+        self.source_bytes = 0
+        self.source_sha1 = hashlib.sha1().hexdigest()
+
+    def add_row(self, row):
+        try:
+            euro = float(row["euro"])
+        except ValueError:
+            return
+        for name, columns in self.tables.iteritems():
+            key = json.dumps([row[column] for column in columns])
+            insort(self.groups[name].setdefault(key, []), euro)
+
+    def remove_row(self, row):
+        """
+        Remove a previously added row from all tables.
+        """
+        try:
+            euro = float(row["euro"])
+        except ValueError:
+            return
+        for name, columns in self.tables.iteritems():
+            key = json.dumps([row[column] for column in columns])
+            values = self.groups[name].get(key, [])
+            index = bisect_left(values, euro)
+            if index == len(values) or values[index] != euro:
+                continue
+            del values[index]
+            if not values:
+                del self.groups[name][key]
+
+    def update_from_csv(self, csv_path):
+        """
+        Add all rows appended to a CSV file since the last update.
+
+        Returns:
+            The number of added rows. If the already processed part of the
+            file has changed, all tables are rebuilt from scratch.
+        """
+        with open(csv_path, "rb") as csv_file:
+            header_line = csv_file.readline()
+            header = oat.UnicodeReader(StringIO(header_line)).next()
+            csv_file.seek(0)
+            prefix_hash = hashlib.sha1(csv_file.read(self.source_bytes))
+            if prefix_hash.hexdigest() != self.source_sha1:
+                oat.print_y("CSV file has changed, rebuilding all tables.")
+                self.__init__(self.tables)
+                prefix_hash = hashlib.sha1()
+            if self.source_bytes == 0:
+                # Skip the header
+                self.source_bytes = len(header_line)
+                prefix_hash.update(header_line)
+            csv_file.seek(self.source_bytes)
+            new_content = csv_file.read()
+        # Only process complete lines, an incomplete last line will be
+        # processed in the next run.
+        complete = new_content[:new_content.rfind("\n") + 1]
+        added = 0
+        for row in oat.UnicodeReader(StringIO(complete)):
+            if len(row) == len(header):
+                self.add_row(dict(zip(header, row)))
+                added += 1
+        prefix_hash.update(complete)
+        self.source_bytes += len(complete)
+        self.source_sha1 = prefix_hash.hexdigest()
+        return added
+
+    def get_table(self, name):
+        """
+        Return an aggregate table as a list of rows (grouping values first).
+        """
+        rows = []
+        for key, values in sorted(self.groups[name].iteritems()):
+            total = sum(values)
+            stats = [total, total / len(values), quantile(values, 0.5)]
+            stats += [quantile(values, q) for q in QUANTILES]
+            rows.append(json.loads(key) + [len(values)] +
+                        [round(stat, 2) for stat in stats])
+        return rows
+
+    def save(self, state_path):
+        state = {"source_bytes": self.source_bytes,
+                 "source_sha1": self.source_sha1,
+                 "tables": self.tables,
+                 "groups": self.groups}
+        with open(state_path, "w") as state_file:
+            json.dump(state, state_file, separators=(",", ":"))
+
+    @classmethod
+    def load(cls, state_path):
+        with open(state_path, "r") as state_file:
+            state = json.load(state_file, object_pairs_hook=OrderedDict)
+        engine = cls(state["tables"])
+        engine.groups = state["groups"]
+        engine.source_bytes = state["source_bytes"]
+        engine.source_sha1 = state["source_sha1"]
+        return engine
+
+    def export_csv(self, dir_path):
+        if not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+        for name, columns in self.tables.iteritems():
+            content = [list(columns) + STAT_COLUMNS]
+            for row in self.get_table(name):
+                content.append([unicode(value) for value in row])
+            quotemask = ([True] * len(columns)) + ([False] * len(STAT_COLUMNS))
+            with open(os.path.join(dir_path, name + ".csv"), "w") as out:
+                writer = oat.OpenAPCUnicodeWriter(out, quotemask, True, True)
+                writer.write_rows(content)
+
+    def export_json(self, file_path):
+        export = OrderedDict()
+        for name, columns in self.tables.iteritems():
+            keys = list(columns) + STAT_COLUMNS
+            export[name] = [OrderedDict(zip(keys, row))
+                            for row in self.get_table(name)]
+        with open(file_path, "w") as out:
+            json.dump(export, out, indent=2)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--csv_file", default="data/apc_de.csv",
+                        help="The OpenAPC CSV file (default: data/apc_de.csv)")
+    parser.add_argument("-s", "--state_file", default="aggregates_state.json",
+                        help="The state file holding the materialized " +
+                        "tables (default: aggregates_state.json)")
+    parser.add_argument("-o", "--output_dir", default="aggregates",
+                        help="Directory for the exported tables (default: " +
+                        "aggregates)")
+    args = parser.parse_args()
+
+    if os.path.isfile(args.state_file):
+        engine = AggregateEngine.load(args.state_file)
+    else:
+        engine = AggregateEngine()
+    added = engine.update_from_csv(args.csv_file)
+    print "Added {} rows to the aggregate tables.".format(added)
+    engine.save(args.state_file)
+    engine.export_csv(args.output_dir)
+    engine.export_json(os.path.join(args.output_dir, "aggregates.json"))
+    print "Tables exported to " + args.output_dir
+
+if __name__ == '__main__':
+    main()
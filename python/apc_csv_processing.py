@@ -7,8 +7,13 @@ from collections import OrderedDict
 from copy import copy
 import csv
 import datetime
+import hashlib
+import json
 import locale
+import os
+import subprocess
 import sys
+import time
 
 import openapc_toolkit as oat
 
@@ -21,6 +26,13 @@ class CSVColumn(object):
     OW_ALWAYS = 0
     OW_ASK = 1
     OW_NEVER = 2
+
+    # Names of the overwrite rules as used in policy files
+    OW_RULES = {
+        "always": OW_ALWAYS,
+        "ask": OW_ASK,
+        "never": OW_NEVER
+    }
     
     _OW_MSG = (u"\033[91mConflict\033[0m: Existing non-NA value " +
                u"\033[93m{ov}\033[0m in column \033[93m{name}\033[0m is to be " +
@@ -39,7 +51,10 @@ class CSVColumn(object):
         self.overwrite = overwrite
         self.overwrite_whitelist = {}
         self.overwrite_blacklist = {}
-        
+        # If a ConflictReview is attached, unresolved conflicts will be
+        # recorded there instead of asking the user.
+        self.conflict_review = None
+
     def check_overwrite(self, old_value, new_value):
         if old_value == new_value:
             return old_value
@@ -48,15 +63,18 @@ class CSVColumn(object):
             return new_value
         if old_value.strip() == "":
             return new_value
+        # Explicit replacements take precedence over the column rule
+        if self.overwrite_blacklist.get(old_value) == new_value:
+            return old_value
+        if self.overwrite_whitelist.get(old_value) == new_value:
+            return new_value
         if self.overwrite == CSVColumn.OW_ALWAYS:
             return new_value
         if self.overwrite == CSVColumn.OW_NEVER:
             return old_value
-        if old_value in self.overwrite_blacklist:
-            if self.overwrite_blacklist[old_value] == new_value:
-                return old_value
-        if old_value in self.overwrite_whitelist:
-            return new_value
+        if self.conflict_review is not None:
+            self.conflict_review.add(self.column_type, old_value, new_value)
+            return old_value
         msg = CSVColumn._OW_MSG.format(ov=old_value, name=self.column_name, 
                                        nv=new_value)
         msg = msg.encode("utf-8")
@@ -80,11 +98,125 @@ class CSVColumn(object):
             self.overwrite = CSVColumn.OW_NEVER
             return old_value
 
+class ConflictReview(object):
+    """
+    Collects unresolved overwrite conflicts during an unattended run.
+
+    Instead of blocking on user input, every conflict which could not be
+    resolved by the overwrite policy is recorded together with the current
+    line number and DOI. The existing value is kept, the collected conflicts
+    can be written to a CSV review file after the run.
+    """
+
+    HEADER = [u"line", u"doi", u"column", u"existing_value", u"new_value"]
+
+    def __init__(self):
+        self.line = None
+        self.doi = None
+        self.conflicts = []
+
+    def add(self, column_type, old_value, new_value):
+        self.conflicts.append([unicode(self.line), self.doi, column_type,
+                               old_value, new_value])
+
+    def write(self, file_path):
+        with open(file_path, "w") as out:
+            writer = oat.OpenAPCUnicodeWriter(out, None, False, True)
+            writer.write_rows([list(ConflictReview.HEADER)] +
+                              [list(c) for c in self.conflicts])
+
+def load_overwrite_policy(file_path):
+    """
+    Load an overwrite policy from a JSON file.
+
+    A policy file defines how conflicts between existing values and new
+    values (usually from crossref or pubmed) are resolved for each column.
+    Its structure looks like this:
+
+    {
+        "default": "ask",
+        "columns": {
+            "license_ref": "always",
+            "publisher": {
+                "rule": "never",
+                "whitelist": {"The Optical Society": "OSA"},
+                "blacklist": {"PLOS ONE": "PLoS ONE"}
+            }
+        }
+    }
+
+    Valid rules are "always", "never" and "ask". Whitelist and blacklist
+    entries work like the interactive choices 2 and 5 of the conflict
+    dialogue: A whitelist entry allows replacing an existing value by
+    exactly the given new value (even if the rule is "never"), a blacklist
+    entry prevents it.
+
+    Args:
+        file_path: Path to the policy file.
+    Returns:
+        A dict with a key 'success'. If the policy was loaded, 'data' will
+        contain a dict mapping column types to (rule, whitelist, blacklist)
+        tuples, with the key None denoting the default rule. Otherwise
+        'error_msg' will state the reason.
+    """
+    try:
+        with open(file_path, "r") as policy_file:
+            content = json.load(policy_file)
+    except IOError as ioe:
+        error_msg = "Error: could not open policy file '{}': {}"
+        return {"success": False,
+                "error_msg": error_msg.format(file_path, ioe.strerror)}
+    except ValueError as ve:
+        error_msg = "Error: policy file '{}' is no valid JSON: {}"
+        return {"success": False,
+                "error_msg": error_msg.format(file_path, ve.message)}
+    default = content.get("default", "ask")
+    if default not in CSVColumn.OW_RULES:
+        error_msg = "Error: unknown default overwrite rule '{}'"
+        return {"success": False, "error_msg": error_msg.format(default)}
+    policy = {None: (CSVColumn.OW_RULES[default], {}, {})}
+    for column_type, column_policy in content.get("columns", {}).iteritems():
+        if not isinstance(column_policy, dict):
+            column_policy = {"rule": column_policy}
+        rule = column_policy.get("rule", default)
+        if rule not in CSVColumn.OW_RULES:
+            error_msg = "Error: unknown overwrite rule '{}' for column '{}'"
+            return {"success": False,
+                    "error_msg": error_msg.format(rule, column_type)}
+        policy[column_type] = (CSVColumn.OW_RULES[rule],
+                               column_policy.get("whitelist", {}),
+                               column_policy.get("blacklist", {}))
+    return {"success": True, "data": policy}
+
+def apply_overwrite_policy(column_map, policy):
+    """
+    Configure the overwrite behaviour of CSVColumns from a loaded policy.
+    """
+    for column in column_map.values():
+        rule, whitelist, blacklist = policy.get(column.column_type,
+                                                policy[None])
+        column.overwrite = rule
+        column.overwrite_whitelist = dict(whitelist)
+        column.overwrite_blacklist = dict(blacklist)
+
+def apply_mapping_profile(profile, column_map, header=None):
+    """
+    Assign the column indices stored in a mapping profile.
+
+    Columns already identified (on the command line) are left unchanged.
+    """
+    for column_type, index in profile["columns"].iteritems():
+        if column_type in column_map and column_map[column_type].index is None:
+            column_map[column_type].index = index
+            if header:
+                column_map[column_type].column_name = header[index]
 
 ARG_HELP_STRINGS = {
     "csv_file": "CSV file containing your APC data. It must contain at least " +
                 "the 4 mandatory columns defined by the OpenAPC data schema: " +
-                "institution, doi, period and euro (in no particular order).",
+                "institution, doi, period and euro (in no particular order). " +
+                "TSV files, Excel workbooks (.xlsx), gzip or bzip2 " +
+                "compressed files and ZIP archives are read as well.",
     "encoding": "The encoding of the CSV file. Setting this argument will " +
                 "disable automatic guessing of encoding.",
     "verbose": "Be more verbose during the enrichment process.",
@@ -138,24 +270,869 @@ ARG_HELP_STRINGS = {
            "it automatically. The value is the numerical column index in the " +
            "CSV file, with the leftmost column being 0. This is an optional " +
            "column, identifying it is required if there are articles without " +
-           "a DOI in the file."
+           "a DOI in the file.",
+    "output": "Where to write the enriched CSV file (default: out.csv)",
+    "policy": "A JSON file defining per-column rules for resolving conflicts " +
+              "between existing values and new metadata (see " +
+              "load_overwrite_policy for the format).",
+    "yes": "Run unattended: Start the metadata aggregation without asking " +
+           "and never prompt on overwrite conflicts. Conflicts which are not " +
+           "resolved by the overwrite policy will keep the existing value " +
+           "and are written to the review file.",
+    "review_file": "Where to write unresolved overwrite conflicts in " +
+                   "unattended mode (default: review.csv)",
+    "profiles": "A JSON file containing column mapping profiles. If the " +
+                "header of the CSV file matches a stored profile, its column " +
+                "map, encoding, dialect and locale will be used and the " +
+                "file analysis is skipped (default: mapping_profiles.json)",
+    "save_profile": "Store the column mapping, encoding, dialect and locale " +
+                    "determined for this file as a profile, so that files " +
+                    "with the same header can be processed without analysis " +
+                    "in the future.",
+    "no_profile": "Do not apply a matching column mapping profile.",
+    "doi_ut_file": "A CSV file mapping DOIs to Web of Science UT " +
+                   "identifiers. It will be used to fill the ut column " +
+                   "(default: data/doi_ut.csv)",
+    "wos": "Look up DOIs not found in the DOI/UT mapping file in Web of " +
+           "Science (requires the IP address to be registered for the " +
+           "Article Match Retrieval service). New results are appended to " +
+           "the mapping file.",
+    "previous": "A previous output file of this script for an earlier " +
+                "version of the same CSV file. Rows which did not change " +
+                "will not be enriched again, their values are taken from " +
+                "the previous output. Rows are recognized by the " +
+                "fingerprints of their source values, which every run " +
+                "writes to <output>.fingerprints for this purpose.",
+    "crossref_store": "A local crossref store (see crossref_dump_import.py). " +
+                      "DOIs will be looked up there first, crossref will " +
+                      "only be queried for DOIs not found in the store.",
+    "service": "The URL of a running enrichment service (see " +
+               "enrichment_service.py). All crossref, PubMed and DOAJ " +
+               "lookups will be sent to the service, which caches results.",
+    "journal_kb": "The journal knowledge base file. Journal-level metadata " +
+                  "(title, publisher, ISSNs, doaj) of journals found there " +
+                  "is taken from the knowledge base instead of crossref and " +
+                  "DOAJ. It is (re)built from --journal-kb-source if it is " +
+                  "missing or outdated (default: data/journal_kb.json)",
+    "journal_kb_source": "The CSV file to derive the journal knowledge base " +
+                         "from (default: data/apc_de.csv)",
+    "no_journal_kb": "Do not use the journal knowledge base.",
+    "dry_run": "Only print the lookup plan (unique DOIs and ISSNs, expected " +
+               "number of requests and projected run time), do not enrich " +
+               "the file.",
+    "cache": "A lookup cache file (SQLite). Results of crossref, PubMed " +
+             "and DOAJ lookups are stored there and reused in later runs. " +
+             "The cache can be shared by several processes.",
+    "shards": "Split the CSV file into this number of row ranges and " +
+              "enrich them in parallel worker processes, which share a " +
+              "lookup cache (--cache, default: lookup_cache.db). The " +
+              "results are merged into a single output file. " +
+              "Implies --yes.",
+    "shard": "Only enrich one row range of the CSV file, given as K/N " +
+             "(range K of N). The result is written to a shard file, which " +
+             "can be merged with --merge-shards. This allows distributing " +
+             "the work over several hosts sharing a file system.",
+    "merge_shards": "Merge the N shard files of a distributed run (see " +
+                    "--shard) into a single output file.",
+    "outliers": "Check the enriched APC amounts against the per-journal " +
+                "and per-publisher distributions of the reference file and " +
+                "report implausible values (requires numpy).",
+    "outlier_reference": "The CSV file to compute the APC distributions " +
+                         "from (default: data/apc_de.csv)",
+    "outlier_threshold": "Robust z-score above which an APC amount is " +
+                         "reported (default: 3.5)",
+    "doaj_list": "A DOAJ journal list. Its titles are used (together with " +
+                 "the journal knowledge base) to identify the journals of " +
+                 "rows without a DOI (default: data/doaj/doajJournalList.csv)",
+    "title_match_threshold": "Minimum similarity (0-1) of a journal title " +
+                             "to a known title to accept it as a match " +
+                             "for rows without a DOI (default: 0.8)",
+    "no_title_matching": "Do not match journal titles of rows without a DOI.",
+    "issn_l_table": "The ISSN-to-ISSN-L table of the ISSN International " +
+                    "Centre. If it exists, journals are also found in the " +
+                    "journal knowledge base by their ISSN-L, so any ISSN of " +
+                    "a journal can be used (default: data/issn_l.tsv)"
 }
 
 ERROR_MSGS = {
-    "locale": "Error: Could not process the monetary value '{}' in column " +
-              "{}. This will usually have one of two reasons:\n1) The value " +
-              "does not represent a number.\n2) The value represents a " +
-              "number, but its format differs from your current system " +
-              "locale - the most common source of error will be the decimal " +
-              "mark (1234.56 vs 1234,56). Try using another locale with the " +
-              "-l option."
+    "values": "Error: {} values could not be processed. This will usually " +
+              "have one of two reasons:\n1) The value does not represent a " +
+              "number or a period.\n2) The value represents a number, but " +
+              "its format differs from the format detected for the column " +
+              "- the most common source of error will be the decimal mark " +
+              "(1234.56 vs 1234,56). Try setting the format explicitly by " +
+              "using a locale with the -l option."
 }
 
+# Number of data rows sampled for the heuristical column analysis
+HEURISTIC_SAMPLE_SIZE = 100
+# Share of sampled values which have to look like a certain column type
+HEURISTIC_THRESHOLD = 0.9
+
+# Seconds to wait between two requests to the Web of Science AMR service
+WOS_REQUEST_DELAY = 2
+
+# Appended to the output file name for the file containing row fingerprints
+FINGERPRINT_SUFFIX = ".fingerprints"
+
+# Default lookup cache shared by the workers in sharded mode
+DEFAULT_SHARD_CACHE = "lookup_cache.db"
+
+# A title match is only accepted if the next best candidate scores lower by
+# at least this margin. Titles like 'Journal of Physical Chemistry C' are
+# similar to several journals, picking one of them would be guesswork.
+TITLE_MATCH_MARGIN = 0.05
+
+# Average duration of a single lookup request in seconds, used to project
+# the run time of the lookup plan
+LOOKUP_TIME_ESTIMATE = 0.6
+
 INFO_MSGS = {
     "unify": "Normalisation: CrossRef-based {} changed from '{}' to '{}' " +
-             "to maintain consistency."
+             "to maintain consistency.",
+    "issn": "Normalisation: ISSN '{}' changed to '{}'."
 }
 
+def analyze_header(header, column_map):
+    """
+    Identify column types by looking up the header entries in a whitelist.
+    """
+    for (index, item) in enumerate(header):
+        column_type = oat.get_column_type_from_whitelist(item)
+        if column_type is not None and column_map[column_type].index is None:
+            column_map[column_type].index = index
+            column_map[column_type].column_name = item
+            print ("Found column named '{}' at index {}, " +
+                   "assuming this to be the {} column.").format(
+                       item, index, column_type)
+
+def analyze_rows(rows, header, column_map):
+    """
+    Heuristically identify the doi, period and euro columns from data rows.
+
+    A column is considered a candidate for a column type if at least
+    HEURISTIC_THRESHOLD of its non-empty values in the sample look like a
+    DOI, a year or a plausible APC amount.
+    """
+    column_candidates = {
+        "doi": [],
+        "period": [],
+        "euro": []
+    }
+    assigned = [csvcolumn.index for csvcolumn in column_map.values()]
+    num_columns = max([len(row) for row in rows])
+    now = datetime.date.today().year
+    for index in range(num_columns):
+        if index in assigned:
+            # Skip columns already assigned
+            continue
+        values = [row[index].strip() for row in rows
+                  if len(row) > index and row[index].strip()]
+        if not values:
+            continue
+        column_id = str(index)
+        # identify column either numerical or by column header
+        if header:
+            column_id += " ('" + header[index] + "')"
+        # Search for DOIs
+        if column_map['doi'].index is None:
+            share = _matching_share(values, oat.DOI_RE.match)
+            if share >= HEURISTIC_THRESHOLD:
+                print ("{}% of the entries in column {} look like a " +
+                       "DOI (example: {})").format(int(share * 100),
+                                                   column_id, values[0])
+                column_candidates['doi'].append(index)
+                continue
+        # Search for potential year strings
+        if column_map['period'].index is None:
+            period_format = oat.infer_period_format(values)
+            if period_format is not None:
+                parse_period = oat.compile_period_parser(period_format)
+                def is_period(value):
+                    try:
+                        # Should be a wide enough margin
+                        return 2000 <= int(parse_period(value)) <= now + 2
+                    except ValueError:
+                        return False
+                share = _matching_share(values, is_period)
+                if share >= HEURISTIC_THRESHOLD:
+                    print ("{}% of the entries in column {} look like a " +
+                           "potential period in format {} (example: " +
+                           "{})").format(int(share * 100), column_id,
+                                         period_format, values[0])
+                    column_candidates['period'].append(index)
+                    continue
+        # Search for potential monetary amounts
+        if column_map['euro'].index is None:
+            decimal_point = oat.get_locale_number_format()[0]
+            number_format = oat.infer_number_format(values, decimal_point)
+            parse_number = oat.compile_number_parser(*number_format)
+            def is_euro(value):
+                try:
+                    # Are there APCs above 6000€ ??
+                    return 10 <= parse_number(value) <= 6000
+                except ValueError:
+                    return False
+            share = _matching_share(values, is_euro)
+            if share >= HEURISTIC_THRESHOLD:
+                print ("{}% of the entries in column {} look like a " +
+                       "potential euro amount (example: {})").format(
+                           int(share * 100), column_id, values[0])
+                column_candidates['euro'].append(index)
+                continue
+    for column_type, candidates in column_candidates.iteritems():
+        if column_map[column_type].index is not None:
+            continue
+        if len(candidates) > 1:
+            print ("Could not reliably identify the '" + column_type +
+                   "' column - more than one possible candiate!")
+        elif len(candidates) < 1:
+            print "No candidate found for column '" + column_type + "'!"
+        else:
+            index = candidates.pop()
+            column_map[column_type].index = index
+            if header:
+                column_id = header[index]
+                column_map[column_type].column_name = column_id
+            else:
+                column_id = index
+            print ("Assuming column '{}' to be the '{}' " +
+                   "column.").format(column_id, column_type)
+
+def _matching_share(values, predicate):
+    matches = len([value for value in values if predicate(value)])
+    return float(matches) / len(values)
+
+def compile_euro_parser(decimal_mark, thousands_sep):
+    """
+    Create a parser normalising monetary values to the OpenAPC format.
+
+    The returned function takes a string in the given number format and
+    returns it as a string with a dot as decimal mark, omitting the decimal
+    places for integral values. It raises a ValueError on malformed input.
+    """
+    parse_number = oat.compile_number_parser(decimal_mark, thousands_sep)
+    def parse_euro(value):
+        euro = parse_number(value)
+        if euro.is_integer():
+            euro = int(euro)
+        return unicode(euro)
+    return parse_euro
+
+def validate_column_values(csv_file, dialect, enc, has_header, num_columns,
+                           column_map, parsers):
+    """
+    Check every value in columns with a value parser in one pass.
+
+    This is meant to be run before any network lookups to find malformed
+    values (like monetary amounts in an unexpected format) early.
+
+    Returns:
+        A list of error messages, one for every value which could not be
+        parsed.
+    """
+    errors = []
+    csv_file.seek(0)
+    reader = oat.UnicodeReader(csv_file, dialect=dialect, encoding=enc)
+    header_skipped = not has_header
+    row_num = 0
+    for row in reader:
+        row_num += 1
+        if not row:
+            continue
+        if not header_skipped:
+            header_skipped = True
+            continue
+        if len(row) != num_columns:
+            # Syntax errors will be reported during metadata aggregation
+            continue
+        for column_type, parse in parsers.iteritems():
+            index = column_map[column_type].index
+            if not row[index].strip():
+                continue
+            try:
+                parse(row[index])
+            except ValueError as ve:
+                msg = u"Line {}: Invalid value in column {} ({}): {}"
+                errors.append(msg.format(row_num, index, column_type,
+                                         ve.message))
+    return errors
+
+def add_ut_identifiers(rows, column_map, doi_ut_file, query_wos):
+    """
+    Fill in missing UT identifiers by joining against a DOI to UT mapping.
+
+    DOIs not present in the mapping file (usually data/doi_ut.csv) can be
+    resolved through batched requests to the Web of Science Article Match
+    Retrieval service. Newly resolved mappings (including negative results)
+    are appended to the mapping file. Existing non-NA values in the ut column
+    are never changed.
+
+    Args:
+        rows: Enriched data rows (lists in column_map order).
+        column_map: The column map used for enrichment.
+        doi_ut_file: Path to the mapping file.
+        query_wos: Query Web of Science for unknown DOIs.
+    Returns:
+        A list of error messages.
+    """
+    keys = column_map.keys()
+    doi_index = keys.index("doi")
+    ut_index = keys.index("ut")
+    mapping = oat.load_doi_ut_mapping(doi_ut_file)
+    missing = OrderedDict()
+    joined = 0
+    for row in rows:
+        if len(row) != len(keys) or row[ut_index] != "NA":
+            continue
+        doi = row[doi_index]
+        if not oat.is_wellformed_DOI(doi):
+            continue
+        norm_doi = oat.normalize_doi(doi)
+        if norm_doi in mapping:
+            if mapping[norm_doi] != "NA":
+                row[ut_index] = mapping[norm_doi]
+                joined += 1
+        else:
+            missing.setdefault(norm_doi, []).append(row)
+    print "UT: {} identifiers found in {}".format(joined, doi_ut_file)
+    error_messages = []
+    if not query_wos or not missing:
+        if missing:
+            print ("UT: {} DOIs are not in the mapping file, use --wos to " +
+                   "look them up in Web of Science.").format(len(missing))
+        return error_messages
+    dois = missing.keys()
+    resolved = 0
+    for start in range(0, len(dois), oat.WOS_AMR_BATCH_SIZE):
+        if start > 0:
+            # The AMR service does not like to be hammered
+            time.sleep(WOS_REQUEST_DELAY)
+        batch = dois[start:start + oat.WOS_AMR_BATCH_SIZE]
+        wos_result = oat.get_uts_from_wos(batch)
+        if not wos_result["success"]:
+            msg = "UT: Error while looking up {} DOIs in Web of Science: {}"
+            msg_fmt = msg.format(len(batch), wos_result["error_msg"])
+            oat.print_r(msg_fmt)
+            error_messages.append(msg_fmt)
+            continue
+        new_mappings = []
+        for doi, ut in wos_result["data"].iteritems():
+            # The normalized DOI is only the lookup key, the mapping file
+            # keeps DOIs as written (R/isi_add.r matches them exactly)
+            original_doi = missing[doi][0][doi_index]
+            new_mappings.append((original_doi, ut if ut else u"NA"))
+            if ut:
+                resolved += 1
+                for row in missing[doi]:
+                    row[ut_index] = ut
+        oat.append_doi_ut_mapping(doi_ut_file, new_mappings)
+    print "UT: {} of {} unknown DOIs resolved via Web of Science".format(
+        resolved, len(dois))
+    return error_messages
+
+def get_row_fingerprint(current_row, source_types):
+    """
+    Hash the source values of a row (before any enrichment).
+
+    Args:
+        current_row: A dict mapping column types to the (normalised) values
+                     copied from the input file.
+        source_types: The column types which were mapped to an input column.
+    Returns:
+        A hex digest string.
+    """
+    content = u"\x1f".join([ct + u"=" + current_row[ct] for ct in source_types])
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+def load_previous_output(file_path, source_types):
+    """
+    Load a previously enriched file for an incremental run.
+
+    Row fingerprints are read from the fingerprint file written along with
+    the previous output. If there is none, they are computed from the
+    previous output itself, which will miss rows where enrichment changed a
+    source value (those rows will simply be enriched again).
+
+    Returns:
+        A tuple (rows, dois): rows maps fingerprints to previous output rows
+        (as records), dois is the set of normalised DOIs in the previous
+        output.
+    """
+    fingerprints = None
+    try:
+        with open(file_path + FINGERPRINT_SUFFIX, "r") as fp_file:
+            fingerprints = [line.strip() for line in fp_file]
+    except IOError:
+        msg = "No fingerprint file found for {}, computing fingerprints."
+        oat.print_y(msg.format(file_path))
+    rows = {}
+    dois = set()
+    with open(file_path, "r") as previous_file:
+        reader = oat.UnicodeRecordReader(previous_file)
+        for num, row in enumerate(reader):
+            if row.get("doi") and oat.is_wellformed_DOI(row["doi"]):
+                dois.add(oat.normalize_doi(row["doi"]))
+            if fingerprints is not None:
+                fingerprint = fingerprints[num] if num < len(fingerprints) else ""
+            elif all([row.get(ct) is not None for ct in source_types]):
+                fingerprint = get_row_fingerprint(row, source_types)
+            else:
+                fingerprint = ""
+            if fingerprint:
+                rows[fingerprint] = row
+    return (rows, dois)
+
+def find_apc_outliers(rows, column_map, reference_file, threshold):
+    """
+    Check enriched rows for implausible APC amounts (see apc_outliers.py).
+
+    Args:
+        rows: Enriched data rows (lists in column_map order).
+        column_map: The column map used for enrichment.
+        reference_file: The CSV file to compute the APC distributions from.
+        threshold: Robust z-score above which an amount is reported.
+    Returns:
+        A list of warning messages.
+    """
+    # numpy is optional, so only import the module when it is needed
+    import apc_outliers
+    if apc_outliers.np is None:
+        return []
+    keys = column_map.keys()
+    row_dicts = [dict(zip(keys, row)) for row in rows if len(row) == len(keys)]
+    detector = apc_outliers.OutlierDetector(
+        apc_outliers.load_rows(reference_file))
+    warnings = []
+    for index, score, median, basis in detector.find_outliers(row_dicts,
+                                                              threshold):
+        warnings.append(apc_outliers.format_outlier(row_dicts[index], score,
+                                                    median, basis))
+    return warnings
+
+def map_row(row, column_map, parsers, record_type):
+    """
+    Copy the content of identified columns from an input row.
+
+    Args:
+        row: The input row, a list of values.
+        column_map: The column map, an OrderedDict of CSVColumns.
+        parsers: A dict mapping column types to value parsers.
+        record_type: The record type of the column map, created once per
+                     run with oat.make_record_type(column_map.iterkeys()).
+    Returns:
+        A record (see openapc_toolkit.make_record_type) mapping all column
+        types to their values, "NA" for columns which are not mapped or
+        empty.
+    """
+    values = []
+    for csv_column in column_map.itervalues():
+        if csv_column.index is not None and len(row[csv_column.index]) > 0:
+            if csv_column.column_type in parsers:
+                # special case for monetary values and periods: normalise
+                # them (decimal point is a dot, period is a year). Values
+                # have already been validated.
+                parse = parsers[csv_column.column_type]
+                values.append(parse(row[csv_column.index]))
+            else:
+                values.append(row[csv_column.index])
+        else:
+            values.append("NA")
+    return record_type(values)
+
+def lookup_journal_kb(current_row, journal_kb):
+    """
+    Find the journal of a row in the journal knowledge base.
+
+    The ISSNs of the row are tried in the same order as for DOAJ lookups.
+
+    Returns:
+        A dict of journal metadata (see JOURNAL_KB_FIELDS) or None.
+    """
+    for column in ["issn_electronic", "issn", "issn_print"]:
+        if current_row[column] != "NA":
+            journal = journal_kb.lookup(current_row[column])
+            if journal is not None:
+                return journal
+    return None
+
+def apply_journal_metadata(current_row, column_map, journal):
+    """
+    Copy the journal-level metadata of a knowledge base journal to a row.
+
+    NA values in the knowledge base never replace existing values.
+    """
+    for key in oat.JOURNAL_KB_FIELDS:
+        if journal[key] != "NA":
+            old_value = current_row[key]
+            current_row[key] = column_map[key].check_overwrite(old_value,
+                                                               journal[key])
+    msg = u"Journal KB: Journal-level metadata taken from '{}'"
+    print msg.format(journal["journal_full_title"]).encode("utf-8")
+
+def match_journal_title(title, title_index, threshold):
+    """
+    Identify a journal by its title.
+
+    Returns:
+        The best match of the title index (see JournalTitleIndex.query) if
+        it reaches the threshold and is not ambiguous, None otherwise.
+    """
+    candidates = title_index.query(title, min_score=threshold)
+    if not candidates:
+        return None
+    if (len(candidates) > 1 and
+            candidates[0]["score"] - candidates[1]["score"] < TITLE_MATCH_MARGIN):
+        msg = u"Title match: '{}' is ambiguous ({}), not matched"
+        titles = u", ".join(u"'{}'".format(c["journal_full_title"])
+                            for c in candidates[:3])
+        oat.print_y(msg.format(title, titles).encode("utf-8"))
+        return None
+    return candidates[0]
+
+def apply_title_match(current_row, column_map, match):
+    """
+    Copy the title, publisher and ISSN of a title match to a row.
+
+    The ISSN is only set if the row has none at all. It allows to look up
+    the journal in the knowledge base and in DOAJ afterwards.
+    """
+    msg = u"Title match: '{}' identified as '{}' (similarity {})"
+    print msg.format(current_row["journal_full_title"],
+                     match["journal_full_title"], match["score"]).encode("utf-8")
+    for key in ["journal_full_title", "publisher"]:
+        if match[key] != "NA":
+            current_row[key] = column_map[key].check_overwrite(current_row[key],
+                                                               match[key])
+    issn_columns = ["issn", "issn_print", "issn_electronic"]
+    if match["issns"] and all(current_row[c] == "NA" for c in issn_columns):
+        current_row["issn"] = match["issns"][0]
+
+def memoize_lookup(lookup, normalize):
+    """
+    Return a version of a lookup function which is called once per key.
+
+    Unlike the lookup cache, failed lookups are remembered as well, since
+    they would most likely fail again in the same run.
+    """
+    results = {}
+    def memoized_lookup(key, *args):
+        cache_key = normalize(key)
+        if cache_key not in results:
+            results[cache_key] = lookup(key, *args)
+        return results[cache_key]
+    return memoized_lookup
+
+def plan_lookups(reader, has_header, num_columns, column_map, parsers,
+                 previous_rows=None, row_range=None, journal_kb=None):
+    """
+    Scan the mapped input once and collect the lookups it requires.
+
+    Args:
+        reader: A reader for the input file, positioned at the start.
+        has_header: The file has a header row.
+        num_columns: The expected number of values per row.
+        column_map: The column map used for enrichment.
+        parsers: The value parsers used for enrichment.
+        previous_rows: Rows of a previous output (see load_previous_output),
+                       rows found there will not be looked up.
+        row_range: An optional tuple (first, last) restricting the scan to a
+                   range of data rows (see get_shard_range).
+        journal_kb: An optional JournalKnowledgeBase. Journals found there
+                    will not be looked up in DOAJ.
+    Returns:
+        A dict with the number of rows to enrich ('rows') and to reuse
+        ('reused'), the unique keys to look up ('crossref', 'pubmed' and
+        'doaj', OrderedDicts mapping normalized to original keys) and the
+        number of requests a row by row run would send ('naive', a dict).
+        DOAJ ISSNs are only taken from the input, ISSNs obtained from
+        crossref will be added during the run.
+    """
+    source_types = [ct for ct, c in column_map.iteritems() if c.index is not None]
+    record_type = oat.make_record_type(column_map.iterkeys())
+    plan = {"rows": 0, "reused": 0, "crossref": OrderedDict(),
+            "pubmed": OrderedDict(), "doaj": OrderedDict(),
+            "naive": {"crossref": 0, "pubmed": 0, "doaj": 0}}
+    data_row_num = 0
+    for row in reader:
+        if not row:
+            continue
+        if has_header:
+            has_header = False
+            continue
+        data_row_num += 1
+        if row_range is not None and not row_range[0] < data_row_num <= row_range[1]:
+            continue
+        if len(row) != num_columns:
+            continue
+        current_row = map_row(row, column_map, parsers, record_type)
+        if previous_rows is not None:
+            if get_row_fingerprint(current_row, source_types) in previous_rows:
+                plan["reused"] += 1
+                continue
+        plan["rows"] += 1
+        doi = current_row["doi"]
+        if oat.is_wellformed_DOI(doi):
+            for service in ["crossref", "pubmed"]:
+                plan[service].setdefault(oat.normalize_doi(doi), doi)
+                plan["naive"][service] += 1
+        if journal_kb is not None and lookup_journal_kb(current_row, journal_kb):
+            continue
+        if current_row["doaj"] != "TRUE":
+            for column in ["issn_electronic", "issn", "issn_print"]:
+                issn = current_row[column]
+                if issn != "NA":
+                    plan["doaj"].setdefault(oat.normalize_issn(issn), issn)
+                    plan["naive"]["doaj"] += 1
+    return plan
+
+def print_lookup_plan(plan, lookup_cache=None):
+    """
+    Print the lookup plan as a dry-run estimate of the requests to send.
+    """
+    msg = "Rows to enrich: {}".format(plan["rows"])
+    if plan["reused"]:
+        msg += " ({} unchanged rows taken from the previous output)".format(
+            plan["reused"])
+    print msg
+    requests = 0
+    for service, name in [("crossref", "Crossref"), ("pubmed", "Europe PMC"),
+                          ("doaj", "DOAJ")]:
+        keys = plan[service]
+        cached = 0
+        if lookup_cache is not None:
+            cached = sum(1 for key in keys
+                         if lookup_cache.get(service, key) is not None)
+        requests += len(keys) - cached
+        key_type = "ISSNs" if service == "doaj" else "DOIs"
+        msg = "{}: {} unique {} ({} with a row by row lookup), {} cached, {} requests"
+        print msg.format(name, len(keys), key_type, plan["naive"][service],
+                         cached, len(keys) - cached)
+    print ("(DOAJ: ISSNs obtained from crossref are not included, each will " +
+           "be looked up once during the run.)")
+    naive = sum(plan["naive"].values())
+    seconds = int(requests * LOOKUP_TIME_ESTIMATE)
+    msg = ("Expected requests: {} instead of {}, projected lookup time: " +
+           "{}:{:02d}:{:02d}")
+    oat.print_b(msg.format(requests, naive, seconds // 3600,
+                           (seconds // 60) % 60, seconds % 60))
+
+def finish_enrichment(args, enriched_content, fingerprints, error_messages,
+                      conflict_review):
+    """
+    Run the stages working on the whole enriched file and write the results.
+
+    This adds UT identifiers, checks for APC outliers, writes the output file
+    and reports conflicts and errors. It is shared by normal runs and merged
+    sharded runs.
+    """
+    # Only the column order of the map is needed from here on
+    column_map = OrderedDict.fromkeys(enriched_content[0])
+
+    print "\n    *** Adding Web of Science identifiers ***\n"
+    error_messages += add_ut_identifiers(enriched_content[1:], column_map,
+                                         args.doi_ut_file, args.wos)
+
+    outlier_warnings = []
+    if args.outliers:
+        print "\n    *** Checking APC amounts for outliers ***\n"
+        outlier_warnings = find_apc_outliers(enriched_content[1:], column_map,
+                                             args.outlier_reference,
+                                             args.outlier_threshold)
+
+    with open(args.output, 'w') as out:
+        writer = oat.OpenAPCUnicodeWriter(out, oat.OPENAPC_QUOTEMASK, True,
+                                          True)
+        writer.write_rows(enriched_content)
+    with open(args.output + FINGERPRINT_SUFFIX, 'w') as out:
+        for fingerprint in fingerprints:
+            out.write(fingerprint + "\n")
+
+    if conflict_review is not None and conflict_review.conflicts:
+        conflict_review.write(args.review_file)
+        msg = ("{} unresolved overwrite conflicts were written to {}, the " +
+               "existing values have been kept.")
+        oat.print_y(msg.format(len(conflict_review.conflicts),
+                               args.review_file))
+
+    if outlier_warnings:
+        oat.print_y("{} APC amounts look implausible:\n".format(
+            len(outlier_warnings)))
+        for msg in outlier_warnings:
+            print msg.encode("utf-8")
+        print ""
+
+    if not error_messages:
+        oat.print_g("Metadata enrichment successful, no errors occured")
+    else:
+        oat.print_r("There were errors during the enrichment process:\n")
+        for msg in error_messages:
+            print msg + "\n"
+
+def parse_shard(shard_spec):
+    """
+    Parse a shard given as 'K/N'. Returns a tuple (K, N) or None if invalid.
+    """
+    try:
+        shard, num_shards = [int(n) for n in shard_spec.split("/")]
+    except ValueError:
+        return None
+    if not 1 <= shard <= num_shards:
+        return None
+    return shard, num_shards
+
+def get_shard_range(reader, has_header, shard, num_shards):
+    """
+    Determine the data rows belonging to a shard.
+
+    Returns:
+        A tuple (first, last). The shard consists of the data rows with
+        first < number <= last (counting non-empty rows, starting with 1).
+    """
+    num_rows = sum(1 for row in reader if row)
+    if has_header and num_rows > 0:
+        num_rows -= 1
+    first = (shard - 1) * num_rows // num_shards
+    last = shard * num_rows // num_shards
+    return first, last
+
+def get_shard_path(file_path, shard, num_shards):
+    return "{}.shard{}of{}".format(file_path, shard, num_shards)
+
+def write_shard(output, enriched_content, fingerprints, error_messages,
+                conflict_review, shard, num_shards):
+    """
+    Write the results of a single shard for a later merge.
+
+    Besides the enriched rows (<output>.shardKofN) and their fingerprints,
+    the error messages and unresolved conflicts are stored as JSON.
+    """
+    out_path = get_shard_path(output, shard, num_shards)
+    with open(out_path, "w") as out:
+        writer = oat.OpenAPCUnicodeWriter(out, oat.OPENAPC_QUOTEMASK, True,
+                                          True)
+        writer.write_rows(enriched_content)
+    with open(out_path + FINGERPRINT_SUFFIX, "w") as out:
+        for fingerprint in fingerprints:
+            out.write(fingerprint + "\n")
+    conflicts = conflict_review.conflicts if conflict_review else []
+    with open(out_path + ".report", "w") as out:
+        json.dump({"errors": error_messages, "conflicts": conflicts}, out)
+    oat.print_g("Shard {} of {} written to {}".format(shard, num_shards,
+                                                     out_path))
+
+def run_shards(args):
+    """
+    Enrich a CSV file in parallel worker processes and merge the results.
+
+    Every worker is a new process of this script working on one row range
+    (--shard). The workers share a lookup cache, their console output is
+    written to <output>.shardKofN.log. Results of earlier runs are removed
+    before the workers start and the run is aborted if a worker fails, so
+    stale shards are never merged.
+    """
+    num_shards = args.shards
+    if num_shards < 1:
+        print "Error: The number of shards has to be at least 1."
+        sys.exit()
+    if args.save_profile:
+        msg = "Warning: --save-profile is ignored when processing shards, " + \
+              "save the profile in a --dry-run instead."
+        oat.print_y(msg)
+    # Pass on all arguments except --shards and --save-profile
+    worker_args = []
+    skip = False
+    for arg in sys.argv[1:]:
+        if skip:
+            skip = False
+        elif arg == "--shards":
+            skip = True
+        elif not arg.startswith("--shards=") and arg != "--save-profile":
+            worker_args.append(arg)
+    if not args.cache:
+        worker_args += ["--cache", DEFAULT_SHARD_CACHE]
+    if not args.yes:
+        worker_args.append("--yes")
+    # Create the cache and the journal knowledge base before the workers
+    # start, so they do not race to set them up
+    oat.LookupCache(args.cache or DEFAULT_SHARD_CACHE).close()
+    if not args.no_journal_kb:
+        oat.load_journal_kb(args.journal_kb, args.journal_kb_source)
+
+    for shard in range(1, num_shards + 1):
+        out_path = get_shard_path(args.output, shard, num_shards)
+        for path in [out_path, out_path + FINGERPRINT_SUFFIX,
+                     out_path + ".report"]:
+            if os.path.isfile(path):
+                os.remove(path)
+
+    workers = []
+    for shard in range(1, num_shards + 1):
+        shard_spec = "{}/{}".format(shard, num_shards)
+        log_path = get_shard_path(args.output, shard, num_shards) + ".log"
+        log = open(log_path, "w")
+        command = ([sys.executable, os.path.abspath(__file__)] + worker_args +
+                   ["--shard", shard_spec])
+        workers.append((shard, log_path, log,
+                        subprocess.Popen(command, stdout=log,
+                                         stderr=subprocess.STDOUT)))
+    print "Started {} worker processes.".format(num_shards)
+    failed = []
+    for shard, log_path, log, process in workers:
+        returncode = process.wait()
+        log.close()
+        if returncode != 0:
+            msg = "Shard {} of {} failed with exit code {} (log: {})"
+            oat.print_r(msg.format(shard, num_shards, returncode, log_path))
+            failed.append(shard)
+            continue
+        print "Shard {} of {} finished (log: {})".format(shard, num_shards,
+                                                        log_path)
+    if failed:
+        print "Error: {} of {} shards failed, no results were merged.".format(
+            len(failed), num_shards)
+        sys.exit()
+    finish_merged_run(args, num_shards)
+
+def merge_shards(output, num_shards):
+    """
+    Read and combine the results of all shards.
+
+    Returns:
+        A tuple (enriched_content, fingerprints, error_messages, conflicts)
+        with the rows in the original order.
+    """
+    enriched_content = []
+    fingerprints = []
+    error_messages = []
+    conflicts = []
+    for shard in range(1, num_shards + 1):
+        out_path = get_shard_path(output, shard, num_shards)
+        if not os.path.isfile(out_path + ".report"):
+            msg = "Error: Shard {} of {} did not finish, see {} for details."
+            oat.print_r(msg.format(shard, num_shards, out_path + ".log"))
+            sys.exit()
+        with open(out_path, "r") as shard_file:
+            rows = list(oat.UnicodeReader(shard_file))
+        enriched_content += rows if not enriched_content else rows[1:]
+        with open(out_path + FINGERPRINT_SUFFIX, "r") as shard_file:
+            fingerprints += [line.strip() for line in shard_file]
+        with open(out_path + ".report", "r") as shard_file:
+            report = json.load(shard_file)
+        error_messages += report["errors"]
+        conflicts += report["conflicts"]
+    return enriched_content, fingerprints, error_messages, conflicts
+
+def finish_merged_run(args, num_shards):
+    enriched_content, fingerprints, error_messages, conflicts = \
+        merge_shards(args.output, num_shards)
+    print "Merged {} shards ({} rows).".format(num_shards,
+                                              len(enriched_content) - 1)
+    conflict_review = ConflictReview()
+    conflict_review.conflicts = conflicts
+    finish_enrichment(args, enriched_content, fingerprints, error_messages,
+                      conflict_review)
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("csv_file", help=ARG_HELP_STRINGS["csv_file"])
@@ -187,15 +1164,89 @@ def main():
                         type=int, help=ARG_HELP_STRINGS["issn"])
     parser.add_argument("-url", "--url_column",
                         type=int, help=ARG_HELP_STRINGS["url"])
+    parser.add_argument("-o", "--output", default="out.csv",
+                        help=ARG_HELP_STRINGS["output"])
+    parser.add_argument("-p", "--policy", help=ARG_HELP_STRINGS["policy"])
+    parser.add_argument("-y", "--yes", action="store_true",
+                        help=ARG_HELP_STRINGS["yes"])
+    parser.add_argument("-r", "--review-file", default="review.csv",
+                        help=ARG_HELP_STRINGS["review_file"])
+    parser.add_argument("--profiles", default="mapping_profiles.json",
+                        help=ARG_HELP_STRINGS["profiles"])
+    parser.add_argument("--save-profile", action="store_true",
+                        help=ARG_HELP_STRINGS["save_profile"])
+    parser.add_argument("--no-profile", action="store_true",
+                        help=ARG_HELP_STRINGS["no_profile"])
+    parser.add_argument("--crossref-store",
+                        help=ARG_HELP_STRINGS["crossref_store"])
+    parser.add_argument("--previous", help=ARG_HELP_STRINGS["previous"])
+    parser.add_argument("--doi-ut-file", default="data/doi_ut.csv",
+                        help=ARG_HELP_STRINGS["doi_ut_file"])
+    parser.add_argument("--wos", action="store_true",
+                        help=ARG_HELP_STRINGS["wos"])
+    parser.add_argument("--service", help=ARG_HELP_STRINGS["service"])
+    parser.add_argument("--journal-kb", default="data/journal_kb.json",
+                        help=ARG_HELP_STRINGS["journal_kb"])
+    parser.add_argument("--journal-kb-source", default="data/apc_de.csv",
+                        help=ARG_HELP_STRINGS["journal_kb_source"])
+    parser.add_argument("--no-journal-kb", action="store_true",
+                        help=ARG_HELP_STRINGS["no_journal_kb"])
+    parser.add_argument("--dry-run", action="store_true",
+                        help=ARG_HELP_STRINGS["dry_run"])
+    parser.add_argument("--cache", help=ARG_HELP_STRINGS["cache"])
+    parser.add_argument("--shards", type=int, help=ARG_HELP_STRINGS["shards"])
+    parser.add_argument("--shard", help=ARG_HELP_STRINGS["shard"])
+    parser.add_argument("--merge-shards", type=int, metavar="N",
+                        help=ARG_HELP_STRINGS["merge_shards"])
+    parser.add_argument("--outliers", action="store_true",
+                        help=ARG_HELP_STRINGS["outliers"])
+    parser.add_argument("--outlier-reference", default="data/apc_de.csv",
+                        help=ARG_HELP_STRINGS["outlier_reference"])
+    parser.add_argument("--outlier-threshold", type=float, default=3.5,
+                        help=ARG_HELP_STRINGS["outlier_threshold"])
+    parser.add_argument("--doaj-list", default="data/doaj/doajJournalList.csv",
+                        help=ARG_HELP_STRINGS["doaj_list"])
+    parser.add_argument("--title-match-threshold", type=float, default=0.8,
+                        help=ARG_HELP_STRINGS["title_match_threshold"])
+    parser.add_argument("--no-title-matching", action="store_true",
+                        help=ARG_HELP_STRINGS["no_title_matching"])
+    parser.add_argument("--issn-l-table", default="data/issn_l.tsv",
+                        help=ARG_HELP_STRINGS["issn_l_table"])
 
     args = parser.parse_args()
     enc = None # CSV file encoding
 
-    if args.locale:
-        norm = locale.normalize(args.locale)
-        if norm != args.locale:
+    if args.shards and not args.dry_run:
+        run_shards(args)
+        return
+    if args.merge_shards:
+        finish_merged_run(args, args.merge_shards)
+        return
+    shard = None
+    if args.shard:
+        shard = parse_shard(args.shard)
+        if shard is None:
+            print "Error: Shards have to be given as K/N, with 1 <= K <= N."
+            sys.exit()
+        if not args.yes:
+            print "Error: Shards can only be processed unattended (--yes)."
+            sys.exit()
+
+    fingerprint = oat.get_header_fingerprint(args.csv_file)
+    profile = None
+    if fingerprint and not args.no_profile:
+        profiles = oat.load_mapping_profiles(args.profiles)
+        profile = profiles.get(fingerprint)
+
+    locale_name = args.locale
+    if profile and not locale_name:
+        locale_name = profile.get("locale")
+
+    if locale_name:
+        norm = locale.normalize(locale_name)
+        if norm != locale_name:
             print "locale '{}' not found, normalized to '{}'".format(
-                args.locale, norm)
+                locale_name, norm)
         try:
             loc = locale.setlocale(locale.LC_ALL, norm)
             print "Using locale", loc
@@ -217,18 +1268,26 @@ def main():
                    "guessing.")
             sys.exit()
 
-    result = oat.analyze_csv_file(args.csv_file)
-    if result["success"]:
-        csv_analysis = result["data"]
-        print csv_analysis
+    if profile:
+        msg = ("Found mapping profile '{}' matching the CSV header, " +
+               "skipping file analysis (use --no-profile to disable).")
+        oat.print_g(msg.format(profile["name"]))
+        if enc is None:
+            enc = profile["encoding"]
+        dialect = oat.dialect_from_dict(profile["dialect"])
+        has_header = profile["has_header"]
     else:
-        print result["error_msg"]
-        sys.exit()
-    
-    if enc is None:
-        enc = csv_analysis.enc
-    dialect = csv_analysis.dialect
-    has_header = csv_analysis.has_header
+        result = oat.analyze_csv_file(args.csv_file)
+        if result["success"]:
+            csv_analysis = result["data"]
+            print csv_analysis
+        else:
+            print result["error_msg"]
+            sys.exit()
+        if enc is None:
+            enc = csv_analysis.enc
+        dialect = csv_analysis.dialect
+        has_header = csv_analysis.has_header
 
     if enc is None:
         print ("Error: No encoding given for CSV file and automated " +
@@ -236,7 +1295,7 @@ def main():
                "--enc argument")
         sys.exit()
 
-    csv_file = open(args.csv_file, "r")
+    csv_file = oat.open_input_file(args.csv_file)
     reader = oat.UnicodeReader(csv_file, dialect=dialect, encoding=enc)
 
     first_row = reader.next()
@@ -246,149 +1305,39 @@ def main():
     csv_file.seek(0)
     reader = oat.UnicodeReader(csv_file, dialect=dialect, encoding=enc)
 
-    column_map = OrderedDict([
-        ("institution", CSVColumn("institution", CSVColumn.MANDATORY, args.institution_column)),  
-        ("period", CSVColumn("period", CSVColumn.MANDATORY, args.period_column)),
-        ("euro", CSVColumn("euro", CSVColumn.MANDATORY, args.euro_column)),
-        ("doi", CSVColumn("doi", CSVColumn.MANDATORY, args.doi_column)),
-        ("is_hybrid", CSVColumn("is_hybrid", CSVColumn.MANDATORY, args.is_hybrid_column)),
-        ("publisher", CSVColumn("publisher", CSVColumn.OPTIONAL, args.publisher_column)),
-        ("journal_full_title", CSVColumn("journal_full_title", CSVColumn.OPTIONAL,
-                                        args.journal_full_title_column)),
-        ("issn", CSVColumn("issn", CSVColumn.OPTIONAL, args.issn_column)),
-        ("issn_print", CSVColumn("issn_print", CSVColumn.NONE, None)),
-        ("issn_electronic", CSVColumn("issn_electronic", CSVColumn.NONE, None)),
-        ("license_ref", CSVColumn("license_ref", CSVColumn.NONE, None)),
-        ("indexed_in_crossref", CSVColumn("indexed_in_crossref", CSVColumn.NONE, None)),
-        ("pmid", CSVColumn("pmid", CSVColumn.NONE, None)),
-        ("pmcid", CSVColumn("pmcid", CSVColumn.NONE, None)),
-        ("ut", CSVColumn("ut", CSVColumn.NONE, None)),
-        ("url", CSVColumn("url", CSVColumn.OPTIONAL, args.url_column)),
-        ("doaj", CSVColumn("doaj", CSVColumn.NONE, None))
-    ])
-
-    # Do not quote the values in the 'period' and 'euro' columns
-    quotemask = [
-        True,
-        False,
-        False,
-        True,
-        True,
-        True,
-        True,
-        True,
-        True,
-        True,
-        True,
-        True,
-        True,
-        True,
-        True,
-        True,
-        True,
-    ]
+    # Columns can be identified on the command line (-doi 3, for example)
+    column_map = OrderedDict()
+    for column in oat.OPENAPC_SCHEMA:
+        index = getattr(args, column.name + "_column", None)
+        column_map[column.name] = CSVColumn(column.name, column.requirement,
+                                            index)
+
 
     header = None
-    if has_header:
-        for row in reader:
-            if not row: # Skip empty lines
-                continue
+    sample_rows = []
+    for row in reader:
+        if not row: # Skip empty lines
+            continue
+        if has_header and header is None:
             header = row # First non-empty row should be the header
+            continue
+        sample_rows.append(row)
+        if len(sample_rows) >= HEURISTIC_SAMPLE_SIZE:
+            break
+
+    if profile:
+        apply_mapping_profile(profile, column_map, header)
+    else:
+        if header:
             if args.ignore_header:
                 print "Skipping header analysis due to command line argument."
-                break
             else:
                 print "\n    *** Analyzing CSV header ***\n"
-            for (index, item) in enumerate(header):
-                column_type = oat.get_column_type_from_whitelist(item)
-                if column_type is not None and column_map[column_type].index is None:
-                    column_map[column_type].index = index
-                    column_map[column_type].column_name = item
-                    print ("Found column named '{}' at index {}, " +
-                           "assuming this to be the {} column.").format(
-                               item, index, column_type)
-            break
-
-
-    print "\n    *** Starting heuristical analysis ***\n"
-    for row in reader:
-        if not row: # Skip empty lines
-            # We analyze the first non-empty line, a possible header should
-            # have been processed by now.
-            continue
-        column_candidates = {
-            "doi": [],
-            "period": [],
-            "euro": []
-        }
-        for (index, entry) in enumerate(row):
-            if index in [csvcolumn.index for csvcolumn in column_map.values()]:
-                # Skip columns already assigned
-                continue
-            entry = entry.strip()
-            # Search for a DOI
-            if column_map['doi'].index is None:
-                if oat.DOI_RE.match(entry):
-                    column_id = str(index)
-                    # identify column either numerical or by column header
-                    if header:
-                        column_id += " ('" + header[index] + "')"
-                    print ("The entry in column {} looks like a " +
-                           "DOI: {}").format(column_id, entry)
-                    column_candidates['doi'].append(index)
-                    continue
-            # Search for a potential year string
-            if column_map['period'].index is None:
-                try:
-                    maybe_period = int(entry)
-                    now = datetime.date.today().year
-                    # Should be a wide enough margin
-                    if maybe_period >= 2000 and maybe_period <= now + 2:
-                        column_id = str(index)
-                        if header:
-                            column_id += " ('" + header[index] + "')"
-                        print ("The entry in column {} looks like a " +
-                               "potential period: {}").format(column_id, entry)
-                        column_candidates['period'].append(index)
-                        continue
-                except ValueError:
-                    pass
-            # Search for a potential monetary amount
-            if column_map['euro'].index is None:
-                try:
-                    maybe_euro = locale.atof(entry)
-                    # Are there APCs above 6000€ ??
-                    if maybe_euro >= 10 and maybe_euro <= 6000:
-                        column_id = str(index)
-                        if header:
-                            column_id += " ('" + header[index] + "')"
-                        print ("The entry in column {} looks like a " +
-                               "potential euro amount: {}").format(column_id,
-                                                                   entry)
-                        column_candidates['euro'].append(index)
-                        continue
-                except ValueError:
-                    pass
-        for column_type, candidates in column_candidates.iteritems():
-            if column_map[column_type].index is not None:
-                continue
-            if len(candidates) > 1:
-                print ("Could not reliably identify the '" + column_type +
-                       "' column - more than one possible candiate!")
-            elif len(candidates) < 1:
-                print "No candidate found for column '" + column_type + "'!"
-            else:
-                index = candidates.pop()
-                column_map[column_type].index = index
-                if header:
-                    column_id = header[index]
-                    column_map[column_type].column_name = column_id
-                else:
-                    column_id = index
-                print ("Assuming column '{}' to be the '{}' " +
-                       "column.").format(column_id, column_type)
-                column_map[column_type].index = index
-        break
+                analyze_header(header, column_map)
+        print "\n    *** Starting heuristical analysis ***\n"
+        if sample_rows:
+            # A possible header should have been processed by now.
+            analyze_rows(sample_rows, header, column_map)
 
     # Wrap up: Check if there any mandatory column types left which have not
     # yet been identified - we cannot continue in that case (unless forced).
@@ -417,6 +1366,57 @@ def main():
             print ("WARNING: Not all mandatory column types in the CSV file " +
                    "could be automatically identified - forced to continue.")
 
+    # Determine the value formats of the euro and period columns. An
+    # explicitly set locale takes precedence over format inference.
+    number_format = None
+    period_format = None
+    if profile:
+        if profile.get("number_format"):
+            number_format = tuple(profile["number_format"])
+        period_format = profile.get("period_format")
+    if args.locale:
+        number_format = oat.get_locale_number_format()
+    euro_index = column_map["euro"].index
+    period_index = column_map["period"].index
+    if number_format is None and euro_index is not None:
+        values = [row[euro_index] for row in sample_rows
+                  if len(row) > euro_index and row[euro_index].strip()]
+        decimal_point = oat.get_locale_number_format()[0]
+        number_format = oat.infer_number_format(values, decimal_point)
+    if period_format is None and period_index is not None:
+        values = [row[period_index] for row in sample_rows
+                  if len(row) > period_index and row[period_index].strip()]
+        period_format = oat.infer_period_format(values)
+
+    parsers = {}
+    if euro_index is not None:
+        msg = "Monetary values use '{}' as decimal mark"
+        if number_format[1]:
+            msg += " and '{}' as thousands separator"
+        print msg.format(*number_format).encode("utf-8")
+        parsers["euro"] = compile_euro_parser(*number_format)
+    if period_index is not None and period_format is not None:
+        print "Period values are in format " + period_format
+        parsers["period"] = oat.compile_period_parser(period_format)
+
+    if args.save_profile:
+        if fingerprint is None:
+            print "Could not compute a header fingerprint, profile not saved."
+        else:
+            new_profile = {
+                "name": os.path.basename(args.csv_file),
+                "encoding": enc,
+                "locale": norm if locale_name else None,
+                "dialect": oat.dialect_to_dict(dialect),
+                "has_header": has_header,
+                "number_format": number_format,
+                "period_format": period_format,
+                "columns": {ct: c.index for ct, c in column_map.iteritems()
+                            if c.index is not None}
+            }
+            oat.save_mapping_profile(args.profiles, fingerprint, new_profile)
+            print "Column mapping profile saved to " + args.profiles
+
     print "\n    *** CSV file analysis summary ***\n"
 
     index_dict = {csvc.index: csvc for csvc in column_map.values()}
@@ -461,22 +1461,127 @@ def main():
                "identified. Metadata aggregation is still possible, but " +
                "every entry in the CSV file will need a valid DOI.")
 
-    start = raw_input("\nStart metadata aggregation? (y/n):")
-    while start not in ["y", "n"]:
-        start = raw_input("Please type 'y' or 'n':")
-    if start == "n":
+    print "\n    *** Validating column values ***\n"
+    parse_errors = validate_column_values(csv_file, dialect, enc, has_header,
+                                          num_columns, column_map, parsers)
+    if parse_errors:
+        for msg in parse_errors:
+            oat.print_r(msg)
+        print ERROR_MSGS["values"].format(len(parse_errors))
         sys.exit()
+    oat.print_g("All values could be parsed.")
+
+    if args.policy:
+        result = load_overwrite_policy(args.policy)
+        if not result["success"]:
+            print result["error_msg"]
+            sys.exit()
+        apply_overwrite_policy(column_map, result["data"])
+
+    conflict_review = None
+    if args.yes:
+        conflict_review = ConflictReview()
+        for column in column_map.values():
+            column.conflict_review = conflict_review
+
+    crossref_store = None
+    if args.crossref_store:
+        crossref_store = oat.CrossrefStore(args.crossref_store)
+    # The enrichment service client offers the same lookup functions as the
+    # toolkit module
+    lookups = oat
+    get_crossref = lambda doi: oat.get_metadata_from_crossref(doi, crossref_store)
+    if args.service:
+        lookups = oat.EnrichmentServiceClient(args.service)
+        get_crossref = lookups.get_metadata_from_crossref
+    get_pubmed = lookups.get_metadata_from_pubmed
+    lookup_doaj = lookups.lookup_journal_in_doaj
+    lookup_cache = None
+    if args.cache:
+        lookup_cache = oat.LookupCache(args.cache)
+        get_crossref = lookup_cache.wrap("crossref", get_crossref,
+                                         normalize=oat.normalize_doi)
+        get_pubmed = lookup_cache.wrap("pubmed", get_pubmed,
+                                       normalize=oat.normalize_doi)
+        lookup_doaj = lookup_cache.wrap("doaj", lookup_doaj, "data_received",
+                                        oat.normalize_issn)
+    # Every unique DOI and ISSN is only looked up once per run
+    get_crossref = memoize_lookup(get_crossref, oat.normalize_doi)
+    get_pubmed = memoize_lookup(get_pubmed, oat.normalize_doi)
+    lookup_doaj = memoize_lookup(lookup_doaj, oat.normalize_issn)
+
+    journal_kb = None
+    if not args.no_journal_kb:
+        journal_kb = oat.load_journal_kb(args.journal_kb,
+                                         args.journal_kb_source)
+        if journal_kb is not None:
+            print "Loaded {} journals from the journal knowledge base {}".format(
+                len(journal_kb), args.journal_kb)
+            if os.path.isfile(args.issn_l_table):
+                journal_kb.issnl_index = oat.load_issnl_index(args.issn_l_table)
+                print "Loaded {} ISSN-L mappings from {}".format(
+                    len(journal_kb.issnl_index), args.issn_l_table)
+
+    # The title index is only built once a row without a DOI shows up
+    title_index = {}
+    def match_title(title):
+        if "index" not in title_index:
+            doaj_list = args.doaj_list if os.path.isfile(args.doaj_list) else None
+            title_index["index"] = oat.build_journal_title_index(journal_kb,
+                                                                 doaj_list)
+            print "Built a title index of {} journals".format(
+                len(title_index["index"]))
+        return match_journal_title(title, title_index["index"],
+                                   args.title_match_threshold)
+    match_title = memoize_lookup(match_title, oat.normalize_journal_title)
+
+    source_types = [ct for ct, c in column_map.iteritems() if c.index is not None]
+    record_type = oat.make_record_type(column_map.iterkeys())
+    previous_rows = None
+    if args.previous:
+        previous_rows, previous_dois = load_previous_output(args.previous,
+                                                            source_types)
+        print "Loaded {} rows from previous output {}".format(
+            len(previous_rows), args.previous)
+    incremental_counts = {"reused": 0, "new": 0, "changed": 0}
+
+    csv_file.seek(0)
+    reader = oat.UnicodeReader(csv_file, dialect=dialect, encoding=enc)
+    row_range = None
+    if shard is not None:
+        row_range = get_shard_range(reader, has_header, *shard)
+        msg = "Processing shard {} of {} (data rows {} to {})"
+        oat.print_b(msg.format(shard[0], shard[1], row_range[0] + 1,
+                               row_range[1]))
+        csv_file.seek(0)
+        reader = oat.UnicodeReader(csv_file, dialect=dialect, encoding=enc)
+
+    print "\n    *** Planning lookups ***\n"
+    plan = plan_lookups(reader, has_header, num_columns, column_map, parsers,
+                        previous_rows, row_range, journal_kb)
+    print_lookup_plan(plan, lookup_cache)
+    if args.dry_run:
+        csv_file.close()
+        return
+    if not args.yes:
+        start = raw_input("\nStart metadata aggregation? (y/n):")
+        while start not in ["y", "n"]:
+            start = raw_input("Please type 'y' or 'n':")
+        if start == "n":
+            sys.exit()
 
     print "\n    *** Starting metadata aggregation ***\n"
 
     enriched_content = []
-    
+    fingerprints = []
+
     error_messages = []
 
     csv_file.seek(0)
     reader = oat.UnicodeReader(csv_file, dialect=dialect, encoding=enc)
     header_processed = False
     row_num = 0
+    data_row_num = 0
 
     for row in reader:
         row_num += 1
@@ -489,6 +1594,9 @@ def main():
                 # If the CSV file has a header, we are currently there - skip it
                 # to get to the first data row
                 continue
+        data_row_num += 1
+        if row_range is not None and not row_range[0] < data_row_num <= row_range[1]:
+            continue
         print "---Processing line number " + str(row_num) + "---"
         if len(row) != num_columns:
             error_msg = ("Syntax: the number of values in line {} ({}) " +
@@ -499,40 +1607,63 @@ def main():
             error_messages.append("Line {}: {}".format(row_num, error_msg_fmt))
             oat.print_r(error_msg_fmt)
             enriched_content.append(row)
+            fingerprints.append("")
             continue
 
         doi = row[column_map["doi"].index]
-        
-        current_row = OrderedDict()
-        # Copy content of identified columns
-        for csv_column in column_map.values():
-            if csv_column.index is not None and len(row[csv_column.index]) > 0:
-                if csv_column.column_type == "euro":
-                    # special case for monetary values: Cast to float to ensure
-                    # the decimal point is a dot (instead of a comma)
-                    euro_value = row[csv_column.index]
-                    try:
-                        euro = locale.atof(euro_value)
-                        if euro.is_integer():
-                            euro = int(euro)
-                        current_row[csv_column.column_type] = str(euro)
-                    except ValueError:
-                        msg = ERROR_MSGS["locale"].format(euro_value,
-                                                          csv_column.index)
-                        oat.print_r(msg)
-                        sys.exit()
-                else:
-                    current_row[csv_column.column_type] = row[csv_column.index]
+        if conflict_review is not None:
+            conflict_review.line = row_num
+            conflict_review.doi = doi
+
+        current_row = map_row(row, column_map, parsers, record_type)
+        fingerprint = get_row_fingerprint(current_row, source_types)
+        fingerprints.append(fingerprint)
+        if previous_rows is not None:
+            if fingerprint in previous_rows:
+                previous_row = previous_rows[fingerprint]
+                print "Row unchanged, using values from previous output."
+                incremental_counts["reused"] += 1
+                enriched_content.append([previous_row.get(ct, value)
+                                         for ct, value in current_row.iteritems()])
+                continue
+            if oat.is_wellformed_DOI(doi) and oat.normalize_doi(doi) in previous_dois:
+                incremental_counts["changed"] += 1
             else:
-                current_row[csv_column.column_type] = "NA"
+                incremental_counts["new"] += 1
+
+        # Without a DOI, the journal can only be identified by its title
+        if (not args.no_title_matching and not oat.is_wellformed_DOI(doi) and
+                current_row["journal_full_title"] != "NA" and
+                (journal_kb is None or
+                 lookup_journal_kb(current_row, journal_kb) is None)):
+            match = match_title(current_row["journal_full_title"])
+            if match is not None:
+                apply_title_match(current_row, column_map, match)
+
+        # Journal-level metadata of known journals is taken from the
+        # knowledge base, crossref is only used for article-level metadata
+        kb_journal = None
+        if journal_kb is not None:
+            kb_journal = lookup_journal_kb(current_row, journal_kb)
+            if kb_journal is not None:
+                apply_journal_metadata(current_row, column_map, kb_journal)
 
         # include crossref metadata
-        crossref_result = oat.get_metadata_from_crossref(doi)
+        crossref_result = get_crossref(doi)
         if crossref_result["success"]:
             print "Crossref: DOI resolved: " + doi
             current_row["indexed_in_crossref"] = "TRUE"
             data = crossref_result["data"]
+            if journal_kb is not None and kb_journal is None:
+                # The ISSNs obtained from crossref might be known
+                issns = {key: data[key] or "NA" for key in
+                         ["issn_electronic", "issn", "issn_print"]}
+                kb_journal = lookup_journal_kb(issns, journal_kb)
+                if kb_journal is not None:
+                    apply_journal_metadata(current_row, column_map, kb_journal)
             for key, value in data.iteritems():
+                if kb_journal is not None and key in oat.JOURNAL_KB_FIELDS:
+                    continue
                 if value is not None:
                     if key == "journal_full_title":
                         unified_value = oat.get_unified_journal_title(value)
@@ -567,7 +1698,7 @@ def main():
             current_row["indexed_in_crossref"] = "FALSE"
 
         # include pubmed metadata
-        pubmed_result = oat.get_metadata_from_pubmed(doi)
+        pubmed_result = get_pubmed(doi)
         if pubmed_result["success"]:
             print "Pubmed: DOI resolved: " + doi
             data = pubmed_result["data"]
@@ -587,17 +1718,31 @@ def main():
             oat.print_r(error_msg)
             error_messages.append("Line {}: {}".format(row_num, error_msg))
 
-        # lookup in DOAJ. try the EISSN first, then ISSN and finally print ISSN
-        if current_row["doaj"] != "TRUE":
+        # ISSNs (from the CSV file or crossref) are stored in canonical form
+        for column in ["issn", "issn_print", "issn_electronic"]:
+            issn = current_row[column]
+            if issn == "NA":
+                continue
+            normalized = oat.normalize_issn(issn)
+            if normalized != issn:
+                oat.print_b(INFO_MSGS["issn"].format(issn, normalized))
+                current_row[column] = normalized
+            if not oat.is_valid_ISSN(normalized):
+                msg = "ISSN: '{}' ({}) is no valid ISSN (format or check digit)"
+                msg_fmt = msg.format(normalized, column)
+                oat.print_y(msg_fmt)
+                error_messages.append("Line {}: {}".format(row_num, msg_fmt))
+
+        # lookup in DOAJ. try the EISSN first, then ISSN and finally print ISSN.
+        # Not necessary for knowledge base journals, their doaj value is kept
+        # up to date by doaj_refresh.py.
+        if current_row["doaj"] != "TRUE" and kb_journal is None:
             issns = []
-            if current_row["issn_electronic"] != "NA":
-                issns.append(current_row["issn_electronic"])
-            if current_row["issn"] != "NA":
-                issns.append(current_row["issn"])
-            if current_row["issn_print"] != "NA":
-                issns.append(current_row["issn_print"])
+            for column in ["issn_electronic", "issn", "issn_print"]:
+                if current_row[column] != "NA" and current_row[column] not in issns:
+                    issns.append(current_row[column])
             for issn in issns:
-                doaj_res = oat.lookup_journal_in_doaj(issn, args.bypass_cert_verification)
+                doaj_res = lookup_doaj(issn, args.bypass_cert_verification)
                 if doaj_res["data_received"]:
                     if doaj_res["data"]["in_doaj"]:
                         msg = "DOAJ: Journal ISSN ({}) found in DOAJ ('{}')."
@@ -618,17 +1763,24 @@ def main():
         enriched_content.append(current_row.values())
 
     csv_file.close()
+    if crossref_store is not None:
+        crossref_store.close()
+    if lookup_cache is not None:
+        lookup_cache.close()
 
-    with open('out.csv', 'w') as out:
-        writer = oat.OpenAPCUnicodeWriter(out, quotemask, True, True)
-        writer.write_rows(enriched_content)
+    if shard is not None:
+        # Identifiers and outliers are handled once for the merged file
+        write_shard(args.output, enriched_content, fingerprints,
+                    error_messages, conflict_review, *shard)
+        return
 
-    if not error_messages:
-        oat.print_g("Metadata enrichment successful, no errors occured")
-    else:
-        oat.print_r("There were errors during the enrichment process:\n")
-        for msg in error_messages:
-            print msg + "\n"
+    if previous_rows is not None:
+        msg = ("Incremental run: {reused} rows taken from the previous " +
+               "output, {changed} changed rows and {new} new rows enriched.")
+        oat.print_b(msg.format(**incremental_counts))
+
+    finish_enrichment(args, enriched_content, fingerprints, error_messages,
+                      conflict_review)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,67 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+"""
+Build or query a DOI/ISSN index over an OpenAPC CSV file.
+
+The index (see openapc_toolkit.APCIndex) allows fast lookups of DOIs and
+ISSNs in apc_de.csv without parsing the whole file. It is shared between
+processes via mmap.
+"""
+
+import argparse
+import sys
+
+import openapc_toolkit as oat
+
+def build(args):
+    count = oat.build_apc_index(args.csv_file, args.index_file)
+    print "Wrote {} index entries for {} to {}".format(count, args.csv_file,
+                                                 args.index_file)
+
+def lookup(args):
+    index = oat.APCIndex(args.index_file, args.csv_file)
+    if not index.is_current():
+        msg = "WARNING: {} has been modified since the index was built."
+        oat.print_y(msg.format(args.csv_file))
+    found = False
+    for key in args.keys:
+        if oat.is_wellformed_DOI(key):
+            offsets = index.lookup_doi(key)
+        else:
+            offsets = index.lookup_issn(key)
+        for offset in offsets:
+            row = index.get_row(offset)
+            msg = u"{}: {} ({}, {}, {})".format(key, row["doi"],
+                                                row["institution"],
+                                                row["period"],
+                                                row["journal_full_title"])
+            print msg.encode("utf-8")
+            found = True
+        if not offsets:
+            print "{}: not found".format(key)
+    index.close()
+    if not found:
+        sys.exit(1)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--csv_file", default="data/apc_de.csv",
+                        help="The OpenAPC CSV file (default: data/apc_de.csv)")
+    parser.add_argument("-x", "--index_file", default="data/apc_de.idx",
+                        help="The index file (default: data/apc_de.idx)")
+    subparsers = parser.add_subparsers(help="The index operation to perform")
+
+    build_parser = subparsers.add_parser("build", help="Build the index")
+    build_parser.set_defaults(func=build)
+
+    lookup_parser = subparsers.add_parser("lookup", help="Look up DOIs " +
+                                          "or ISSNs in the index")
+    lookup_parser.add_argument("keys", nargs="+", help="DOIs or ISSNs")
+    lookup_parser.set_defaults(func=lookup)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
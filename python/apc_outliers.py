@@ -0,0 +1,199 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+"""
+Detect implausible APC amounts.
+
+APC amounts are compared against robust per-journal and per-publisher
+distributions (median and median absolute deviation, MAD) computed over
+apc_de.csv. Rows deviating by more than a threshold (as robust z-score) are
+reported. All statistics are computed in a single vectorized pass using
+NumPy.
+
+This script audits a whole CSV file, apc_csv_processing uses the same
+functions to check newly enriched rows (--outliers).
+"""
+
+import argparse
+import sys
+
+import openapc_toolkit as oat
+
+try:
+    import numpy as np
+except ImportError:
+    print ("WARNING: 3rd party module 'numpy' not found - outlier " +
+           "detection will not work")
+    np = None
+
+# Robust z-scores above this value are considered outliers
+DEFAULT_THRESHOLD = 3.5
+# Groups with fewer values are not used as a reference
+MIN_GROUP_SIZE = 5
+# Scales the MAD to the standard deviation of a normal distribution
+MAD_SCALE = 1.4826
+# Lower bound for the spread of a group, relative to its median. Many
+# journals have a fixed list price, so their MAD is (close to) zero and
+# small deviations like currency conversion effects would be reported.
+MIN_RELATIVE_SCALE = 0.1
+
+def _group_medians(values, groups, num_groups):
+    """
+    Compute the median of values for every group (given as group indices).
+    """
+    order = np.lexsort((values, groups))
+    sorted_values = values[order]
+    counts = np.bincount(groups, minlength=num_groups)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    medians = np.full(num_groups, np.nan)
+    valid = counts > 0
+    lower = (starts + (counts - 1) // 2)[valid]
+    upper = (starts + counts // 2)[valid]
+    medians[valid] = (sorted_values[lower] + sorted_values[upper]) / 2.0
+    return medians, counts
+
+class APCDistribution(object):
+    """
+    Robust distributions of APC amounts per group (journal or publisher).
+    """
+
+    def __init__(self, euros, keys):
+        euros = np.asarray(euros, dtype=float)
+        self.keys, inverse = np.unique(np.asarray(keys), return_inverse=True)
+        self.medians, self.counts = _group_medians(euros, inverse,
+                                                   len(self.keys))
+        deviations = np.abs(euros - self.medians[inverse])
+        mads = _group_medians(deviations, inverse, len(self.keys))[0]
+        self.scales = np.maximum(mads * MAD_SCALE,
+                                 np.abs(self.medians) * MIN_RELATIVE_SCALE)
+
+    def lookup(self, keys):
+        """
+        Return the group indices for keys, -1 for unknown keys.
+        """
+        keys = np.asarray(keys)
+        if not len(self.keys):
+            return np.full(len(keys), -1, dtype=int)
+        indices = np.searchsorted(self.keys, keys)
+        indices = np.clip(indices, 0, len(self.keys) - 1)
+        indices[self.keys[indices] != keys] = -1
+        return indices
+
+    def score(self, euros, keys):
+        """
+        Compute robust z-scores of euro values against their groups.
+
+        Returns:
+            A tuple of arrays (z-scores, group medians). Both are NaN for
+            values without a group of at least MIN_GROUP_SIZE values.
+        """
+        euros = np.asarray(euros, dtype=float)
+        indices = self.lookup(keys)
+        usable = indices >= 0
+        usable[usable] = self.counts[indices[usable]] >= MIN_GROUP_SIZE
+        medians = np.full(len(euros), np.nan)
+        scales = np.full(len(euros), np.nan)
+        medians[usable] = self.medians[indices[usable]]
+        scales[usable] = self.scales[indices[usable]]
+        deviations = np.abs(euros - medians)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scores = deviations / scales
+        # Only possible for a group median of 0
+        scores[usable & (scales == 0)] = np.where(
+            deviations[usable & (scales == 0)] > 0, np.inf, 0.0)
+        return scores, medians
+
+class OutlierDetector(object):
+    """
+    Score APC amounts against journal and publisher distributions.
+
+    The journal distribution is used if the journal has at least
+    MIN_GROUP_SIZE reference values, the publisher distribution otherwise.
+    """
+
+    def __init__(self, reference_rows):
+        euros, journals, publishers = _extract_columns(reference_rows)
+        self.journals = APCDistribution(euros, journals)
+        self.publishers = APCDistribution(euros, publishers)
+
+    def score(self, rows):
+        """
+        Score a list of row dicts.
+
+        Returns:
+            A tuple of arrays (z-scores, reference medians, basis), where
+            basis is 'journal', 'publisher' or '' for every row.
+        """
+        euros, journals, publishers = _extract_columns(rows)
+        scores, medians = self.journals.score(euros, journals)
+        basis = np.where(np.isnan(scores), "", "journal").astype("S9")
+        p_scores, p_medians = self.publishers.score(euros, publishers)
+        fallback = np.isnan(scores) & ~np.isnan(p_scores)
+        scores[fallback] = p_scores[fallback]
+        medians[fallback] = p_medians[fallback]
+        basis[fallback] = "publisher"
+        return scores, medians, basis
+
+    def find_outliers(self, rows, threshold=DEFAULT_THRESHOLD):
+        """
+        Return (row index, z-score, reference median, basis) tuples for all
+        rows scoring above the threshold, the most extreme ones first.
+        """
+        scores, medians, basis = self.score(rows)
+        with np.errstate(invalid="ignore"):
+            flagged = np.nonzero(scores > threshold)[0]
+        flagged = flagged[np.argsort(-scores[flagged], kind="mergesort")]
+        return [(int(i), float(scores[i]), float(medians[i]), str(basis[i]))
+                for i in flagged]
+
+def _extract_columns(rows):
+    euros = []
+    journals = []
+    publishers = []
+    for row in rows:
+        try:
+            euros.append(float(row["euro"]))
+        except ValueError:
+            euros.append(float("nan"))
+        journals.append(row["journal_full_title"].strip().lower())
+        publishers.append(row["publisher"].strip().lower())
+    return (np.array(euros, dtype=float), np.array(journals, dtype=unicode),
+            np.array(publishers, dtype=unicode))
+
+def load_rows(csv_path):
+    with open(csv_path, "r") as csv_file:
+        return list(oat.UnicodeRecordReader(csv_file))
+
+def format_outlier(row, score, median, basis):
+    msg = (u"{}: {} EUR deviates from the {} median of {} EUR " +
+           u"(robust z-score {:.1f}, {}, {})")
+    group = row["journal_full_title"] if basis == "journal" else row["publisher"]
+    return msg.format(row["doi"], row["euro"], basis, median, score, group,
+                      row["institution"])
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("csv_file", nargs="?", default="data/apc_de.csv",
+                        help="The OpenAPC CSV file to audit (default: " +
+                        "data/apc_de.csv)")
+    parser.add_argument("-r", "--reference", default="data/apc_de.csv",
+                        help="The CSV file to compute the distributions " +
+                        "from (default: data/apc_de.csv)")
+    parser.add_argument("-t", "--threshold", type=float,
+                        default=DEFAULT_THRESHOLD,
+                        help="Robust z-score above which an APC is " +
+                        "reported (default: {})".format(DEFAULT_THRESHOLD))
+    args = parser.parse_args()
+
+    if np is None:
+        sys.exit()
+    detector = OutlierDetector(load_rows(args.reference))
+    rows = load_rows(args.csv_file)
+    outliers = detector.find_outliers(rows, args.threshold)
+    for index, score, median, basis in outliers:
+        print format_outlier(rows[index], score, median, basis).encode("utf-8")
+    print "{} of {} rows are potential outliers.".format(len(outliers),
+                                                         len(rows))
+
+if __name__ == '__main__':
+    main()
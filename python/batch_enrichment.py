@@ -0,0 +1,147 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+"""
+Enrich many CSV files (like institution deliveries) in one run.
+
+Every input file is enriched by an unattended apc_csv_processing.py job.
+The jobs are scheduled through a pool of worker processes and share one
+lookup cache, so DOIs and ISSNs occurring in several files are only looked
+up once. The result of every file is written to its own path below the
+output directory, mirroring the directory structure of the input files,
+together with a log (.log) and a conflict review file (.review.csv).
+
+Additional arguments for apc_csv_processing.py can be given after '--':
+
+    batch_enrichment.py "data/*/apc_*.csv" -- --policy policy.json
+"""
+
+import argparse
+import glob
+from multiprocessing.pool import ThreadPool
+import os
+import subprocess
+import sys
+import time
+
+import openapc_toolkit as oat
+
+ARG_HELP_STRINGS = {
+    "input": "CSV files or glob patterns (quote them to prevent expansion " +
+             "by the shell)",
+    "output_dir": "Directory for the enriched files (default: enriched)",
+    "workers": "Number of files enriched in parallel (default: 4)",
+    "cache": "The lookup cache shared by all jobs (default: " +
+             "lookup_cache.db)"
+}
+
+def expand_inputs(patterns):
+    """
+    Expand glob patterns into a sorted list of unique, existing files.
+    """
+    files = set()
+    for pattern in patterns:
+        matches = glob.glob(pattern)
+        if not matches:
+            oat.print_y("WARNING: No files found for '{}'".format(pattern))
+        files.update(path for path in matches if os.path.isfile(path))
+    return sorted(files)
+
+def get_output_paths(input_files, output_dir):
+    """
+    Map every input file to an output path below output_dir.
+
+    The paths of the input files relative to their common parent directory
+    are kept, so files with the same name in different institution
+    directories do not collide.
+    """
+    abs_paths = [os.path.abspath(path) for path in input_files]
+    # Compare whole path components, a character based prefix would turn
+    # data/uni and data/unikassel into data/uni
+    dir_parts = [os.path.dirname(path).split(os.sep) for path in abs_paths]
+    common_parts = dir_parts[0]
+    for parts in dir_parts[1:]:
+        length = 0
+        for part, common_part in zip(parts, common_parts):
+            if part != common_part:
+                break
+            length += 1
+        common_parts = common_parts[:length]
+    base_dir = os.sep.join(common_parts) or os.sep
+    return {path: os.path.join(output_dir, os.path.relpath(abs_path, base_dir))
+            for path, abs_path in zip(input_files, abs_paths)}
+
+def run_job(job):
+    input_file, output, cache, processing_args = job
+    output_dir = os.path.dirname(output)
+    if output_dir and not os.path.isdir(output_dir):
+        try:
+            os.makedirs(output_dir)
+        except OSError:
+            # Created by another job in the meantime
+            pass
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "apc_csv_processing.py")
+    command = ([sys.executable, script, input_file, "--yes", "--output",
+                output, "--review-file", output + ".review.csv", "--cache",
+                cache] + processing_args)
+    # A stale result of an earlier run must not be taken for a success
+    if os.path.isfile(output):
+        os.remove(output)
+    start = time.time()
+    with open(output + ".log", "w") as log:
+        returncode = subprocess.call(command, stdout=log,
+                                     stderr=subprocess.STDOUT)
+    success = returncode == 0 and os.path.isfile(output)
+    return input_file, output, success, time.time() - start
+
+def main():
+    if "--" in sys.argv:
+        split = sys.argv.index("--")
+        argv, processing_args = sys.argv[1:split], sys.argv[split + 1:]
+    else:
+        argv, processing_args = sys.argv[1:], []
+    parser = argparse.ArgumentParser(
+        usage="%(prog)s [-h] [-d OUTPUT_DIR] [-w WORKERS] [-c CACHE] " +
+              "input [input ...] [-- PROCESSING_ARGS]")
+    parser.add_argument("input", nargs="+", help=ARG_HELP_STRINGS["input"])
+    parser.add_argument("-d", "--output-dir", default="enriched",
+                        help=ARG_HELP_STRINGS["output_dir"])
+    parser.add_argument("-w", "--workers", type=int, default=4,
+                        help=ARG_HELP_STRINGS["workers"])
+    parser.add_argument("-c", "--cache", default="lookup_cache.db",
+                        help=ARG_HELP_STRINGS["cache"])
+    args = parser.parse_args(argv)
+
+    input_files = expand_inputs(args.input)
+    if not input_files:
+        print "Error: No input files found."
+        sys.exit()
+    # Create the cache before the jobs start, so they do not race to set it up
+    oat.LookupCache(args.cache).close()
+
+    outputs = get_output_paths(input_files, args.output_dir)
+    jobs = [(path, outputs[path], args.cache, processing_args)
+            for path in input_files]
+    print "Enriching {} files with {} workers.".format(len(jobs), args.workers)
+    failed = []
+    pool = ThreadPool(args.workers)
+    for input_file, output, success, duration in pool.imap_unordered(run_job,
+                                                                     jobs):
+        if success:
+            msg = "{} -> {} ({:.1f}s)".format(input_file, output, duration)
+            oat.print_g(msg)
+        else:
+            failed.append(input_file)
+            msg = "{} failed, see {} for details.".format(input_file,
+                                                          output + ".log")
+            oat.print_r(msg)
+    pool.close()
+    pool.join()
+
+    print "{} of {} files enriched.".format(len(jobs) - len(failed), len(jobs))
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
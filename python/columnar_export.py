@@ -0,0 +1,34 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+"""
+Export apc_de.csv to compressed column files.
+
+The export (see openapc_toolkit.export_columnar) is only rebuilt if the CSV
+file has changed. Analytical consumers can load it via
+openapc_toolkit.read_columnar, reading only the columns they need.
+"""
+
+import argparse
+
+import openapc_toolkit as oat
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--csv_file", default="data/apc_de.csv",
+                        help="The OpenAPC CSV file (default: data/apc_de.csv)")
+    parser.add_argument("-d", "--export_dir", default="data/apc_de.columns",
+                        help="The export directory (default: " +
+                        "data/apc_de.columns)")
+    parser.add_argument("-f", "--force", action="store_true",
+                        help="Rebuild the export even if the CSV file did " +
+                        "not change.")
+    args = parser.parse_args()
+
+    if oat.export_columnar(args.csv_file, args.export_dir, args.force):
+        print "Exported {} to {}".format(args.csv_file, args.export_dir)
+    else:
+        print "Export in {} is up to date.".format(args.export_dir)
+
+if __name__ == '__main__':
+    main()
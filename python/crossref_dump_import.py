@@ -0,0 +1,34 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+"""
+Import a crossref metadata dump into a local crossref store.
+
+This script reads a crossref metadata dump (JSON lines, optionally gzipped)
+and stores the metadata relevant to OpenAPC in a local SQLite database. The
+database can be used by apc_csv_processing (--crossref-store) to avoid
+querying crossref for every DOI.
+"""
+
+import argparse
+
+import openapc_toolkit as oat
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("dump_file", help="A crossref metadata dump, one " +
+                        "JSON work record per line (may be gzipped).")
+    parser.add_argument("store_file", help="The crossref store database. " +
+                        "It will be created if it does not exist.")
+    parser.add_argument("-b", "--batch-size", type=int, default=10000,
+                        help="Number of records to insert per transaction.")
+    args = parser.parse_args()
+
+    store = oat.CrossrefStore(args.store_file)
+    count = oat.import_crossref_dump(args.dump_file, store, args.batch_size)
+    print "Imported {} records, the store now contains {} DOIs.".format(
+        count, len(store))
+    store.close()
+
+if __name__ == '__main__':
+    main()
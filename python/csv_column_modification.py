@@ -9,7 +9,8 @@ import sys
 import openapc_toolkit as oat
 
 ARG_HELP_STRINGS = {
-    "csv_file": "The csv file where columns should be modified",
+    "csv_file": "The csv file where columns should be modified (also TSV, " +
+                ".xlsx, .gz, .bz2 or .zip)",
     "encoding": "The encoding of the CSV file. Setting this argument will " +
                 "disable automatic guessing of encoding.",
     "quotemask": "A quotemask to apply to the result file after the action " +
@@ -92,7 +93,7 @@ def main():
         
     dialect = csv_analysis.dialect
     
-    csv_file = open(args.csv_file, "r")
+    csv_file = oat.open_input_file(args.csv_file)
 
     reader = oat.UnicodeReader(csv_file, dialect=dialect, encoding=enc)
     new_rows = args.func(reader, args)
@@ -0,0 +1,305 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+"""
+Compare two versions of an OpenAPC CSV file row by row.
+
+Unlike a line-based diff, rows are matched by a key: the normalised DOI, or
+for rows without a DOI a composite key of institution, period, journal
+(ISSN or title) and URL. Reordered rows are therefore not reported, changed
+rows are reported field by field.
+
+Both files are sorted by key with an external merge sort: Chunks of at most
+--chunk-size rows are sorted in memory and written to temporary files, which
+are then merged. Memory usage is bounded by the chunk size, so files of
+millions of rows can be compared. The sorted files are compared in a single
+merge pass.
+
+    csv_diff.py old/apc_de.csv data/apc_de.csv -o changes.csv
+"""
+
+import argparse
+import heapq
+from itertools import groupby
+import os
+import shutil
+import sys
+import tempfile
+
+import openapc_toolkit as oat
+
+ARG_HELP_STRINGS = {
+    "old_file": "The old version of the CSV file",
+    "new_file": "The new version of the CSV file",
+    "output": "Write the changes to a CSV file (columns: change, key, " +
+              "old_line, new_line, column, old_value, new_value)",
+    "chunk_size": "Maximum number of rows sorted in memory (default: " +
+                  "100000)",
+    "temp_dir": "Directory for temporary files (default: the system's " +
+                "temporary directory)",
+    "quiet": "Only print the summary"
+}
+
+# Maximum number of rows sorted in memory
+DEFAULT_CHUNK_SIZE = 100000
+
+# Maximum number of sorted runs merged at once (each needs an open file)
+DEFAULT_FAN_IN = 64
+
+REPORT_HEADER = [u"change", u"key", u"old_line", u"new_line", u"column",
+                 u"old_value", u"new_value"]
+
+def get_row_key(row):
+    """
+    Return the key identifying a row across versions of a file.
+
+    Returns:
+        'doi:<normalised DOI>' or, for rows without a valid DOI,
+        'row:<institution>|<period>|<ISSN or journal title>|<URL>'.
+    """
+    doi = row.get("doi") or u""
+    if oat.is_wellformed_DOI(doi):
+        return u"doi:" + oat.normalize_doi(doi)
+    journal = oat.normalize_issn(row.get("issn") or u"NA")
+    if journal == u"NA":
+        journal = oat.normalize_journal_title(row.get("journal_full_title") or
+                                              u"")
+    parts = [(row.get("institution") or u"").strip(),
+             (row.get("period") or u"").strip(), journal,
+             (row.get("url") or u"NA").strip()]
+    return u"row:" + u"|".join(parts)
+
+class ExternalSorter(object):
+    """
+    Sort the rows of a CSV file by key with bounded memory.
+
+    Sorted runs of at most chunk_size rows are written to temporary CSV
+    files (using the toolkit's writer and reader) and merged. If there are
+    more than fan_in runs, they are merged in several passes.
+    """
+
+    def __init__(self, temp_dir, chunk_size=DEFAULT_CHUNK_SIZE,
+                 fan_in=DEFAULT_FAN_IN):
+        self.temp_dir = temp_dir
+        self.chunk_size = chunk_size
+        self.fan_in = fan_in
+
+    def _write_run(self, entries):
+        handle, path = tempfile.mkstemp(suffix=".csv", dir=self.temp_dir)
+        with os.fdopen(handle, "w") as run_file:
+            writer = oat.OpenAPCUnicodeWriter(run_file, None, False, False)
+            writer.write_rows([key, unicode(line_num)] + values
+                              for key, line_num, values in entries)
+        return path
+
+    def _read_run(self, path):
+        with open(path, "r") as run_file:
+            for row in oat.UnicodeReader(run_file):
+                yield row[0], int(row[1]), row[2:]
+        os.remove(path)
+
+    def _merge_runs(self, paths):
+        return heapq.merge(*[self._read_run(path) for path in paths])
+
+    def sort(self, csv_path):
+        """
+        Sort a CSV file by row key.
+
+        Returns:
+            A tuple (header, iterator of (key, line number, values) tuples
+            sorted by key and line number).
+        """
+        runs = []
+        chunk = []
+        with open(csv_path, "r") as csv_file:
+            reader = oat.UnicodeRecordReader(csv_file)
+            header = reader.fieldnames
+            # Line numbers are only exact for files without empty lines or
+            # multi-line values, they are used for reporting only.
+            for line_num, row in enumerate(reader, 2):
+                values = [value if value is not None else u""
+                          for value in row.values()]
+                chunk.append((get_row_key(row), line_num, values))
+                if len(chunk) >= self.chunk_size:
+                    chunk.sort()
+                    runs.append(self._write_run(chunk))
+                    chunk = []
+        chunk.sort()
+        if not runs:
+            return header, iter(chunk)
+        if chunk:
+            runs.append(self._write_run(chunk))
+        while len(runs) > self.fan_in:
+            runs = [self._write_run(self._merge_runs(runs[i:i + self.fan_in]))
+                    for i in range(0, len(runs), self.fan_in)]
+        return header, self._merge_runs(runs)
+
+def _group_by_key(entries):
+    for key, group in groupby(entries, lambda entry: entry[0]):
+        yield key, list(group)
+
+def _pair_identical(old_rows, new_rows):
+    """
+    Order two lists of entries with the same key so that identical rows
+    are paired first.
+
+    Returns:
+        A tuple (old entries, new entries), the unpaired entries follow the
+        paired ones in their original order.
+    """
+    unpaired = {}
+    for entry in new_rows:
+        unpaired.setdefault(tuple(entry[2]), []).append(entry)
+    old_paired, new_paired, old_rest = [], [], []
+    for entry in old_rows:
+        candidates = unpaired.get(tuple(entry[2]))
+        if candidates:
+            old_paired.append(entry)
+            new_paired.append(candidates.pop(0))
+        else:
+            old_rest.append(entry)
+    paired = set(entry[1] for entry in new_paired)
+    new_rest = [entry for entry in new_rows if entry[1] not in paired]
+    return old_paired + old_rest, new_paired + new_rest
+
+def compare_rows(old_header, old_values, new_header, new_values):
+    """
+    Compare two rows field by field (by column name).
+
+    Returns:
+        A list of (column, old value, new value) tuples. Values of columns
+        missing in a version are None.
+    """
+    old_row = dict(zip(old_header, old_values))
+    new_row = dict(zip(new_header, new_values))
+    columns = list(new_header) + [c for c in old_header if c not in new_row]
+    return [(column, old_row.get(column), new_row.get(column))
+            for column in columns
+            if old_row.get(column) != new_row.get(column)]
+
+def diff_sorted(old_header, old_entries, new_header, new_entries):
+    """
+    Compare two sorted entry streams (see ExternalSorter.sort).
+
+    Rows with the same key are paired (identical rows first, then in the
+    order of their line numbers), surplus rows are reported as added or
+    removed.
+
+    Returns:
+        A generator of (change, key, old entry, new entry, field changes)
+        tuples, change is 'added', 'removed' or 'changed'. Unchanged rows
+        are reported as 'unchanged' without field changes.
+    """
+    old_groups = _group_by_key(old_entries)
+    new_groups = _group_by_key(new_entries)
+    old_group = next(old_groups, None)
+    new_group = next(new_groups, None)
+    while old_group is not None or new_group is not None:
+        if new_group is None or (old_group is not None and
+                                 old_group[0] < new_group[0]):
+            for entry in old_group[1]:
+                yield "removed", old_group[0], entry, None, None
+            old_group = next(old_groups, None)
+        elif old_group is None or new_group[0] < old_group[0]:
+            for entry in new_group[1]:
+                yield "added", new_group[0], None, entry, None
+            new_group = next(new_groups, None)
+        else:
+            key, old_rows = old_group
+            new_rows = new_group[1]
+            if len(old_rows) > 1 or len(new_rows) > 1:
+                old_rows, new_rows = _pair_identical(old_rows, new_rows)
+            for old_entry, new_entry in zip(old_rows, new_rows):
+                changes = compare_rows(old_header, old_entry[2], new_header,
+                                       new_entry[2])
+                change = "changed" if changes else "unchanged"
+                yield change, key, old_entry, new_entry, changes
+            for entry in old_rows[len(new_rows):]:
+                yield "removed", key, entry, None, None
+            for entry in new_rows[len(old_rows):]:
+                yield "added", key, None, entry, None
+            old_group = next(old_groups, None)
+            new_group = next(new_groups, None)
+
+def diff_files(old_path, new_path, temp_dir, chunk_size=DEFAULT_CHUNK_SIZE,
+               fan_in=DEFAULT_FAN_IN):
+    """
+    Compare two CSV files by row key.
+
+    Returns:
+        A generator like diff_sorted.
+    """
+    sorter = ExternalSorter(temp_dir, chunk_size, fan_in)
+    old_header, old_entries = sorter.sort(old_path)
+    new_header, new_entries = sorter.sort(new_path)
+    return diff_sorted(old_header, old_entries, new_header, new_entries)
+
+def format_change(change, key, old_entry, new_entry, changes):
+    if change == "added":
+        return u"+ {} (new line {})".format(key, new_entry[1])
+    if change == "removed":
+        return u"- {} (old line {})".format(key, old_entry[1])
+    lines = [u"~ {} (old line {}, new line {})".format(key, old_entry[1],
+                                                      new_entry[1])]
+    for column, old_value, new_value in changes:
+        lines.append(u"    {}: '{}' -> '{}'".format(column, old_value,
+                                                    new_value))
+    return u"\n".join(lines)
+
+def get_report_rows(change, key, old_entry, new_entry, changes):
+    old_line = unicode(old_entry[1]) if old_entry else u""
+    new_line = unicode(new_entry[1]) if new_entry else u""
+    if change != "changed":
+        return [[change, key, old_line, new_line, u"", u"", u""]]
+    return [[change, key, old_line, new_line, column,
+             old_value if old_value is not None else u"",
+             new_value if new_value is not None else u""]
+            for column, old_value, new_value in changes]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("old_file", help=ARG_HELP_STRINGS["old_file"])
+    parser.add_argument("new_file", help=ARG_HELP_STRINGS["new_file"])
+    parser.add_argument("-o", "--output", help=ARG_HELP_STRINGS["output"])
+    parser.add_argument("-c", "--chunk-size", type=int,
+                        default=DEFAULT_CHUNK_SIZE,
+                        help=ARG_HELP_STRINGS["chunk_size"])
+    parser.add_argument("-t", "--temp-dir", help=ARG_HELP_STRINGS["temp_dir"])
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help=ARG_HELP_STRINGS["quiet"])
+    args = parser.parse_args()
+
+    for path in [args.old_file, args.new_file]:
+        if not os.path.isfile(path):
+            print "Error: '{}' not found.".format(path)
+            sys.exit()
+    temp_dir = tempfile.mkdtemp(prefix="csv_diff_", dir=args.temp_dir)
+    counts = {"added": 0, "removed": 0, "changed": 0, "unchanged": 0}
+    # The report is written while comparing, it can be as large as the files
+    out = None
+    if args.output:
+        out = open(args.output, "w")
+        writer = oat.OpenAPCUnicodeWriter(out, None, False, True)
+        writer.write_rows([list(REPORT_HEADER)])
+        writer.has_header = False
+    try:
+        for result in diff_files(args.old_file, args.new_file, temp_dir,
+                                 args.chunk_size):
+            change = result[0]
+            counts[change] += 1
+            if change == "unchanged":
+                continue
+            if not args.quiet:
+                print format_change(*result).encode("utf-8")
+            if out is not None:
+                writer.write_rows(get_report_rows(*result))
+    finally:
+        shutil.rmtree(temp_dir)
+        if out is not None:
+            out.close()
+    msg = "{added} rows added, {removed} removed, {changed} changed, " + \
+          "{unchanged} unchanged."
+    print msg.format(**counts)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+"""
+Refresh the doaj column of apc_de.csv after a DOAJ journal list update.
+
+This script compares two versions of the DOAJ journal list and only updates
+rows containing an ISSN which was added to or removed from DOAJ. The
+DOI/ISSN index (see apc_index.py) is used to find the affected rows, the
+file is only rewritten if the doaj value of any of them changes. All other
+rows are written back unchanged (in the OpenAPC quoting and with the line
+endings of the file).
+"""
+
+import argparse
+import csv
+import os
+import sys
+
+import openapc_toolkit as oat
+
+ARG_HELP_STRINGS = {
+    "old_list": "The previous version of the DOAJ journal list",
+    "new_list": "The current version of the DOAJ journal list",
+    "csv_file": "The OpenAPC CSV file to update (default: data/apc_de.csv)",
+    "index_file": "The DOI/ISSN index of the CSV file, it will be (re)built " +
+                  "if necessary (default: data/apc_de.idx)",
+    "output": "Where to write the updated CSV file (default: overwrite the " +
+              "input file)"
+}
+
+def get_row_issns(row):
+    issns = set()
+    for column in ["issn", "issn_print", "issn_electronic"]:
+        issn = oat.normalize_issn(row[column])
+        if issn and issn != u"NA":
+            issns.add(issn)
+    return issns
+
+def get_doaj_value(row, new_issns):
+    """
+    Return the doaj value of a row: TRUE if any of its ISSNs is in DOAJ.
+    """
+    return u"TRUE" if get_row_issns(row) & new_issns else u"FALSE"
+
+def refresh_doaj_column(csv_path, output, changed_issns, new_issns):
+    """
+    Update the doaj column of all rows with an ISSN in changed_issns.
+
+    Returns:
+        A list of (line number, row, old value, new value) tuples of the
+        updated rows.
+    """
+    updates = []
+    line_terminator = oat.get_line_terminator(csv_path) or u"\n"
+    tmp_output = output + ".tmp"
+    with open(csv_path, "r") as csv_file:
+        reader = oat.UnicodeReader(csv_file)
+        header = reader.next()
+        record_type = oat.make_record_type(header)
+        with open(tmp_output, "w") as out:
+            writer = oat.OpenAPCUnicodeWriter(out, oat.OPENAPC_QUOTEMASK,
+                                              True, True, line_terminator)
+            writer.write_rows([header])
+            writer.has_header = False
+            for line_num, row in enumerate(reader, 2):
+                record = record_type(row)
+                if len(row) == len(header) and \
+                        get_row_issns(record) & changed_issns:
+                    in_doaj = get_doaj_value(record, new_issns)
+                    if record["doaj"] != in_doaj:
+                        updates.append((line_num, record, record["doaj"],
+                                        in_doaj))
+                        record["doaj"] = in_doaj
+                writer.write_rows([row])
+    os.rename(tmp_output, output)
+    return updates
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("old_list", help=ARG_HELP_STRINGS["old_list"])
+    parser.add_argument("new_list", help=ARG_HELP_STRINGS["new_list"])
+    parser.add_argument("-c", "--csv_file", default="data/apc_de.csv",
+                        help=ARG_HELP_STRINGS["csv_file"])
+    parser.add_argument("-x", "--index_file", default="data/apc_de.idx",
+                        help=ARG_HELP_STRINGS["index_file"])
+    parser.add_argument("-o", "--output", help=ARG_HELP_STRINGS["output"])
+    args = parser.parse_args()
+
+    with open(args.csv_file, "rb") as csv_file:
+        header = csv.reader([csv_file.readline()]).next()
+    if "doaj" not in header:
+        print "Error: The CSV file has no 'doaj' column."
+        sys.exit()
+
+    old_issns = oat.load_doaj_issns(args.old_list)
+    new_issns = oat.load_doaj_issns(args.new_list)
+    added = new_issns - old_issns
+    removed = old_issns - new_issns
+    print "DOAJ list diff: {} ISSNs added, {} ISSNs removed".format(
+        len(added), len(removed))
+
+    index = None
+    if os.path.isfile(args.index_file):
+        index = oat.APCIndex(args.index_file, args.csv_file)
+        if not index.is_current():
+            index.close()
+            index = None
+    if index is None:
+        print "Building index " + args.index_file
+        oat.build_apc_index(args.csv_file, args.index_file)
+        index = oat.APCIndex(args.index_file, args.csv_file)
+
+    # Check the affected rows first, the file is only rewritten if needed
+    changed_issns = added | removed
+    needs_update = False
+    for issn in changed_issns:
+        for offset in index.lookup_issn(issn):
+            row = index.get_row(offset)
+            if row["doaj"] != get_doaj_value(row, new_issns):
+                needs_update = True
+    index.close()
+
+    if not needs_update:
+        print "No rows need to be updated."
+        return
+
+    output = args.output if args.output else args.csv_file
+    updates = refresh_doaj_column(args.csv_file, output, changed_issns,
+                                  new_issns)
+    for line_num, row, old_value, new_value in updates:
+        msg = u"Line {}: {} ({}): doaj {} -> {}".format(
+            line_num, row["doi"], row["journal_full_title"], old_value,
+            new_value)
+        print msg.encode("utf-8")
+    print "Updated the doaj value of {} rows in {}".format(len(updates), output)
+    if output == args.csv_file:
+        oat.build_apc_index(args.csv_file, args.index_file)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,356 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+"""
+Run a local enrichment service with warm caches.
+
+The service keeps lookup results from crossref, PubMed and DOAJ in memory
+(and optionally uses a local crossref store and an offline DOAJ journal
+list), so repeated lookups are answered without network requests. It offers
+a small HTTP/JSON API:
+
+    GET  /crossref?doi=<doi>     Same result as get_metadata_from_crossref
+    GET  /pubmed?doi=<doi>       Same result as get_metadata_from_pubmed
+    GET  /doaj?issn=<issn>       Same result as lookup_journal_in_doaj
+    POST /batch                  {"crossref": [...], "pubmed": [...],
+                                  "doaj": [...]}
+    POST /jobs                   {"csv_file": <path>, "options": [...]}
+                                 Runs apc_csv_processing.py for a CSV file
+    GET  /jobs/<id>              Status of an enrichment job
+    GET  /stats                  Cache sizes and hit counts
+
+openapc_toolkit.EnrichmentServiceClient implements the client side,
+apc_csv_processing.py, crossref_test.py and pubmed_test.py use it if they are
+given a service URL (--service). Enrichment jobs also route their lookups
+through the service.
+"""
+
+import argparse
+import BaseHTTPServer
+import json
+import os
+import SocketServer
+import subprocess
+import sys
+import threading
+import urlparse
+
+import openapc_toolkit as oat
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8420
+
+# Jobs run in the repository root, where the default paths of
+# apc_csv_processing.py (data/doi_ut.csv, data/apc_de.csv, ...) resolve
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Options of apc_csv_processing.py which clients cannot pass to jobs: The
+# service sets the output paths and routes the lookups through itself, and
+# jobs must not write files outside their job directory.
+JOB_RESERVED_OPTIONS = ["--output", "--review-file", "--service",
+                        "--doi-ut-file", "--journal-kb", "--profiles",
+                        "--save-profile", "--cache"]
+JOB_RESERVED_SHORT_OPTIONS = ["-o", "-r"]
+
+ARG_HELP_STRINGS = {
+    "host": "The address to listen on (default: {})".format(DEFAULT_HOST),
+    "port": "The port to listen on (default: {})".format(DEFAULT_PORT),
+    "crossref_store": "A local crossref store (see crossref_dump_import.py). " +
+                      "DOIs will be looked up there before querying crossref.",
+    "doaj_list": "A DOAJ journal list (data/doaj/doajJournalList.csv). If " +
+                 "given, DOAJ lookups are answered from this list instead " +
+                 "of the DOAJ API.",
+    "jobs_dir": "Directory for the output of enrichment jobs (default: " +
+                "enrichment_jobs)",
+    "bypass": "Bypass SSL certificate verification for DOAJ lookups."
+}
+
+def get_reserved_option(arg):
+    """
+    Return the reserved job option an argument would set or None.
+
+    Like argparse, long options may be abbreviated and given with '=value',
+    short options may have their value attached.
+    """
+    if arg.startswith("--"):
+        name = arg.split("=", 1)[0]
+        for option in JOB_RESERVED_OPTIONS:
+            if len(name) > 2 and option.startswith(name):
+                return option
+        return None
+    for option in JOB_RESERVED_SHORT_OPTIONS:
+        if arg.startswith(option):
+            return option
+    return None
+
+class LookupFailure(Exception):
+    """
+    An unexpected error of a lookup function, like an unparsable response.
+
+    Attributes:
+        result: A failed lookup result (a dict like the ones returned by
+                the lookup functions).
+    """
+
+    def __init__(self, result):
+        Exception.__init__(self, result["error_msg"])
+        self.result = result
+
+class EnrichmentService(object):
+    """
+    Lookup functions with in-memory result caches shared by all requests.
+
+    Only definite results are cached: Successful lookups and negative DOAJ
+    answers. Failed lookups (network errors, unknown DOIs) are retried on
+    the next request. Unexpected errors of the lookup functions raise a
+    LookupFailure.
+    """
+
+    def __init__(self, crossref_store=None, doaj_list=None, jobs_dir=None,
+                 bypass_cert_verification=False):
+        self.crossref_store_path = crossref_store
+        self.doaj_issns = None
+        if doaj_list:
+            self.doaj_issns = oat.load_doaj_issns(doaj_list)
+        self.jobs_dir = jobs_dir
+        self.bypass_cert_verification = bypass_cert_verification
+        self.url = None
+        self.caches = {"crossref": {}, "pubmed": {}, "doaj": {}}
+        self.stats = {"requests": 0, "hits": 0}
+        self.jobs = {}
+        self.lock = threading.Lock()
+        # SQLite connections can only be used by the thread creating them
+        self.local = threading.local()
+
+    def _get_crossref_store(self):
+        if self.crossref_store_path is None:
+            return None
+        if not hasattr(self.local, "crossref_store"):
+            self.local.crossref_store = oat.CrossrefStore(
+                self.crossref_store_path)
+        return self.local.crossref_store
+
+    def _cached(self, cache_name, key, lookup, success_key):
+        with self.lock:
+            self.stats["requests"] += 1
+            if key in self.caches[cache_name]:
+                self.stats["hits"] += 1
+                return self.caches[cache_name][key]
+        try:
+            result = lookup()
+        except IOError as ioe:
+            # Network errors are not handled by the lookup functions
+            msg = "Lookup failed: {}".format(getattr(ioe, "reason", ioe))
+            return {success_key: False, "error_msg": msg}
+        except Exception as e:
+            # Invalid responses (ET.ParseError, httplib.HTTPException, ...)
+            # must not kill the request handler
+            msg = "Lookup failed: {}".format(repr(e))
+            raise LookupFailure({success_key: False, "error_msg": msg})
+        if result[success_key]:
+            with self.lock:
+                self.caches[cache_name][key] = result
+        return result
+
+    def crossref(self, doi):
+        key = oat.normalize_doi(doi) if oat.is_wellformed_DOI(doi) else doi
+        lookup = lambda: oat.get_metadata_from_crossref(
+            doi, self._get_crossref_store())
+        return self._cached("crossref", key, lookup, "success")
+
+    def pubmed(self, doi):
+        key = oat.normalize_doi(doi) if oat.is_wellformed_DOI(doi) else doi
+        lookup = lambda: oat.get_metadata_from_pubmed(doi)
+        return self._cached("pubmed", key, lookup, "success")
+
+    def doaj(self, issn):
+        key = oat.normalize_issn(issn)
+        if self.doaj_issns is not None:
+            # The journal list holds no titles
+            in_doaj = key in self.doaj_issns
+            data = {"in_doaj": in_doaj}
+            if in_doaj:
+                data["title"] = ""
+            return {"data_received": True, "data": data}
+        lookup = lambda: oat.lookup_journal_in_doaj(
+            issn, self.bypass_cert_verification)
+        return self._cached("doaj", key, lookup, "data_received")
+
+    def batch(self, request):
+        result = {}
+        for name, lookup in [("crossref", self.crossref),
+                             ("pubmed", self.pubmed), ("doaj", self.doaj)]:
+            result[name] = {}
+            for key in request.get(name, []):
+                try:
+                    result[name][key] = lookup(key)
+                except LookupFailure as failure:
+                    result[name][key] = failure.result
+        return result
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            for name, cache in self.caches.iteritems():
+                stats[name + "_cached"] = len(cache)
+            stats["jobs"] = len(self.jobs)
+        return stats
+
+    def submit_job(self, csv_file, options):
+        """
+        Start apc_csv_processing.py for a CSV file in a background thread.
+
+        Every job runs unattended (-y) in the repository root, so the
+        default data files are found. Its output (out.csv), the review file
+        (review.csv) and the console output (log.txt) are written to its
+        own directory below jobs_dir. All lookups of the job are routed
+        through this service. Options in JOB_RESERVED_OPTIONS raise a
+        ValueError.
+        """
+        if not os.path.isfile(csv_file):
+            raise ValueError("CSV file '{}' not found".format(csv_file))
+        options = [str(opt) for opt in options]
+        for opt in options:
+            reserved = get_reserved_option(opt)
+            if reserved is not None:
+                msg = "Option '{}' ({}) cannot be set for jobs"
+                raise ValueError(msg.format(opt, reserved))
+        with self.lock:
+            job_id = len(self.jobs) + 1
+            job_dir = os.path.abspath(os.path.join(self.jobs_dir, str(job_id)))
+            job = {"id": job_id, "csv_file": os.path.abspath(csv_file),
+                   "status": "running", "returncode": None,
+                   "output": os.path.join(job_dir, "out.csv"),
+                   "review_file": os.path.join(job_dir, "review.csv"),
+                   "log": os.path.join(job_dir, "log.txt")}
+            self.jobs[job_id] = job
+        if not os.path.isdir(job_dir):
+            os.makedirs(job_dir)
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "apc_csv_processing.py")
+        command = ([sys.executable, script, job["csv_file"], "-y",
+                    "--service", self.url, "-o", job["output"],
+                    "-r", job["review_file"]] + options)
+        thread = threading.Thread(target=self._run_job, args=(job, command))
+        thread.daemon = True
+        thread.start()
+        return dict(job)
+
+    def _run_job(self, job, command):
+        with open(job["log"], "w") as log:
+            returncode = subprocess.call(command, cwd=REPO_DIR, stdout=log,
+                                         stderr=subprocess.STDOUT)
+        with self.lock:
+            job["returncode"] = returncode
+            job["status"] = "finished" if returncode == 0 else "failed"
+
+    def get_job(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+class EnrichmentRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def _send_json(self, data, code=200):
+        content = json.dumps(data)
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _send_error(self, code, msg):
+        self._send_json({"error_msg": msg}, code)
+
+    def _get_param(self, query, name):
+        values = urlparse.parse_qs(query).get(name)
+        if not values:
+            self._send_error(400, "Missing parameter '{}'".format(name))
+            return None
+        return values[0].decode("utf-8")
+
+    def do_GET(self):
+        service = self.server.service
+        url = urlparse.urlparse(self.path)
+        if url.path in ["/crossref", "/pubmed", "/doaj"]:
+            param = "issn" if url.path == "/doaj" else "doi"
+            value = self._get_param(url.query, param)
+            if value is not None:
+                lookup = getattr(service, url.path[1:])
+                try:
+                    self._send_json(lookup(value))
+                except LookupFailure as failure:
+                    self._send_json(failure.result, 500)
+        elif url.path == "/stats":
+            self._send_json(service.get_stats())
+        elif url.path.startswith("/jobs/"):
+            try:
+                job = service.get_job(int(url.path[len("/jobs/"):]))
+            except ValueError:
+                job = None
+            if job is None:
+                self._send_error(404, "Unknown job")
+            else:
+                self._send_json(job)
+        else:
+            self._send_error(404, "Unknown resource " + url.path)
+
+    def do_POST(self):
+        service = self.server.service
+        length = int(self.headers.getheader("Content-Length", 0))
+        try:
+            request = json.loads(self.rfile.read(length))
+        except ValueError as ve:
+            self._send_error(400, "Invalid JSON: " + ve.message)
+            return
+        if self.path == "/batch":
+            self._send_json(service.batch(request))
+        elif self.path == "/jobs":
+            try:
+                job = service.submit_job(request["csv_file"],
+                                         request.get("options", []))
+            except (KeyError, ValueError) as e:
+                self._send_error(400, "Invalid job request: " + str(e))
+                return
+            self._send_json(job, 202)
+        else:
+            self._send_error(404, "Unknown resource " + self.path)
+
+class EnrichmentServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        BaseHTTPServer.HTTPServer.__init__(self, address,
+                                           EnrichmentRequestHandler)
+        self.service = service
+        host, port = self.server_address[:2]
+        service.url = "http://{}:{}".format(host, port)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-H", "--host", default=DEFAULT_HOST,
+                        help=ARG_HELP_STRINGS["host"])
+    parser.add_argument("-p", "--port", type=int, default=DEFAULT_PORT,
+                        help=ARG_HELP_STRINGS["port"])
+    parser.add_argument("--crossref-store",
+                        help=ARG_HELP_STRINGS["crossref_store"])
+    parser.add_argument("--doaj-list", help=ARG_HELP_STRINGS["doaj_list"])
+    parser.add_argument("-j", "--jobs-dir", default="enrichment_jobs",
+                        help=ARG_HELP_STRINGS["jobs_dir"])
+    parser.add_argument("-b", "--bypass-cert-verification", action="store_true",
+                        help=ARG_HELP_STRINGS["bypass"])
+    args = parser.parse_args()
+
+    service = EnrichmentService(args.crossref_store, args.doaj_list,
+                                args.jobs_dir, args.bypass_cert_verification)
+    server = EnrichmentServer((args.host, args.port), service)
+    print "Enrichment service listening on " + service.url
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print "Shutting down."
+    server.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+"""
+Build or query the journal knowledge base derived from apc_de.csv.
+
+The knowledge base (see openapc_toolkit.JournalKnowledgeBase) holds the
+canonical journal-level metadata of every journal in apc_de.csv, keyed by
+all of its ISSNs. apc_csv_processing uses it to resolve journal metadata
+locally; it rebuilds the knowledge base automatically when apc_de.csv has
+changed. The 'match' operation looks up journals by (possibly misspelled or
+abbreviated) titles, using the same title index apc_csv_processing uses for
+rows without a DOI.
+"""
+
+import argparse
+import os
+import sys
+
+import openapc_toolkit as oat
+
+def build(args):
+    kb = oat.build_journal_kb(args.csv_file)
+    kb.save(args.kb_file)
+    print "Wrote {} journals ({} ISSNs) to {}".format(len(kb), len(kb.issns),
+                                                     args.kb_file)
+
+def lookup(args):
+    kb = oat.load_journal_kb(args.kb_file, args.csv_file)
+    if kb is None:
+        print "Error: Neither {} nor {} found.".format(args.kb_file,
+                                                       args.csv_file)
+        sys.exit()
+    found = False
+    for issn in args.issns:
+        journal = kb.lookup(issn)
+        if journal is None:
+            print "{}: not found".format(issn)
+            continue
+        found = True
+        print "{}:".format(issn)
+        for field in oat.JOURNAL_KB_FIELDS:
+            print u"    {}: {}".format(field, journal[field]).encode("utf-8")
+    if not found:
+        sys.exit(1)
+
+def match(args):
+    kb = oat.load_journal_kb(args.kb_file, args.csv_file)
+    doaj_list = args.doaj_list if os.path.isfile(args.doaj_list) else None
+    index = oat.build_journal_title_index(kb, doaj_list)
+    found = False
+    for title in args.titles:
+        matches = index.query(title.decode("utf-8"), args.min_score)
+        if not matches:
+            print "{}: not found".format(title)
+            continue
+        found = True
+        print "{}:".format(title)
+        for journal in matches:
+            msg = u"    {} ({}, {}): {}".format(journal["journal_full_title"],
+                                               journal["publisher"],
+                                               u", ".join(journal["issns"]),
+                                               journal["score"])
+            print msg.encode("utf-8")
+    if not found:
+        sys.exit(1)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--csv_file", default="data/apc_de.csv",
+                        help="The OpenAPC CSV file (default: data/apc_de.csv)")
+    parser.add_argument("-k", "--kb_file", default="data/journal_kb.json",
+                        help="The knowledge base file (default: " +
+                        "data/journal_kb.json)")
+    subparsers = parser.add_subparsers(help="The operation to perform")
+
+    build_parser = subparsers.add_parser("build", help="Build the " +
+                                         "knowledge base")
+    build_parser.set_defaults(func=build)
+
+    lookup_parser = subparsers.add_parser("lookup", help="Look up journals " +
+                                          "by ISSN")
+    lookup_parser.add_argument("issns", nargs="+", help="ISSNs")
+    lookup_parser.set_defaults(func=lookup)
+
+    match_parser = subparsers.add_parser("match", help="Look up journals " +
+                                         "by title")
+    match_parser.add_argument("titles", nargs="+", help="Journal titles")
+    match_parser.add_argument("-d", "--doaj-list",
+                              default="data/doaj/doajJournalList.csv",
+                              help="A DOAJ journal list with additional " +
+                              "titles (default: " +
+                              "data/doaj/doajJournalList.csv)")
+    match_parser.add_argument("-s", "--min-score", type=float, default=0.6,
+                              help="Minimum similarity (default: 0.6)")
+    match_parser.set_defaults(func=match)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+"""
+Find probable duplicates among rows without a DOI.
+
+The DOI duplicate check (test_apc_csv.py) cannot detect articles without a
+DOI which were reported twice, for example by two institutions or in a
+re-delivery. Comparing all rows pairwise would be quadratic, so candidate
+pairs are generated by blocking: Rows are grouped by keys two duplicates
+will most likely share (normalized URL, pmid, pmcid, ut, ISSN and period,
+journal title shingles and period), and only rows in a common block are
+compared. Blocks larger than MAX_BLOCK_SIZE are skipped, which keeps the
+number of comparisons roughly linear in the number of rows.
+
+Candidate pairs are scored by their matching fields (see score_pair) and
+reported if they reach a threshold. Only pairs sharing an article level
+identifier (URL, pmid, pmcid or ut) can be reported: Journal, period and
+price are shared by many different articles (all 2013 articles of a
+journal with a flat fee, for example).
+"""
+
+import argparse
+from collections import OrderedDict
+import re
+import sys
+
+import openapc_toolkit as oat
+
+# Blocks with more rows are not used to generate candidate pairs. They are
+# formed by very frequent keys (like a journal title shingle occurring in
+# many titles) and the pairs they would generate are covered by more
+# specific blocks.
+MAX_BLOCK_SIZE = 50
+
+# Pairs scoring at least this value are reported as probable duplicates
+DEFAULT_THRESHOLD = 0.5
+
+# Evidence and its contribution to the score of a pair
+SCORE_WEIGHTS = OrderedDict([
+    ("url", 0.5),            # Identical (normalized) URL
+    ("identifier", 0.5),     # Identical pmid, pmcid or ut
+    ("journal", 0.2),        # Common ISSN or similar journal title
+    ("period", 0.15),        # Same period
+    ("euro", 0.15),          # Amounts differ by less than EURO_TOLERANCE
+    ("different_url", -0.3)  # Both rows have URLs, but they differ
+])
+
+# At least one of these is required for a pair to score above 0
+ARTICLE_EVIDENCE = ["url", "identifier"]
+
+# Relative difference of two amounts still considered the same APC (allows
+# for currency conversion and rounding effects)
+EURO_TOLERANCE = 0.01
+
+# Minimum trigram similarity of two journal titles (if no ISSN is shared)
+TITLE_SIMILARITY = 0.8
+
+def normalize_url(url):
+    """
+    Normalize a URL for comparison: Scheme, 'www.', fragments, trailing
+    slashes and case are ignored.
+    """
+    url = url.strip().lower()
+    url = re.sub(r"^[a-z]+://", "", url)
+    if url.startswith("www."):
+        url = url[4:]
+    url = url.split("#")[0]
+    return url.rstrip("/")
+
+def _has_value(value):
+    return len(value) > 0 and value != "NA"
+
+def _get_issns(row):
+    return set(oat.normalize_issn(row[column])
+               for column in ["issn", "issn_print", "issn_electronic"]
+               if _has_value(row[column]))
+
+def _get_title_shingles(title):
+    words = oat.normalize_journal_title(title).split()
+    if len(words) < 2:
+        return set(words)
+    return set(u" ".join(words[i:i + 2]) for i in range(len(words) - 1))
+
+def get_blocking_keys(row):
+    """
+    Return the blocking keys of a row.
+    """
+    keys = set()
+    if _has_value(row["url"]):
+        keys.add(u"url:" + normalize_url(row["url"]))
+    # Identifiers are article level evidence like the URL, so rows sharing
+    # one are compared even if their journal blocks are oversized
+    for column in ["pmid", "pmcid", "ut"]:
+        if _has_value(row[column]):
+            keys.add(u"{}:{}".format(column, row[column]))
+    for issn in _get_issns(row):
+        keys.add(u"issn:{}:{}".format(issn, row["period"]))
+    for shingle in _get_title_shingles(row["journal_full_title"]):
+        keys.add(u"title:{}:{}".format(shingle, row["period"]))
+    return keys
+
+def get_candidate_pairs(rows):
+    """
+    Generate the candidate pairs of a list of row dicts by blocking.
+
+    Returns:
+        A tuple (set of index pairs (i, j) with i < j, number of skipped
+        oversized blocks).
+    """
+    blocks = {}
+    for index, row in enumerate(rows):
+        for key in get_blocking_keys(row):
+            blocks.setdefault(key, []).append(index)
+    pairs = set()
+    skipped = 0
+    for indices in blocks.itervalues():
+        if len(indices) > MAX_BLOCK_SIZE:
+            skipped += 1
+            continue
+        for pos, first in enumerate(indices):
+            for second in indices[pos + 1:]:
+                pairs.add((first, second))
+    return pairs, skipped
+
+def _same_euro(first, second):
+    try:
+        first, second = float(first), float(second)
+    except ValueError:
+        return False
+    return abs(first - second) <= EURO_TOLERANCE * max(abs(first), abs(second))
+
+def score_pair(first, second):
+    """
+    Score the probability of two rows describing the same article.
+
+    Returns:
+        A tuple (score, list of matching evidence, see SCORE_WEIGHTS). The
+        score is 0 if the evidence contains nothing from ARTICLE_EVIDENCE.
+    """
+    evidence = []
+    if _has_value(first["url"]) and _has_value(second["url"]):
+        if normalize_url(first["url"]) == normalize_url(second["url"]):
+            evidence.append("url")
+        else:
+            evidence.append("different_url")
+    if any(_has_value(first[column]) and first[column] == second[column]
+           for column in ["pmid", "pmcid", "ut"]):
+        evidence.append("identifier")
+    if _get_issns(first) & _get_issns(second):
+        evidence.append("journal")
+    else:
+        title = oat.normalize_journal_title(first["journal_full_title"])
+        other = oat.normalize_journal_title(second["journal_full_title"])
+        if title and other:
+            first_trigrams = oat.get_trigrams(title)
+            second_trigrams = oat.get_trigrams(other)
+            similarity = (2.0 * len(first_trigrams & second_trigrams) /
+                          (len(first_trigrams) + len(second_trigrams)))
+            if similarity >= TITLE_SIMILARITY:
+                evidence.append("journal")
+    if first["period"] == second["period"]:
+        evidence.append("period")
+    if _same_euro(first["euro"], second["euro"]):
+        evidence.append("euro")
+    if not any(name in evidence for name in ARTICLE_EVIDENCE):
+        return 0.0, evidence
+    score = sum(SCORE_WEIGHTS[name] for name in evidence)
+    return round(max(min(score, 1.0), 0.0), 2), evidence
+
+def find_near_duplicates(rows, threshold=DEFAULT_THRESHOLD):
+    """
+    Find probable duplicates among the rows without a DOI.
+
+    Returns:
+        A tuple (list of (score, i, j, evidence) tuples for all pairs
+        reaching the threshold, best first, number of compared pairs,
+        number of skipped blocks). i and j are indices into rows.
+    """
+    candidates = [index for index, row in enumerate(rows)
+                  if not _has_value(row["doi"])]
+    pairs, skipped = get_candidate_pairs([rows[i] for i in candidates])
+    duplicates = []
+    for first, second in pairs:
+        i, j = candidates[first], candidates[second]
+        score, evidence = score_pair(rows[i], rows[j])
+        if score >= threshold:
+            duplicates.append((score, i, j, evidence))
+    duplicates.sort(key=lambda duplicate: (-duplicate[0],) + duplicate[1:3])
+    return duplicates, len(pairs), skipped
+
+def load_rows(csv_paths):
+    """
+    Load the rows of several CSV files.
+
+    Returns:
+        A tuple (list of row dicts, list of their 'file:line' locations).
+    """
+    rows = []
+    locations = []
+    for csv_path in csv_paths:
+        with open(csv_path, "r") as csv_file:
+            # Line 1 is the header
+            for line, row in enumerate(oat.UnicodeRecordReader(csv_file), 2):
+                rows.append(row)
+                locations.append(u"{}:{}".format(csv_path, line))
+    return rows, locations
+
+def format_row(row):
+    return u"{}, {}, {} EUR, {}, {}".format(row["institution"], row["period"],
+                                           row["euro"],
+                                           row["journal_full_title"],
+                                           row["url"])
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("csv_files", nargs="*", default=["data/apc_de.csv"],
+                        help="OpenAPC CSV files, compared with each other " +
+                        "and among themselves (default: data/apc_de.csv)")
+    parser.add_argument("-t", "--threshold", type=float,
+                        default=DEFAULT_THRESHOLD,
+                        help="Minimum score (0-1) of a pair to be reported " +
+                        "(default: {})".format(DEFAULT_THRESHOLD))
+    args = parser.parse_args()
+
+    rows, locations = load_rows(args.csv_files)
+    duplicates, compared, skipped = find_near_duplicates(rows, args.threshold)
+    for score, i, j, evidence in duplicates:
+        msg = u"Probable duplicate (score {}, {}):\n    {}: {}\n    {}: {}"
+        msg = msg.format(score, u", ".join(evidence), locations[i],
+                         format_row(rows[i]), locations[j],
+                         format_row(rows[j]))
+        oat.print_y(msg.encode("utf-8"))
+    msg = "{} probable duplicates found ({} candidate pairs compared"
+    if skipped:
+        msg += ", {} oversized blocks skipped".format(skipped)
+    print (msg + ").").format(len(duplicates), compared)
+    if duplicates:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,35 @@
 #!/usr/bin/python
 # -*- coding: UTF-8 -*-
 
+import array
+import bz2
 import csv
 import codecs
+from collections import namedtuple, OrderedDict
+from cStringIO import StringIO
+import gzip
+import hashlib
+import httplib
+from itertools import izip
 import json
+import locale
+import math
+import mmap
+from multiprocessing.pool import ThreadPool
+import os
 import re
+import socket
+import sqlite3
+import struct
+import sys
+import unicodedata
+import urllib
 import urllib2
+from xml.sax.saxutils import escape as xml_escape
+import xml.etree.cElementTree as cET
 import xml.etree.ElementTree as ET
+import zipfile
+import zlib
 
 try:
     import chardet
@@ -17,6 +40,105 @@ except ImportError:
 # regex for detecing DOIs
 DOI_RE = re.compile("^(((https?://)?dx.doi.org/)|(doi:))?(?P<doi>10\.[0-9]+(\.[0-9]+)*\/\S+)")
 
+# ISSNs, also with a missing hyphen or another kind of dash
+ISSN_RE = re.compile(u"^(?P<first>[0-9]{4})[-\u2010-\u2015 ]?(?P<second>[0-9]{3}[0-9X])$")
+
+# Strings which might represent a number in any common format
+NUMBER_CHARS_RE = re.compile("^-?[0-9][0-9., ]*$")
+
+# Known formats for the 'period' column. The day/month order does not matter
+# as only the year is extracted.
+PERIOD_FORMATS = OrderedDict([
+    ("YYYY", re.compile("^(?P<year>[0-9]{4})$")),
+    ("YYYY-MM-DD", re.compile("^(?P<year>[0-9]{4})-[0-9]{1,2}-[0-9]{1,2}$")),
+    ("DD.MM.YYYY", re.compile("^[0-9]{1,2}\.[0-9]{1,2}\.(?P<year>[0-9]{4})$")),
+    ("DD/MM/YYYY", re.compile("^[0-9]{1,2}/[0-9]{1,2}/(?P<year>[0-9]{4})$")),
+    ("MM/YYYY", re.compile("^[0-9]{1,2}/(?P<year>[0-9]{4})$"))
+])
+
+# Definition of an OpenAPC data set column:
+#   name: The column name (also used as column type in apc_csv_processing)
+#   value_type: 'string', 'year', 'number', 'doi', 'boolean' or 'issn'
+#   quoted: If values are quoted in OpenAPC CSV files ('NA', 'TRUE' and
+#           'FALSE' are never quoted)
+#   requirement: 'mandatory', 'optional' or 'non-required' in files to
+#                be enriched (see apc_csv_processing.CSVColumn)
+#   aliases: Lowercase header names identifying the column in input files
+OpenAPCColumn = namedtuple("OpenAPCColumn", ["name", "value_type", "quoted",
+                                             "requirement", "aliases"])
+
+# The OpenAPC schema: All columns of apc_de.csv, in order
+OPENAPC_SCHEMA = [
+    OpenAPCColumn("institution", "string", True, "mandatory", ["institution"]),
+    OpenAPCColumn("period", "year", False, "mandatory", ["period", "jahr"]),
+    OpenAPCColumn("euro", "number", False, "mandatory",
+                  ["apc", "kosten", "cost", "euro", "eur"]),
+    OpenAPCColumn("doi", "doi", True, "mandatory", ["doi"]),
+    OpenAPCColumn("is_hybrid", "boolean", True, "mandatory", ["is_hybrid"]),
+    OpenAPCColumn("publisher", "string", True, "optional", ["publisher"]),
+    OpenAPCColumn("journal_full_title", "string", True, "optional",
+                  ["journal_full_title", "journal", "journal title"]),
+    OpenAPCColumn("issn", "issn", True, "optional", ["issn"]),
+    OpenAPCColumn("issn_print", "issn", True, "non-required", ["issn_print"]),
+    OpenAPCColumn("issn_electronic", "issn", True, "non-required",
+                  ["issn_electronic"]),
+    OpenAPCColumn("license_ref", "string", True, "non-required",
+                  ["license_ref"]),
+    OpenAPCColumn("indexed_in_crossref", "boolean", True, "non-required",
+                  ["indexed_in_crossref"]),
+    OpenAPCColumn("pmid", "string", True, "non-required", ["pmid"]),
+    OpenAPCColumn("pmcid", "string", True, "non-required", ["pmcid"]),
+    OpenAPCColumn("ut", "string", True, "non-required", ["ut"]),
+    OpenAPCColumn("url", "string", True, "optional", ["url"]),
+    OpenAPCColumn("doaj", "boolean", True, "non-required", ["doaj"])
+]
+
+OPENAPC_COLUMNS = [column.name for column in OPENAPC_SCHEMA]
+
+# Quotemask for OpenAPCUnicodeWriter when writing OpenAPC CSV files
+OPENAPC_QUOTEMASK = [column.quoted for column in OPENAPC_SCHEMA]
+
+# Metadata fields relevant to OpenAPC which can be obtained from crossref
+CROSSREF_FIELDS = ["publisher", "journal_full_title", "issn", "issn_print",
+                   "issn_electronic", "license_ref"]
+
+# Journal-level fields kept in the JournalKnowledgeBase
+JOURNAL_KB_FIELDS = ["journal_full_title", "publisher", "issn", "issn_print",
+                     "issn_electronic", "doaj"]
+
+# Format version of journal knowledge base files. Version 3 stores the ISSNs
+# normalized by normalize_issn, with compound values ('2090-004X;2090-0058')
+# split into their ISSNs.
+JOURNAL_KB_VERSION = 3
+
+# Binary structures of the APCIndex file format
+APC_INDEX_MAGIC = "OAPCIDX1"
+APC_INDEX_HEADER = struct.Struct("<8sIIQd")
+APC_INDEX_BUCKET = struct.Struct("<I")
+APC_INDEX_ENTRY = struct.Struct("<QQ")
+
+# The Article Match Retrieval service of Web of Science
+WOS_AMR_URL = "https://ws.isiknowledge.com/cps/xrpc"
+WOS_AMR_BATCH_SIZE = 50
+WOS_AMR_REQUEST = (u'<?xml version="1.0" encoding="UTF-8" ?>' +
+                   u'<request xmlns="http://www.isinet.com/xrpc41">' +
+                   u'<fn name="LinksAMR.retrieve"><list><map></map><map>' +
+                   u'<list name="WOS"><val>ut</val><val>doi</val></list>' +
+                   u'</map><map>{cites}</map></list></fn></request>')
+WOS_AMR_CITE = u'<map name="cite_{num}"><val name="doi">{doi}</val></map>'
+
+# Version of the columnar export format, exports in other versions are rebuilt
+COLUMNAR_FORMAT_VERSION = 2
+
+# Stored for NA values in int columns of columnar exports
+COLUMNAR_INT_NA = -2 ** 31
+
+# Types of numerical columns in columnar exports (see export_columnar)
+COLUMNAR_TYPES = {
+    "period": "int",
+    "euro": "float"
+}
+
 # These classes were adopted from
 # https://docs.python.org/2/library/csv.html#examples
 class UTF8Recoder(object):
@@ -67,6 +189,419 @@ class UnicodeDictReader(object):
     def __iter__(self):
         return self
         
+class Record(object):
+    """
+    Base class for compact CSV row records (see make_record_type).
+
+    A record holds the values of a row in a list and maps column names to
+    positions through its class, so unlike a dict per row, no per-row key
+    storage or hash table is needed. Records support the read and write
+    access of dicts by column name (row["doi"], get, keys, values,
+    iteritems) and iterate over their column names like dicts.
+    """
+
+    __slots__ = ("_values",)
+    fields = ()
+    _positions = {}
+
+    def __init__(self, values):
+        self._values = values
+
+    def __getitem__(self, name):
+        return self._values[self._positions[name]]
+
+    def __setitem__(self, name, value):
+        self._values[self._positions[name]] = value
+
+    def __contains__(self, name):
+        return name in self._positions
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            return self.fields == other.fields and self._values == other._values
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, dict(self.iteritems()))
+
+    def get(self, name, default=None):
+        position = self._positions.get(name)
+        if position is None or position >= len(self._values):
+            return default
+        return self._values[position]
+
+    def keys(self):
+        return list(self.fields)
+
+    def values(self):
+        return list(self._values)
+
+    def iteritems(self):
+        return izip(self.fields, self._values)
+
+    def items(self):
+        return list(self.iteritems())
+
+_record_types = {}
+
+def make_record_type(fields):
+    """
+    Return the Record class for a sequence of column names.
+
+    Classes are created once per distinct column sequence and shared.
+    """
+    fields = tuple(fields)
+    if fields not in _record_types:
+        positions = {name: position for position, name in enumerate(fields)}
+        _record_types[fields] = type("Record", (Record,), {
+            "__slots__": (), "fields": fields, "_positions": positions})
+    return _record_types[fields]
+
+# The record type of rows in the OpenAPC schema
+OpenAPCRecord = make_record_type(OPENAPC_COLUMNS)
+
+class UnicodeRecordReader(object):
+    """
+    A CSV reader which will iterate over the lines in the CSV file "f" as
+    records (see make_record_type) keyed by the header of the file.
+
+    Like csv.DictReader, short rows are padded with None, surplus values are
+    kept (and counted by len()).
+    """
+
+    def __init__(self, f, dialect=csv.excel, encoding="utf-8", **kwds):
+        self.reader = UnicodeReader(f, dialect=dialect, encoding=encoding,
+                                    **kwds)
+        self.fieldnames = self.reader.next()
+        self.record_type = make_record_type(self.fieldnames)
+
+    def next(self):
+        row = self.reader.next()
+        while not row:
+            # Skip empty lines like csv.DictReader
+            row = self.reader.next()
+        if len(row) < len(self.fieldnames):
+            row += [None] * (len(self.fieldnames) - len(row))
+        return self.record_type(row)
+
+    def __iter__(self):
+        return self
+
+# Compressed inputs and the functions opening them (see open_input_file)
+COMPRESSED_INPUT_TYPES = {
+    ".gz": gzip.open,
+    ".bz2": bz2.BZ2File
+}
+
+TSV_SUFFIXES = (".tsv", ".tab")
+
+XLSX_NAMESPACES = {
+    "main": "http://schemas.openxmlformats.org/spreadsheetml/2006/main",
+    "rel": "http://schemas.openxmlformats.org/officeDocument/2006/relationships",
+    "pkg": "http://schemas.openxmlformats.org/package/2006/relationships"
+}
+
+XLSX_CELL_REF_RE = re.compile(r"^(?P<column>[A-Z]+)")
+
+class StreamingInput(object):
+    """
+    A read-only file object streaming the lines of a converted or
+    decompressed input file.
+
+    The lines are produced by a generator, so only the current line is held
+    in memory. Like the file objects of plain CSV files, instances can be
+    rewound with seek(0) (which restarts the generator), other positions are
+    not supported.
+
+    Args:
+        open_lines: A function returning a new iterator over the lines of
+                    the file (as byte strings).
+    """
+
+    def __init__(self, open_lines):
+        self.open_lines = open_lines
+        self.lines = None
+        self.seek(0)
+
+    def seek(self, offset, whence=0):
+        if offset != 0 or whence != 0:
+            raise IOError("StreamingInput can only be rewound (seek(0))")
+        self.close()
+        self.lines = self.open_lines()
+        self.buffer = ""
+
+    def _fill(self, size=-1):
+        # Read lines into the buffer until it contains a complete line (or
+        # at least size bytes)
+        while "\n" not in self.buffer and (size < 0 or len(self.buffer) < size):
+            line = next(self.lines, None)
+            if line is None:
+                return
+            self.buffer += line
+
+    def read(self, size=-1):
+        if size < 0:
+            content = self.buffer + "".join(self.lines)
+            self.buffer = ""
+            return content
+        while len(self.buffer) < size:
+            line = next(self.lines, None)
+            if line is None:
+                break
+            self.buffer += line
+        content, self.buffer = self.buffer[:size], self.buffer[size:]
+        return content
+
+    def readline(self, size=-1):
+        self._fill(size)
+        end = self.buffer.find("\n") + 1 or len(self.buffer)
+        if size >= 0:
+            end = min(end, size)
+        line, self.buffer = self.buffer[:end], self.buffer[end:]
+        return line
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def close(self):
+        # Closing the generator runs its cleanup (closes archives)
+        if self.lines is not None and hasattr(self.lines, "close"):
+            self.lines.close()
+
+def _select_zip_member(zip_file):
+    """
+    Return the name of the CSV or TSV file in a ZIP archive.
+
+    Raises:
+        IOError: If the archive does not contain exactly one such file (or
+                 exactly one file at all).
+    """
+    names = [name for name in zip_file.namelist() if not name.endswith("/")
+             and not name.startswith("__MACOSX/")
+             and not os.path.basename(name).startswith(".")]
+    tabular = [name for name in names
+               if name.lower().endswith((".csv", ".txt") + TSV_SUFFIXES)]
+    if len(tabular) == 1:
+        return tabular[0]
+    if len(names) == 1:
+        return names[0]
+    raise IOError("the ZIP archive has to contain exactly one CSV file " +
+                  "(found: {})".format(", ".join(tabular or names)))
+
+def _open_zip_archive(file_path):
+    try:
+        return zipfile.ZipFile(file_path, "r")
+    except zipfile.BadZipfile:
+        raise IOError("'{}' is no valid ZIP archive".format(file_path))
+
+def _iter_zip_member(file_path):
+    zip_file = _open_zip_archive(file_path)
+    try:
+        member = zip_file.open(_select_zip_member(zip_file))
+        for line in member:
+            yield line
+    finally:
+        zip_file.close()
+
+def _get_first_sheet_path(zip_file):
+    """
+    Return the archive path of the first worksheet of an XLSX workbook.
+    """
+    try:
+        workbook = ET.fromstring(zip_file.read("xl/workbook.xml"))
+        rels = ET.fromstring(zip_file.read("xl/_rels/workbook.xml.rels"))
+    except KeyError:
+        return "xl/worksheets/sheet1.xml"
+    sheet = workbook.find("main:sheets/main:sheet", XLSX_NAMESPACES)
+    rel_id = sheet.get("{" + XLSX_NAMESPACES["rel"] + "}id")
+    for rel in rels.findall("pkg:Relationship", XLSX_NAMESPACES):
+        if rel.get("Id") == rel_id:
+            target = rel.get("Target")
+            if target.startswith("/"):
+                return target[1:]
+            return "xl/" + target
+    return "xl/worksheets/sheet1.xml"
+
+def _get_cell_text(elem):
+    # Concatenates rich text runs, but not phonetic hints (rPh)
+    tag = "{" + XLSX_NAMESPACES["main"] + "}"
+    texts = [t.text or u"" for t in elem.findall(tag + "t")]
+    texts += [t.text or u"" for t in elem.findall(tag + "r/" + tag + "t")]
+    return u"".join(texts)
+
+def _load_shared_strings(zip_file):
+    """
+    Load the shared string table of an XLSX workbook (cell values are stored
+    as indices into this table).
+    """
+    strings = []
+    if "xl/sharedStrings.xml" not in zip_file.namelist():
+        return strings
+    si_tag = "{" + XLSX_NAMESPACES["main"] + "}si"
+    with zip_file.open("xl/sharedStrings.xml") as xml_file:
+        for _, elem in cET.iterparse(xml_file):
+            if elem.tag == si_tag:
+                strings.append(_get_cell_text(elem))
+                elem.clear()
+    return strings
+
+def _get_column_index(cell_ref):
+    index = 0
+    for char in XLSX_CELL_REF_RE.match(cell_ref).group("column"):
+        index = index * 26 + ord(char) - ord("A") + 1
+    return index - 1
+
+def _format_xlsx_number(value):
+    # Floats are stored with binary rounding errors (1199.9999999999998)
+    try:
+        return u"{:.15g}".format(float(value))
+    except ValueError:
+        return value
+
+def iter_xlsx_rows(file_path):
+    """
+    Iterate over the rows of the first worksheet of an XLSX workbook.
+
+    The worksheet XML is parsed incrementally and every row is discarded
+    after it has been yielded, so memory usage only depends on the size of
+    the shared string table, not on the number of rows. Empty rows are
+    skipped, missing cells are returned as empty strings and rows shorter
+    than the first one are padded. Numbers are formatted without binary
+    rounding errors, booleans as TRUE and FALSE. Dates cannot be told from
+    numbers without evaluating cell styles and are returned as serial
+    numbers.
+
+    Returns:
+        A generator of lists of unicode strings.
+    """
+    zip_file = _open_zip_archive(file_path)
+    try:
+        shared_strings = _load_shared_strings(zip_file)
+        tag = "{" + XLSX_NAMESPACES["main"] + "}"
+        width = None
+        sheet_data = None
+        with zip_file.open(_get_first_sheet_path(zip_file)) as xml_file:
+            for event, elem in cET.iterparse(xml_file, ("start", "end")):
+                if event == "start":
+                    if elem.tag == tag + "sheetData":
+                        sheet_data = elem
+                    continue
+                if elem.tag != tag + "row":
+                    continue
+                row = []
+                for cell in elem.iter(tag + "c"):
+                    cell_type = cell.get("t", "n")
+                    if cell_type == "inlineStr":
+                        value = _get_cell_text(cell.find(tag + "is"))
+                    else:
+                        value = cell.findtext(tag + "v") or u""
+                        if cell_type == "s" and value:
+                            value = shared_strings[int(value)]
+                        elif cell_type == "b":
+                            value = u"TRUE" if value == "1" else u"FALSE"
+                        elif cell_type == "n" and value:
+                            value = _format_xlsx_number(value)
+                    if cell.get("r"):
+                        position = _get_column_index(cell.get("r"))
+                        row += [u""] * (position - len(row))
+                    row.append(unicode(value))
+                # Parsed rows are removed from the tree to bound memory usage
+                elem.clear()
+                if sheet_data is not None:
+                    sheet_data.remove(elem)
+                if not any(value.strip() for value in row):
+                    continue
+                if width is None:
+                    width = len(row)
+                row += [u""] * (width - len(row))
+                yield row
+    finally:
+        zip_file.close()
+
+def _iter_xlsx_csv_lines(file_path):
+    buf = StringIO()
+    writer = csv.writer(buf)
+    for row in iter_xlsx_rows(file_path):
+        writer.writerow([value.encode("utf-8") for value in row])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+def _get_input_type(file_path):
+    return os.path.splitext(file_path)[1].lower()
+
+def get_input_name(file_path):
+    """
+    Return the name of the CSV or TSV content of an input file: The path
+    without a compression suffix or the name of the file in a ZIP archive.
+    """
+    input_type = _get_input_type(file_path)
+    if input_type in COMPRESSED_INPUT_TYPES:
+        return os.path.splitext(file_path)[0]
+    if input_type == ".zip":
+        zip_file = _open_zip_archive(file_path)
+        try:
+            return _select_zip_member(zip_file)
+        finally:
+            zip_file.close()
+    return file_path
+
+def is_xlsx_input(file_path):
+    return _get_input_type(file_path) == ".xlsx"
+
+def is_tsv_input(file_path):
+    return get_input_name(file_path).lower().endswith(TSV_SUFFIXES)
+
+def open_input_file(file_path):
+    """
+    Open an APC delivery for reading as CSV.
+
+    Besides plain CSV and TSV files, gzip (.gz) and bzip2 (.bz2) compressed
+    files, ZIP archives containing one CSV or TSV file (.zip) and Excel
+    workbooks (.xlsx, the first worksheet is converted to UTF-8 encoded CSV)
+    are supported. All formats are streamed, so memory usage does not
+    depend on the size of the file.
+
+    Returns:
+        A file object which can be passed to UnicodeReader and rewound with
+        seek(0).
+    Raises:
+        IOError: If the file cannot be opened or is no valid archive.
+    """
+    input_type = _get_input_type(file_path)
+    if input_type in COMPRESSED_INPUT_TYPES:
+        open_file = COMPRESSED_INPUT_TYPES[input_type]
+        # Fail early (the generator only opens the file on the first read)
+        open_file(file_path, "rb").close()
+        def open_lines():
+            with open_file(file_path, "rb") as compressed_file:
+                for line in compressed_file:
+                    yield line
+        return StreamingInput(open_lines)
+    if input_type == ".zip":
+        get_input_name(file_path)
+        return StreamingInput(lambda: _iter_zip_member(file_path))
+    if input_type == ".xlsx":
+        _open_zip_archive(file_path).close()
+        return StreamingInput(lambda: _iter_xlsx_csv_lines(file_path))
+    return open(file_path, "r")
+
 class OpenAPCUnicodeWriter(object):
     """
     A customized CSV Writer.
@@ -88,31 +623,40 @@ class OpenAPCUnicodeWriter(object):
         has_header: Determines if the csv file has a header. If that's the case,
                     The values in the first row will all be quoted regardless
                     of any quotemask.  
+        line_terminator: The string terminating every row.
     """
     
-    def __init__(self, f, quotemask=None, openapc_quote_rules=True, has_header=True):
+    def __init__(self, f, quotemask=None, openapc_quote_rules=True, has_header=True,
+                 line_terminator=u"\r\n"):
         self.outfile = f
         self.quotemask = quotemask
         self.openapc_quote_rules = openapc_quote_rules
         self.has_header = has_header
+        self.line_terminator = line_terminator
         self.encoder = codecs.getincrementalencoder("utf-8")()
         
     def _prepare_row(self, row, use_quotemask):
+        # Works on a copy, rows can be lists or records
+        row = list(row.values() if isinstance(row, Record) else row)
         for index in range(len(row)):
             if self.openapc_quote_rules and row[index] in [u"TRUE", u"FALSE", u"NA"]:
                 # Never quote these keywords
                 continue
             if not use_quotemask or not self.quotemask:
                 # Always quote without a quotemask
-                row[index] = u'"' + row[index] + u'"'
+                row[index] = self._quote(row[index])
                 continue
             if index < len(self.quotemask):
                 if self.quotemask[index]:
-                    row[index] = u'"' + row[index] + u'"'
+                    row[index] = self._quote(row[index])
         return row
 
+    def _quote(self, value):
+        # Quotes within values have to be doubled
+        return u'"' + value.replace(u'"', u'""') + u'"'
+
     def _write_row(self, row):
-        line = u",".join(row) + u"\r\n"
+        line = u",".join(row) + self.line_terminator
         line = self.encoder.encode(line)
         self.outfile.write(line)
         
@@ -168,18 +712,720 @@ class CSVAnalysisResult(object):
         ret += "***************************"
         return ret
         
+class CrossrefStore(object):
+    """
+    A local key-value store for crossref metadata, indexed by DOI.
+
+    The store is an SQLite database holding only the metadata fields relevant
+    to OpenAPC (see CROSSREF_FIELDS) for every DOI. Values are stored as a
+    compact JSON list in the order of CROSSREF_FIELDS. DOIs are normalized
+    (see normalize_doi) before storing or lookup.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS crossref " +
+                                "(doi TEXT PRIMARY KEY, metadata TEXT)")
+
+    def get(self, doi):
+        """
+        Return a crossref metadata dict for a DOI or None if it is unknown.
+        """
+        cursor = self.connection.execute(
+            "SELECT metadata FROM crossref WHERE doi = ?", (normalize_doi(doi),))
+        result = cursor.fetchone()
+        if result is None:
+            return None
+        return dict(zip(CROSSREF_FIELDS, json.loads(result[0])))
+
+    def add_many(self, items):
+        """
+        Insert or replace metadata for many DOIs at once.
+
+        Args:
+            items: An iterable of (doi, metadata_dict) tuples.
+        """
+        rows = []
+        for doi, metadata in items:
+            values = [metadata.get(field) for field in CROSSREF_FIELDS]
+            rows.append((normalize_doi(doi),
+                         json.dumps(values, separators=(",", ":"))))
+        self.connection.executemany("INSERT OR REPLACE INTO crossref " +
+                                    "VALUES (?, ?)", rows)
+        self.connection.commit()
+
+    def __len__(self):
+        cursor = self.connection.execute("SELECT COUNT(*) FROM crossref")
+        return cursor.fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+class LookupCache(object):
+    """
+    A persistent cache for lookup results which can be shared by processes.
+
+    Results of lookup functions (like get_metadata_from_crossref) are stored
+    as JSON in an SQLite database in WAL mode, which allows concurrent
+    readers alongside a writer, so several enrichment processes (possibly on
+    different hosts using the same file share) can use one cache file.
+    Only successful lookups are stored.
+    """
+
+    def __init__(self, path, timeout=60):
+        self.connection = sqlite3.connect(path, timeout=timeout)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS lookups " +
+                                "(kind TEXT, key TEXT, result TEXT, " +
+                                "PRIMARY KEY (kind, key))")
+        self.connection.commit()
+
+    def get(self, kind, key):
+        cursor = self.connection.execute(
+            "SELECT result FROM lookups WHERE kind = ? AND key = ?",
+            (kind, key))
+        result = cursor.fetchone()
+        if result is None:
+            return None
+        return json.loads(result[0])
+
+    def put(self, kind, key, result):
+        self.connection.execute("INSERT OR REPLACE INTO lookups " +
+                                "VALUES (?, ?, ?)",
+                                (kind, key, json.dumps(result)))
+        self.connection.commit()
+
+    def wrap(self, kind, lookup, success_key="success", normalize=None):
+        """
+        Return a cached version of a lookup function.
+
+        Args:
+            kind: The name of the lookup (cache namespace).
+            lookup: A function taking a key as first argument and returning
+                    a result dict.
+            success_key: The result key signalling a successful lookup.
+            normalize: An optional function to normalize keys.
+        """
+        def cached_lookup(key, *args, **kwargs):
+            cache_key = normalize(key) if normalize else key
+            result = self.get(kind, cache_key)
+            if result is None:
+                result = lookup(key, *args, **kwargs)
+                if result[success_key]:
+                    self.put(kind, cache_key, result)
+            return result
+        return cached_lookup
+
+    def close(self):
+        self.connection.close()
+
+class APCIndex(object):
+    """
+    A read-only, memory-mapped DOI/ISSN index over an OpenAPC CSV file.
+
+    The index maps normalized DOIs and ISSNs to the byte offsets of the rows
+    containing them. It is built by build_apc_index and opened via mmap, so
+    many processes can share the same index without loading or parsing the
+    CSV file. Lookups hash the key into one of the buckets of the index and
+    only scan the (usually one or two) entries in that bucket.
+
+    File layout (little endian):
+        header: magic, number of buckets, number of entries, size and
+                mtime of the indexed CSV file (APC_INDEX_HEADER)
+        bucket directory: number of buckets + 1 entry indices (uint32)
+        entries: (key hash, row offset) pairs (uint64, uint64), sorted by
+                 bucket
+    """
+
+    def __init__(self, index_path, csv_path):
+        self.csv_path = csv_path
+        with open(index_path, "rb") as index_file:
+            self.mmap = mmap.mmap(index_file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        header = APC_INDEX_HEADER.unpack_from(self.mmap, 0)
+        magic, self.num_buckets, self.num_entries = header[:3]
+        self.csv_size, self.csv_mtime = header[3:]
+        if magic != APC_INDEX_MAGIC:
+            self.mmap.close()
+            raise ValueError("'{}' is not an APC index file".format(index_path))
+        self._entries_start = (APC_INDEX_HEADER.size +
+                               (self.num_buckets + 1) * APC_INDEX_BUCKET.size)
+        self._csv_file = None
+        self._header = None
+
+    def is_current(self):
+        """
+        Check if the indexed CSV file has not been modified since indexing.
+        """
+        stat = os.stat(self.csv_path)
+        return stat.st_size == self.csv_size and stat.st_mtime == self.csv_mtime
+
+    def _lookup(self, key):
+        key_hash = _apc_index_hash(key)
+        bucket = key_hash & (self.num_buckets - 1)
+        pos = APC_INDEX_HEADER.size + bucket * APC_INDEX_BUCKET.size
+        first, last = struct.unpack_from("<II", self.mmap, pos)
+        offsets = []
+        for entry in range(first, last):
+            pos = self._entries_start + entry * APC_INDEX_ENTRY.size
+            entry_hash, offset = APC_INDEX_ENTRY.unpack_from(self.mmap, pos)
+            if entry_hash == key_hash:
+                offsets.append(offset)
+        return offsets
+
+    def lookup_doi(self, doi):
+        """
+        Return the byte offsets of all rows containing a DOI.
+        """
+        return self._lookup(u"doi:" + normalize_doi(doi))
+
+    def lookup_issn(self, issn):
+        """
+        Return the byte offsets of all rows containing an ISSN in any of the
+        issn, issn_print or issn_electronic columns.
+        """
+        return self._lookup(u"issn:" + normalize_issn(issn))
+
+    def contains_doi(self, doi):
+        return len(self.lookup_doi(doi)) > 0
+
+    def get_row(self, offset):
+        """
+        Read the CSV row starting at a byte offset as a dict.
+        """
+        if self._csv_file is None:
+            self._csv_file = open(self.csv_path, "rb")
+            self._header = UnicodeReader(self._csv_file).next()
+        self._csv_file.seek(offset)
+        row = UnicodeReader(self._csv_file).next()
+        return dict(zip(self._header, row))
+
+    def close(self):
+        self.mmap.close()
+        if self._csv_file is not None:
+            self._csv_file.close()
+
+def _apc_index_hash(key):
+    digest = hashlib.md5(key.encode("utf-8")).digest()
+    return struct.unpack("<Q", digest[:8])[0]
+
+class _OffsetLineIterator(object):
+    """
+    A line iterator which keeps track of the byte offset in a file.
+    """
+
+    def __init__(self, f):
+        self.file = f
+        self.offset = 0
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.file.readline()
+        if not line:
+            raise StopIteration
+        self.offset += len(line)
+        return line
+
+def build_apc_index(csv_path, index_path):
+    """
+    Build an APCIndex file for an OpenAPC CSV file (usually apc_de.csv).
+
+    Args:
+        csv_path: Path to a UTF-8 encoded CSV file in the OpenAPC format.
+        index_path: Where to write the index.
+    Returns:
+        The number of index entries (one per row and distinct key).
+    """
+    entries = []
+    with open(csv_path, "rb") as csv_file:
+        lines = _OffsetLineIterator(csv_file)
+        reader = csv.reader(lines)
+        header = reader.next()
+        doi_index = header.index("doi")
+        issn_indices = [header.index(col) for col in
+                        ["issn", "issn_print", "issn_electronic"]]
+        while True:
+            offset = lines.offset
+            try:
+                row = reader.next()
+            except StopIteration:
+                break
+            if not row:
+                continue
+            keys = set()
+            doi = unicode(row[doi_index], "utf-8")
+            if doi and doi != u"NA":
+                keys.add(u"doi:" + normalize_doi(doi))
+            for index in issn_indices:
+                issn = normalize_issn(unicode(row[index], "utf-8"))
+                if issn and issn != u"NA":
+                    keys.add(u"issn:" + issn)
+            for key in keys:
+                entries.append((_apc_index_hash(key), offset))
+    num_buckets = 1
+    while num_buckets < len(entries):
+        num_buckets *= 2
+    entries.sort(key=lambda entry: (entry[0] & (num_buckets - 1), entry[1]))
+    bucket_starts = [0] * (num_buckets + 1)
+    for key_hash, _ in entries:
+        bucket_starts[(key_hash & (num_buckets - 1)) + 1] += 1
+    for bucket in range(num_buckets):
+        bucket_starts[bucket + 1] += bucket_starts[bucket]
+    stat = os.stat(csv_path)
+    with open(index_path, "wb") as index_file:
+        index_file.write(APC_INDEX_HEADER.pack(APC_INDEX_MAGIC, num_buckets,
+                                               len(entries), stat.st_size,
+                                               stat.st_mtime))
+        index_file.write(struct.pack("<{}I".format(num_buckets + 1),
+                                     *bucket_starts))
+        for entry in entries:
+            index_file.write(APC_INDEX_ENTRY.pack(*entry))
+    return len(entries)
+
+class JournalKnowledgeBase(object):
+    """
+    Canonical journal metadata derived from an OpenAPC CSV file.
+
+    Rows of apc_de.csv are grouped into journals by their ISSNs (rows sharing
+    any ISSN belong to the same journal). For every journal, the most
+    frequent non-NA value of each field in JOURNAL_KB_FIELDS is kept, except
+    for doaj, where the value of the most recent row is used. Journals can
+    be looked up by any of their ISSN variants.
+
+    Use build_journal_kb to create a knowledge base and save/load to store it
+    as a compact JSON file. If an ISSNLIndex is assigned to issnl_index,
+    ISSNs not in the knowledge base are also looked up by their ISSN-L.
+    """
+
+    def __init__(self, journals, issns, csv_size=None, csv_mtime=None):
+        self.journals = journals
+        self.issns = issns
+        self.csv_size = csv_size
+        self.csv_mtime = csv_mtime
+        self.issnl_index = None
+
+    def lookup(self, issn):
+        """
+        Return the journal metadata (a dict) for an ISSN or None.
+        """
+        issn = normalize_issn(issn)
+        journal = self.issns.get(issn)
+        if journal is None and self.issnl_index is not None:
+            journal = self.issns.get(self.issnl_index.get_issn_l(issn))
+        if journal is None:
+            return None
+        return dict(zip(JOURNAL_KB_FIELDS, self.journals[journal]))
+
+    def __len__(self):
+        return len(self.journals)
+
+    def is_current(self, csv_path):
+        """
+        Check if the source CSV file has not been modified since building.
+        """
+        stat = os.stat(csv_path)
+        return stat.st_size == self.csv_size and stat.st_mtime == self.csv_mtime
+
+    def save(self, path):
+        content = {"fields": JOURNAL_KB_FIELDS, "version": JOURNAL_KB_VERSION,
+                   "csv_size": self.csv_size,
+                   "csv_mtime": self.csv_mtime, "journals": self.journals,
+                   "issns": self.issns}
+        with open(path, "w") as kb_file:
+            json.dump(content, kb_file, separators=(",", ":"))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r") as kb_file:
+            content = json.load(kb_file)
+        if (content.get("fields") != JOURNAL_KB_FIELDS or
+                content.get("version") != JOURNAL_KB_VERSION):
+            msg = "'{}' is no compatible journal knowledge base file"
+            raise ValueError(msg.format(path))
+        return cls(content["journals"], content["issns"], content["csv_size"],
+                   content["csv_mtime"])
+
+def build_journal_kb(csv_path):
+    """
+    Build a JournalKnowledgeBase from an OpenAPC CSV file.
+    """
+    parents = {}
+    def find(issn):
+        root = issn
+        while parents[root] != root:
+            root = parents[root]
+        while parents[issn] != root:
+            parents[issn], issn = root, parents[issn]
+        return root
+
+    rows = []
+    with open(csv_path, "r") as csv_file:
+        for row in UnicodeDictReader(csv_file):
+            issns = _split_issns([row[column] for column in
+                                  ["issn", "issn_print", "issn_electronic"]])
+            if not issns:
+                continue
+            for issn in issns:
+                parents.setdefault(issn, issn)
+            for issn in issns[1:]:
+                parents[find(issn)] = find(issns[0])
+            rows.append((issns[0], row))
+
+    groups = OrderedDict()
+    for issn, row in rows:
+        groups.setdefault(find(issn), []).append(row)
+    journals = []
+    journal_indices = {}
+    for root, journal_rows in groups.iteritems():
+        values = []
+        for field in JOURNAL_KB_FIELDS:
+            if field == "doaj":
+                latest = max(journal_rows, key=lambda row: row["period"])
+                values.append(latest["doaj"])
+                continue
+            counts = {}
+            for row in journal_rows:
+                if row[field] != u"NA":
+                    counts[row[field]] = counts.get(row[field], 0) + 1
+            if counts:
+                values.append(max(sorted(counts), key=counts.get))
+            else:
+                values.append(u"NA")
+        journal_indices[root] = len(journals)
+        journals.append(values)
+    issns = {issn: journal_indices[find(issn)] for issn in parents}
+    stat = os.stat(csv_path)
+    return JournalKnowledgeBase(journals, issns, stat.st_size, stat.st_mtime)
+
+def load_journal_kb(kb_path, csv_path):
+    """
+    Load a journal knowledge base, (re)building it if it is outdated.
+
+    Returns:
+        A JournalKnowledgeBase or None if neither a current knowledge base
+        file nor the source CSV file exist.
+    """
+    if os.path.isfile(kb_path):
+        try:
+            kb = JournalKnowledgeBase.load(kb_path)
+        except ValueError:
+            # Written by an older version, rebuild it
+            kb = None
+        if kb is not None and (not os.path.isfile(csv_path) or
+                               kb.is_current(csv_path)):
+            return kb
+    if not os.path.isfile(csv_path):
+        return None
+    kb = build_journal_kb(csv_path)
+    kb.save(kb_path)
+    return kb
+
+class JournalTitleIndex(object):
+    """
+    A trigram index for fuzzy matching of journal titles.
+
+    Titles are normalized (see normalize_journal_title) and split into
+    character trigrams. The similarity of two titles is the Dice coefficient
+    of their trigram sets. Queries use prefix filtering: A title reaching the
+    minimum score shares a minimum number of trigrams with the query, so it
+    has to contain several of the query's rarest trigrams. Only the (short)
+    posting lists of those are scanned, and only titles with enough hits
+    there are scored.
+    """
+
+    # Number of rare trigrams scanned in addition to the minimal prefix.
+    # Scanning more posting lists allows to require more hits per candidate.
+    PREFIX_EXTENSION = 2
+
+    def __init__(self):
+        self.journals = []
+        self.trigrams = []
+        self.postings = {}
+        self.titles = {}
+
+    def add(self, title, publisher, issns):
+        """
+        Add a journal. Titles already in the index are not added again, but
+        new ISSNs are merged into the existing entry.
+        """
+        normalized = normalize_journal_title(title)
+        if not normalized:
+            return
+        issns = _split_issns(issns)
+        if normalized in self.titles:
+            journal = self.journals[self.titles[normalized]]
+            journal["issns"] += [i for i in issns if i not in journal["issns"]]
+            return
+        journal_id = len(self.journals)
+        self.titles[normalized] = journal_id
+        self.journals.append({"journal_full_title": title,
+                              "publisher": publisher, "issns": issns})
+        trigrams = get_trigrams(normalized)
+        self.trigrams.append(trigrams)
+        for trigram in trigrams:
+            self.postings.setdefault(trigram, []).append(journal_id)
+
+    def __len__(self):
+        return len(self.journals)
+
+    def query(self, title, min_score=0.6, limit=5):
+        """
+        Find the journals with titles most similar to a given title.
+
+        Returns:
+            A list of up to limit journal dicts (keys 'journal_full_title',
+            'publisher', 'issns' and 'score'), best matches first.
+        """
+        normalized = normalize_journal_title(title)
+        if normalized in self.titles:
+            journal = dict(self.journals[self.titles[normalized]])
+            journal["issns"] = list(journal["issns"])
+            journal["score"] = 1.0
+            return [journal]
+        query_trigrams = get_trigrams(normalized)
+        num_trigrams = len(query_trigrams)
+        if not num_trigrams:
+            return []
+        # A match needs at least min_overlap common trigrams. Of the
+        # prefix_len rarest query trigrams, it has to contain at least
+        # min_overlap - (num_trigrams - prefix_len).
+        min_overlap = int(math.ceil(min_score * num_trigrams /
+                                    (2 - min_score)))
+        prefix_len = min(num_trigrams, num_trigrams - min_overlap + 1 +
+                         JournalTitleIndex.PREFIX_EXTENSION)
+        min_hits = min_overlap - (num_trigrams - prefix_len)
+        rare = sorted(query_trigrams,
+                      key=lambda t: len(self.postings.get(t, ())))
+        hits = {}
+        for trigram in rare[:prefix_len]:
+            for journal_id in self.postings.get(trigram, ()):
+                hits[journal_id] = hits.get(journal_id, 0) + 1
+        results = []
+        for journal_id, count in hits.iteritems():
+            if count < min_hits:
+                continue
+            trigrams = self.trigrams[journal_id]
+            score = (2.0 * len(query_trigrams & trigrams) /
+                     (num_trigrams + len(trigrams)))
+            if score >= min_score:
+                results.append((score, journal_id))
+        results.sort(key=lambda result: (-result[0], result[1]))
+        matches = []
+        for score, journal_id in results[:limit]:
+            journal = dict(self.journals[journal_id])
+            journal["issns"] = list(journal["issns"])
+            journal["score"] = round(score, 3)
+            matches.append(journal)
+        return matches
+
+def normalize_journal_title(title):
+    """
+    Normalize a journal title for matching.
+
+    Accents, punctuation, case and a leading 'The' are removed, '&' is
+    replaced by 'and'.
+    """
+    title = unicodedata.normalize("NFKD", unicode(title))
+    title = u"".join(c for c in title if not unicodedata.combining(c))
+    title = title.lower().replace(u"&", u" and ")
+    title = re.sub(r"[^\w]+", u" ", title, flags=re.UNICODE).strip()
+    if title.startswith(u"the "):
+        title = title[4:]
+    return title
+
+def _split_issns(values):
+    """
+    Split and clean ISSN values, which may contain several ISSNs separated
+    by ';' or ','.
+    """
+    issns = []
+    for value in values:
+        for issn in re.split(u"[;,]", value or u""):
+            issn = normalize_issn(issn)
+            if issn and issn != u"NA" and issn not in issns:
+                issns.append(issn)
+    return issns
+
+def get_trigrams(normalized_title):
+    padded = u"  " + normalized_title + u" "
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+def build_journal_title_index(journal_kb=None, doaj_list=None):
+    """
+    Build a JournalTitleIndex from a JournalKnowledgeBase and/or a DOAJ
+    journal list (data/doaj/doajJournalList.csv).
+
+    Journals from the knowledge base are added first, so their canonical
+    titles and publishers take precedence over those from DOAJ.
+    """
+    index = JournalTitleIndex()
+    if journal_kb is not None:
+        fields = JOURNAL_KB_FIELDS
+        for values in journal_kb.journals:
+            journal = dict(zip(fields, values))
+            index.add(journal["journal_full_title"], journal["publisher"],
+                      [journal["issn"], journal["issn_print"],
+                       journal["issn_electronic"]])
+    if doaj_list is not None:
+        with open(doaj_list, "r") as doaj_file:
+            for row in UnicodeDictReader(doaj_file):
+                issns = [row.get("ISSN", u""), row.get("EISSN", u"")]
+                index.add(row["Title"], row.get("Publisher", u"NA"), issns)
+                if row.get("Title.Alternative"):
+                    index.add(row["Title.Alternative"],
+                              row.get("Publisher", u"NA"), issns)
+    return index
+
 def is_wellformed_DOI(doi_string):
     doi_match = DOI_RE.match(doi_string.strip())
     if doi_match is not None:
         return True
     return False
+
+def is_wellformed_ISSN(issn_string):
+    return ISSN_RE.match(issn_string.strip().upper()) is not None
+
+def normalize_issn(issn_string):
+    """
+    Bring an ISSN into its canonical form ('1234-567X') for comparisons and
+    lookups.
+
+    Whitespace, a missing hyphen (or another kind of dash) and a lowercase
+    check digit are corrected. Leading zeros dropped by spreadsheet
+    applications ('283908') are restored if the result has a valid check
+    digit. Strings which are no well-formed ISSN are returned stripped and
+    uppercased.
+    """
+    issn_string = issn_string.strip().upper()
+    if re.match(u"^[0-9]{4,6}[0-9X]$", issn_string):
+        padded = issn_string.rjust(8, u"0")
+        if padded[-1] == get_issn_check_digit(padded):
+            issn_string = padded
+    issn_match = ISSN_RE.match(issn_string)
+    if issn_match is not None:
+        return issn_match.group("first") + u"-" + issn_match.group("second")
+    return issn_string
+
+def get_issn_check_digit(issn_string):
+    """
+    Compute the check digit of an ISSN from its first seven digits.
+    """
+    digits = issn_string.replace(u"-", u"")[:7]
+    total = sum(int(digit) * weight for digit, weight in zip(digits,
+                                                             range(8, 1, -1)))
+    check = (11 - total % 11) % 11
+    return u"X" if check == 10 else unicode(check)
+
+def is_valid_ISSN(issn_string):
+    """
+    Check if an ISSN is well-formed and has a correct check digit.
+    """
+    issn = normalize_issn(issn_string)
+    if not is_wellformed_ISSN(issn):
+        return False
+    return issn[-1] == get_issn_check_digit(issn)
+
+class ISSNLIndex(object):
+    """
+    Map ISSNs to their linking ISSN (ISSN-L).
+
+    The ISSN-L groups the ISSNs of all media versions (print, electronic) of
+    a journal, so joins on it find a journal regardless of which of its
+    ISSNs is given. ISSNs not in the index are their own ISSN-L.
+
+    The mapping is read from the ISSN-to-ISSN-L table published by the ISSN
+    International Centre (tab-separated, columns 'ISSN' and 'ISSN-L'). ISSNs
+    of the same journal can also be linked explicitly (see link).
+    """
+
+    def __init__(self, mapping=None):
+        self.mapping = mapping if mapping is not None else {}
+
+    def __len__(self):
+        return len(self.mapping)
+
+    def get_issn_l(self, issn):
+        issn = normalize_issn(issn)
+        return self.mapping.get(issn, issn)
+
+    def link(self, issns):
+        """
+        Group ISSNs known to belong to the same journal (like the print and
+        electronic ISSN of a row) under a common ISSN-L.
+
+        The ISSN-L is taken from the first ISSN already in the index, or the
+        first ISSN otherwise. ISSNs already in the index keep their ISSN-L.
+        """
+        issns = [normalize_issn(issn) for issn in issns]
+        known = [issn for issn in issns if issn in self.mapping]
+        issn_l = self.mapping[known[0]] if known else issns[0]
+        for issn in issns:
+            self.mapping.setdefault(issn, issn_l)
+
+    def save(self, file_path):
+        with open(file_path, "w") as out:
+            out.write("ISSN\tISSN-L\n")
+            for issn, issn_l in sorted(self.mapping.iteritems()):
+                out.write("{}\t{}\n".format(issn, issn_l))
+
+    @classmethod
+    def load(cls, file_path):
+        mapping = {}
+        with open(file_path, "r") as table:
+            for line in table:
+                fields = line.rstrip("\r\n").split("\t")
+                if len(fields) < 2 or not is_wellformed_ISSN(fields[0]):
+                    # Header
+                    continue
+                mapping[normalize_issn(fields[0])] = normalize_issn(fields[1])
+        return cls(mapping)
+
+def load_issnl_index(table_path=None, csv_path=None):
+    """
+    Build an ISSNLIndex from an ISSN-L table and/or an OpenAPC CSV file.
+
+    The ISSNs given together in a row of the CSV file (issn, issn_print,
+    issn_electronic) are linked, so print and electronic ISSNs of journals
+    in the file are grouped even without (or in addition to) the table.
+    Missing files are ignored.
+    """
+    if table_path is not None and os.path.isfile(table_path):
+        index = ISSNLIndex.load(table_path)
+    else:
+        index = ISSNLIndex()
+    if csv_path is not None and os.path.isfile(csv_path):
+        with open(csv_path, "r") as csv_file:
+            for row in UnicodeDictReader(csv_file):
+                issns = [row[column] for column in
+                         ["issn_print", "issn", "issn_electronic"]
+                         if row[column] and row[column] != u"NA"]
+                if issns:
+                    index.link(issns)
+    return index
+
+def normalize_doi(doi_string):
+    """
+    Bring a DOI into a canonical form for comparisons and lookups.
+
+    Prefixes like 'doi:' or 'http://dx.doi.org/' are removed and the DOI is
+    lowercased (DOIs are case-insensitive). Strings which are no well-formed
+    DOI are returned stripped and lowercased.
+    """
+    doi_string = doi_string.strip()
+    doi_match = DOI_RE.match(doi_string)
+    if doi_match is not None:
+        doi_string = doi_match.groupdict()["doi"]
+    return doi_string.lower()
  
 def analyze_csv_file(file_path, line_limit=None):
     try:
-        csv_file = open(file_path, "r")
+        csv_file = open_input_file(file_path)
     except IOError as ioe:
         error_msg = "Error: could not open file '{}': {}".format(file_path,
-                                                                 ioe.strerror)
+                                                                 ioe.strerror or
+                                                                 str(ioe))
         return {"success": False, "error_msg": error_msg}
         
     data = {}
@@ -196,7 +1442,11 @@ def analyze_csv_file(file_path, line_limit=None):
         else:
             blanks += 1
 
-    if chardet:
+    if is_xlsx_input(file_path):
+        # Workbooks are converted to UTF-8
+        enc = "utf-8"
+        enc_conf = 1.0
+    elif chardet:
         chardet_result = chardet.detect(content)
         enc = chardet_result["encoding"]
         enc_conf = chardet_result["confidence"]
@@ -206,8 +1456,22 @@ def analyze_csv_file(file_path, line_limit=None):
 
     sniffer = csv.Sniffer()
     try:
-        dialect = sniffer.sniff(content)
-        has_header = sniffer.has_header(content)
+        # The dialects of workbooks (converted with the default dialect) and
+        # TSV files are known
+        known_dialect = None
+        if is_xlsx_input(file_path):
+            known_dialect = csv.excel
+        elif is_tsv_input(file_path):
+            known_dialect = csv.excel_tab
+        if known_dialect:
+            dialect = known_dialect
+            try:
+                has_header = sniffer.has_header(content)
+            except csv.Error:
+                has_header = True
+        else:
+            dialect = sniffer.sniff(content)
+            has_header = sniffer.has_header(content)
     except csv.Error as csve:
         error_msg = ("Error: An error occured while analyzing the file: '" +
                      csve.message + "'. Maybe it is no valid CSV file?")
@@ -216,8 +1480,407 @@ def analyze_csv_file(file_path, line_limit=None):
     csv_file.close()
     return {"success": True, "data": result}
 
+def infer_number_format(values, default_decimal_mark="."):
+    """
+    Guess decimal mark and thousands separator from a sample of numbers.
+
+    Every value containing a '.' or ',' is counted as evidence: If both
+    marks occur, the last one is the decimal mark. A mark occuring more than
+    once or followed by exactly 3 digits is considered a thousands separator
+    (monetary values do not have 3 decimal places), otherwise it is counted
+    as decimal mark.
+
+    Args:
+        values: A list of strings, usually the sampled values of one column.
+        default_decimal_mark: The decimal mark to assume if there is no
+                              evidence in the values.
+    Returns:
+        A tuple (decimal_mark, thousands_separator). The thousands separator
+        is an empty string if there is no evidence for one.
+    """
+    decimal_votes = {".": 0, ",": 0}
+    thousands_votes = {".": 0, ",": 0, " ": 0}
+    for value in values:
+        value = value.strip()
+        if not NUMBER_CHARS_RE.match(value):
+            continue
+        if " " in value:
+            thousands_votes[" "] += 1
+        dots = value.count(".")
+        commas = value.count(",")
+        if dots and commas:
+            last = "." if value.rfind(".") > value.rfind(",") else ","
+            other = "," if last == "." else "."
+            decimal_votes[last] += 1
+            thousands_votes[other] += 1
+        elif dots or commas:
+            mark = "." if dots else ","
+            if value.count(mark) > 1 or len(value) - value.rfind(mark) == 4:
+                thousands_votes[mark] += 1
+            else:
+                decimal_votes[mark] += 1
+    if decimal_votes["."] > decimal_votes[","]:
+        decimal_mark = "."
+    elif decimal_votes[","] > decimal_votes["."]:
+        decimal_mark = ","
+    elif thousands_votes["."] != thousands_votes[","]:
+        # No decimal places anywhere, but a thousands separator was found
+        if thousands_votes["."] > thousands_votes[","]:
+            decimal_mark = ","
+        else:
+            decimal_mark = "."
+    else:
+        decimal_mark = default_decimal_mark
+    thousands_sep = ""
+    candidates = [(votes, sep) for sep, votes in thousands_votes.iteritems()
+                  if votes > 0 and sep != decimal_mark]
+    if candidates:
+        thousands_sep = max(candidates)[1]
+    return (decimal_mark, thousands_sep)
+
+def get_locale_number_format():
+    """
+    Return the decimal mark and thousands separator of the current locale.
+
+    locale.localeconv returns byte strings in the encoding of the locale
+    (the thousands separator of fr_FR.UTF-8 is '\\xe2\\x80\\xaf'), they are
+    decoded, so they can be compared with unicode values.
+
+    Returns:
+        A tuple (decimal mark, thousands separator) of unicode strings.
+    """
+    conv = locale.localeconv()
+    encoding = locale.getpreferredencoding(False)
+    return tuple(conv[key].decode(encoding)
+                 for key in ["decimal_point", "thousands_sep"])
+
+def compile_number_parser(decimal_mark, thousands_sep=""):
+    """
+    Create a fast, strict parser for numbers in a fixed format.
+
+    Args:
+        decimal_mark: The decimal mark, usually '.' or ','.
+        thousands_sep: The thousands separator or an empty string if digits
+                       are not grouped.
+    Returns:
+        A function taking a string and returning a float. It will raise a
+        ValueError if the string does not represent a number in the given
+        format.
+    """
+    decimals = "(" + re.escape(decimal_mark) + "[0-9]+)?$"
+    if thousands_sep:
+        grouping = "[0-9]{1,3}(" + re.escape(thousands_sep) + "[0-9]{3})+"
+        number_re = re.compile("^-?(" + grouping + "|[0-9]+)" + decimals)
+    else:
+        number_re = re.compile("^-?[0-9]+" + decimals)
+
+    def parse_number(value):
+        value = value.strip()
+        if not number_re.match(value):
+            msg = u"'{}' is not a number with decimal mark '{}'"
+            if thousands_sep:
+                msg += u" and thousands separator '{}'"
+            raise ValueError(msg.format(value, decimal_mark, thousands_sep))
+        if thousands_sep:
+            value = value.replace(thousands_sep, "")
+        return float(value.replace(decimal_mark, "."))
+    return parse_number
+
+def infer_period_format(values):
+    """
+    Determine which entry in PERIOD_FORMATS matches most of the given values.
+
+    Returns:
+        The name of a period format or None if no value matches any format.
+    """
+    best_format = None
+    best_count = 0
+    for period_format, period_re in PERIOD_FORMATS.iteritems():
+        count = len([v for v in values if period_re.match(v.strip())])
+        if count > best_count:
+            best_format = period_format
+            best_count = count
+    return best_format
+
+def compile_period_parser(period_format):
+    """
+    Create a parser extracting the year from values in a given period format.
+
+    Args:
+        period_format: A key from PERIOD_FORMATS.
+    Returns:
+        A function taking a string and returning the year as a unicode
+        string. It will raise a ValueError if the string does not match the
+        period format.
+    """
+    period_re = PERIOD_FORMATS[period_format]
+
+    def parse_period(value):
+        match = period_re.match(value.strip())
+        if not match:
+            msg = u"'{}' does not match the period format {}"
+            raise ValueError(msg.format(value, period_format))
+        return unicode(match.group("year"))
+    return parse_period
+
+def get_header_fingerprint(file_path):
+    """
+    Compute a fingerprint of the first non-empty line in a CSV file.
+
+    The line is hashed as raw bytes, so the fingerprint can be computed
+    without knowing the encoding or dialect of the file. Files sharing the
+    same layout (usually repeated deliveries from one institution) will
+    have the same fingerprint.
+
+    Args:
+        file_path: Path to the CSV file.
+    Returns:
+        A hex digest string or None if the file could not be read or is
+        empty.
+    """
+    try:
+        csv_file = open_input_file(file_path)
+        try:
+            for line in csv_file:
+                line = line.strip()
+                if line:
+                    return hashlib.sha1(line).hexdigest()
+        finally:
+            csv_file.close()
+    except IOError:
+        pass
+    return None
+
+def dialect_to_dict(dialect):
+    """
+    Serialize a csv dialect (for example a sniffed one) into a dict.
+    """
+    attrs = ["delimiter", "doublequote", "escapechar", "lineterminator",
+             "quotechar", "quoting", "skipinitialspace"]
+    return {attr: getattr(dialect, attr) for attr in attrs}
+
+def dialect_from_dict(dialect_dict):
+    """
+    Create a csv dialect from a dict created by dialect_to_dict.
+    """
+    class ProfileDialect(csv.Dialect):
+        pass
+    for key, value in dialect_dict.iteritems():
+        if isinstance(value, unicode):
+            # The csv module in Python 2 does not accept unicode here
+            value = value.encode("utf-8")
+        setattr(ProfileDialect, key, value)
+    return ProfileDialect
 
-def get_metadata_from_crossref(doi_string):
+def load_mapping_profiles(file_path):
+    """
+    Load column mapping profiles from a JSON file.
+
+    Mapping profiles store the result of a CSV file analysis (column map,
+    encoding, dialect and locale) keyed by the header fingerprint of the
+    analyzed file. A missing profile file is treated as an empty one.
+
+    Args:
+        file_path: Path to the profile file.
+    Returns:
+        A dict mapping header fingerprints to profile dicts.
+    """
+    try:
+        with open(file_path, "r") as profile_file:
+            return json.load(profile_file)
+    except IOError:
+        return {}
+
+def save_mapping_profile(file_path, fingerprint, profile):
+    """
+    Add or replace a single profile in a mapping profile file.
+    """
+    profiles = load_mapping_profiles(file_path)
+    profiles[fingerprint] = profile
+    with open(file_path, "w") as profile_file:
+        json.dump(profiles, profile_file, indent=4, sort_keys=True)
+
+
+def _is_columnar_na(value):
+    return value.strip() in [u"", u"NA"]
+
+def export_columnar(csv_path, dir_path, force=False):
+    """
+    Export an OpenAPC CSV file to compressed, typed column files.
+
+    Every column is written to its own zlib-compressed file in dir_path, so
+    consumers can load single columns without parsing the CSV file. Columns
+    listed in COLUMNAR_TYPES are stored as binary arrays of ints ('period',
+    NA becomes COLUMNAR_INT_NA) or floats ('euro', NA becomes NaN), empty
+    values are treated like NA. All other columns are dictionary encoded: A
+    list of the distinct values and an array of indices into it. The export
+    is described in a schema.json file which also holds a hash of the CSV
+    file, the export is only rebuilt if the CSV file or the export format
+    has changed.
+
+    Args:
+        csv_path: Path to a UTF-8 encoded CSV file with a header.
+        dir_path: Directory to write the column files to.
+        force: Rebuild the export even if the CSV file did not change.
+    Returns:
+        True if the export was (re)built, False if it was up to date.
+    """
+    with open(csv_path, "rb") as csv_file:
+        source_hash = hashlib.sha1(csv_file.read()).hexdigest()
+    schema_path = os.path.join(dir_path, "schema.json")
+    if not force and os.path.isfile(schema_path):
+        with open(schema_path, "r") as schema_file:
+            schema = json.load(schema_file)
+            if (schema.get("source_sha1") == source_hash and
+                    schema.get("format_version") == COLUMNAR_FORMAT_VERSION):
+                return False
+    if not os.path.isdir(dir_path):
+        os.makedirs(dir_path)
+    with open(csv_path, "r") as csv_file:
+        reader = UnicodeReader(csv_file)
+        header = reader.next()
+        columns = [[] for _ in header]
+        for row in reader:
+            if len(row) != len(header):
+                continue
+            for index, value in enumerate(row):
+                columns[index].append(value)
+    schema = {"source_sha1": source_hash, "byteorder": sys.byteorder,
+              "format_version": COLUMNAR_FORMAT_VERSION,
+              "rows": len(columns[0]) if columns else 0, "columns": []}
+    for name, values in zip(header, columns):
+        column_type = COLUMNAR_TYPES.get(name, "string")
+        column_schema = {"name": name, "type": column_type}
+        if column_type == "int":
+            column_schema["na_value"] = COLUMNAR_INT_NA
+            data = array.array("i", [COLUMNAR_INT_NA if _is_columnar_na(v)
+                                     else int(v) for v in values]).tostring()
+        elif column_type == "float":
+            data = array.array("d", [float("nan") if _is_columnar_na(v)
+                                     else float(v) for v in values]).tostring()
+        else:
+            dictionary = OrderedDict()
+            codes = array.array("I")
+            for value in values:
+                codes.append(dictionary.setdefault(value, len(dictionary)))
+            dict_data = u"\0".join(dictionary.keys()).encode("utf-8")
+            column_schema["dictionary_bytes"] = len(dict_data)
+            data = dict_data + codes.tostring()
+        with open(os.path.join(dir_path, name + ".col"), "wb") as col_file:
+            col_file.write(zlib.compress(data))
+        schema["columns"].append(column_schema)
+    with open(schema_path, "w") as schema_file:
+        json.dump(schema, schema_file, indent=4)
+    return True
+
+def read_columnar(dir_path, columns=None):
+    """
+    Read columns from an export created by export_columnar.
+
+    Args:
+        dir_path: The export directory.
+        columns: A list of column names to read, all columns if None.
+    Returns:
+        An OrderedDict mapping column names to their values: array.array
+        objects for numerical columns (NA is NaN in float columns), lists of
+        unicode strings otherwise. Int columns containing NA values are
+        returned as lists with 'NA' restored.
+    """
+    with open(os.path.join(dir_path, "schema.json"), "r") as schema_file:
+        schema = json.load(schema_file)
+    swap = schema["byteorder"] != sys.byteorder
+    result = OrderedDict()
+    for column_schema in schema["columns"]:
+        name = column_schema["name"]
+        if columns is not None and name not in columns:
+            continue
+        with open(os.path.join(dir_path, name + ".col"), "rb") as col_file:
+            data = zlib.decompress(col_file.read())
+        if column_schema["type"] in ["int", "float"]:
+            values = array.array("i" if column_schema["type"] == "int" else "d")
+            values.fromstring(data)
+            if swap:
+                values.byteswap()
+            na_value = column_schema.get("na_value")
+            if na_value is not None and na_value in values:
+                values = [u"NA" if value == na_value else value
+                          for value in values]
+        else:
+            dict_bytes = column_schema["dictionary_bytes"]
+            dictionary = data[:dict_bytes].decode("utf-8").split(u"\0")
+            codes = array.array("I")
+            codes.fromstring(data[dict_bytes:])
+            if swap:
+                codes.byteswap()
+            values = [dictionary[code] for code in codes]
+        result[name] = values
+    return result
+
+def crossref_work_to_metadata(work):
+    """
+    Extract the metadata relevant to OpenAPC from a crossref work record.
+
+    Args:
+        work: A dict representing a work in the JSON format of the crossref
+              REST API, as found in crossref metadata dumps.
+    Returns:
+        A tuple (doi, metadata) where metadata is a dict with the keys from
+        CROSSREF_FIELDS. Missing values are None.
+    """
+    metadata = dict.fromkeys(CROSSREF_FIELDS)
+    metadata["publisher"] = work.get("publisher")
+    if work.get("container-title"):
+        metadata["journal_full_title"] = work["container-title"][0]
+    if work.get("ISSN"):
+        metadata["issn"] = work["ISSN"][0]
+    for issn_type in work.get("issn-type", []):
+        if issn_type.get("type") == "print":
+            metadata["issn_print"] = issn_type.get("value")
+        elif issn_type.get("type") == "electronic":
+            metadata["issn_electronic"] = issn_type.get("value")
+    if work.get("license"):
+        metadata["license_ref"] = work["license"][0].get("URL")
+    return (work.get("DOI"), metadata)
+
+def import_crossref_dump(dump_path, store, batch_size=10000):
+    """
+    Import a crossref metadata dump into a CrossrefStore.
+
+    The dump is read as a stream of JSON lines (one work record per line),
+    optionally gzip-compressed (detected by a '.gz' file extension), so
+    memory usage does not depend on the size of the dump.
+
+    Args:
+        dump_path: Path to the dump file.
+        store: A CrossrefStore.
+        batch_size: Number of records to insert per transaction.
+    Returns:
+        The number of imported records.
+    """
+    if dump_path.endswith(".gz"):
+        dump_file = gzip.open(dump_path, "rb")
+    else:
+        dump_file = open(dump_path, "r")
+    count = 0
+    batch = []
+    with dump_file:
+        for line in dump_file:
+            if not line.strip():
+                continue
+            doi, metadata = crossref_work_to_metadata(json.loads(line))
+            if not doi:
+                continue
+            batch.append((doi, metadata))
+            if len(batch) >= batch_size:
+                store.add_many(batch)
+                count += len(batch)
+                batch = []
+    if batch:
+        store.add_many(batch)
+        count += len(batch)
+    return count
+
+def get_metadata_from_crossref(doi_string, store=None):
     """
     Take a DOI and extract metadata relevant to OpenAPC from crossref.
 
@@ -229,6 +1892,8 @@ def get_metadata_from_crossref(doi_string):
         doi_string: A string representing a doi. 'Pure' form (10.xxx),
         DOI Handbook notation (doi:10.xxx) or crossref-style
         (http://dx.doi.org/10.xxx) are all acceptable.
+        store: An optional CrossrefStore. If given, the DOI will be looked
+        up there first and crossref will only be queried if it is not found.
     Returns:
         A dict with a key 'success'. If data extraction was successful,
         'success' will be True and the dict will have a second entry 'data'
@@ -266,6 +1931,10 @@ def get_metadata_from_crossref(doi_string):
         error_msg = u"Parse Error: '{}' is no valid DOI".format(doi_string)
         return {"success": False, "error_msg": error_msg}
     doi = doi_match.groupdict()["doi"]
+    if store is not None:
+        data = store.get(doi)
+        if data is not None:
+            return {"success": True, "data": data}
     url = 'http://data.crossref.org/' + doi
     headers = {"Accept": "application/vnd.crossref.unixsd+xml"}
     req = urllib2.Request(url, None, headers)
@@ -319,6 +1988,113 @@ def get_metadata_from_pubmed(doi):
         ret_value['error_msg'] = "HTTPError: {} - {}".format(code, httpe.reason)
     return ret_value
     
+def get_uts_from_wos(dois, url=WOS_AMR_URL):
+    """
+    Look up Web of Science UT identifiers for a batch of DOIs.
+
+    This method sends a single request for all given DOIs to the Article
+    Match Retrieval (AMR) service of Web of Science. The IP address of the
+    caller has to be registered for the service
+    (http://wokinfo.com/products_tools/products/related/amr/). The service
+    accepts up to WOS_AMR_BATCH_SIZE DOIs per request.
+
+    Args:
+        dois: A list of DOI strings.
+        url: The AMR endpoint, mainly useful for testing.
+    Returns:
+        A dict with a key 'success'. If the request was successful, 'success'
+        will be True and the dict will have a second entry 'data' which maps
+        each DOI to its UT (in the form 'ut:000123456700001') or to None if
+        the DOI was not found.
+
+        If the request failed, 'success' will be False and the dict will
+        contain a second entry 'error_msg' with a string value stating the
+        reason.
+    """
+    namespaces = {"amr": "http://www.isinet.com/xrpc41"}
+    cites = u""
+    for num, doi in enumerate(dois):
+        cites += WOS_AMR_CITE.format(num=num, doi=xml_escape(doi))
+    body = WOS_AMR_REQUEST.format(cites=cites).encode("utf-8")
+    req = urllib2.Request(url, body, {"Content-Type": "application/xml"})
+    ret_value = {'success': True}
+    try:
+        response = urllib2.urlopen(req)
+        root = ET.fromstring(response.read())
+        error = root.find(".//amr:error", namespaces)
+        if error is not None:
+            ret_value['success'] = False
+            ret_value['error_msg'] = "AMR error: {}".format(error.text)
+            return ret_value
+        uts = {}
+        for cite in root.findall("amr:fn/amr:map/amr:map", namespaces):
+            ut = cite.find(".//amr:val[@name='ut']", namespaces)
+            if ut is not None and ut.text:
+                uts[cite.get("name")] = "ut:" + ut.text.strip()
+        ret_value['data'] = {doi: uts.get("cite_" + str(num))
+                             for num, doi in enumerate(dois)}
+    except urllib2.HTTPError as httpe:
+        ret_value['success'] = False
+        code = str(httpe.getcode())
+        ret_value['error_msg'] = "HTTPError: {} - {}".format(code, httpe.reason)
+    except urllib2.URLError as urle:
+        ret_value['success'] = False
+        ret_value['error_msg'] = "URLError: {}".format(urle.reason)
+    except ET.ParseError as pe:
+        ret_value['success'] = False
+        ret_value['error_msg'] = "ParseError: {}".format(pe)
+    return ret_value
+
+def load_doi_ut_mapping(file_path):
+    """
+    Load a DOI to UT mapping file (usually data/doi_ut.csv).
+
+    Returns:
+        A dict mapping normalized DOIs to UTs. UTs may be 'NA' if an earlier
+        lookup did not find the DOI in Web of Science. A missing file is
+        treated as an empty one.
+    """
+    mapping = {}
+    try:
+        with open(file_path, "r") as mapping_file:
+            for row in UnicodeDictReader(mapping_file):
+                if row["doi"] and row["doi"] != u"NA":
+                    mapping[normalize_doi(row["doi"])] = row["ut"]
+    except IOError:
+        pass
+    return mapping
+
+def get_line_terminator(file_path):
+    """
+    Return the line terminator of the first line of a file ('\\r\\n' or
+    '\\n'), None if the file does not exist or is empty.
+    """
+    try:
+        with open(file_path, "rb") as text_file:
+            first_line = text_file.readline()
+    except IOError:
+        return None
+    if not first_line:
+        return None
+    return u"\r\n" if first_line.endswith("\r\n") else u"\n"
+
+def append_doi_ut_mapping(file_path, mappings):
+    """
+    Append (doi, ut) tuples to a DOI to UT mapping file.
+
+    A new file is created with a header. Rows are terminated like the
+    existing lines of the file ('\\n' like data/doi_ut.csv by default).
+    """
+    line_terminator = get_line_terminator(file_path)
+    rows = [[doi, ut] for doi, ut in mappings]
+    if line_terminator is None:
+        line_terminator = u"\n"
+        rows.insert(0, [u"doi", u"ut"])
+    with open(file_path, "ab") as mapping_file:
+        writer = OpenAPCUnicodeWriter(mapping_file, None, False, False,
+                                      line_terminator)
+        writer.write_rows(rows)
+
 def lookup_journal_in_doaj(issn, bypass_cert_verification=False):
     """
     Take an ISSN and check if the corresponding journal exists in DOAJ.
@@ -383,6 +2159,180 @@ def lookup_journal_in_doaj(issn, bypass_cert_verification=False):
         ret_value['error_msg'] = msg.format(ve.message)
     return ret_value
     
+def load_doaj_issns(file_path):
+    """
+    Read all ISSNs from a DOAJ journal list (data/doaj/doajJournalList.csv).
+
+    Returns:
+        A set of normalized ISSNs from the 'ISSN' and 'EISSN' columns.
+    """
+    issns = set()
+    with open(file_path, "r") as doaj_file:
+        for row in UnicodeDictReader(doaj_file):
+            for column in ["ISSN", "EISSN"]:
+                issn = normalize_issn(row.get(column, u""))
+                if issn and issn != u"NA":
+                    issns.add(issn)
+    return issns
+
+class EnrichmentServiceClient(object):
+    """
+    A client for a running enrichment service (see enrichment_service.py).
+
+    The lookup methods have the same signatures and return values as the
+    corresponding module functions, so they can be used as drop-in
+    replacements. Connection errors and invalid responses are reported like
+    failed lookups.
+    """
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+
+    def _request(self, path, params=None, body=None):
+        url = self.url + path
+        if params:
+            encoded = {k: v.encode("utf-8") if isinstance(v, unicode) else v
+                       for k, v in params.iteritems()}
+            url += "?" + urllib.urlencode(encoded)
+        headers = {"Accept": "application/json"}
+        if body is not None:
+            body = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        req = urllib2.Request(url, body, headers)
+        response = urllib2.urlopen(req)
+        return json.loads(response.read())
+
+    def _lookup(self, path, params, success_key):
+        try:
+            return self._request(path, params)
+        except urllib2.HTTPError as httpe:
+            msg = "Enrichment service error: {} - {}"
+            reason = httpe.reason
+            try:
+                # Failed lookups are reported with a JSON body
+                reason = json.loads(httpe.read())["error_msg"]
+            except (ValueError, KeyError, TypeError):
+                pass
+            return {success_key: False,
+                    "error_msg": msg.format(httpe.getcode(), reason)}
+        except urllib2.URLError as urle:
+            msg = "Enrichment service not reachable: {}"
+            return {success_key: False, "error_msg": msg.format(urle.reason)}
+        except (httplib.HTTPException, socket.error) as e:
+            msg = "Enrichment service connection failed: {}"
+            return {success_key: False, "error_msg": msg.format(repr(e))}
+        except ValueError as ve:
+            msg = "Invalid response from the enrichment service: {}"
+            return {success_key: False, "error_msg": msg.format(ve)}
+
+    def get_metadata_from_crossref(self, doi_string):
+        return self._lookup("/crossref", {"doi": doi_string}, "success")
+
+    def get_metadata_from_pubmed(self, doi):
+        return self._lookup("/pubmed", {"doi": doi}, "success")
+
+    def lookup_journal_in_doaj(self, issn, bypass_cert_verification=False):
+        return self._lookup("/doaj", {"issn": issn}, "data_received")
+
+    def batch(self, crossref=None, pubmed=None, doaj=None):
+        """
+        Look up many DOIs and ISSNs in a single request.
+
+        Returns:
+            A dict with the keys 'crossref', 'pubmed' and 'doaj', each mapping
+            the requested DOIs/ISSNs to their lookup results.
+        """
+        body = {"crossref": crossref or [], "pubmed": pubmed or [],
+                "doaj": doaj or []}
+        return self._request("/batch", body=body)
+
+    def submit_job(self, csv_file, options=None):
+        """
+        Start an enrichment job for a CSV file on the service host.
+
+        Returns:
+            A dict describing the job, including its 'id'.
+        """
+        body = {"csv_file": csv_file, "options": options or []}
+        return self._request("/jobs", body=body)
+
+    def get_job(self, job_id):
+        return self._request("/jobs/" + str(job_id))
+
+    def get_stats(self):
+        return self._request("/stats")
+
+def lookup_concurrently(lookup, keys, workers=8):
+    """
+    Run a lookup function for many keys using a bounded pool of threads.
+
+    Args:
+        lookup: A function taking a single key and returning a result dict
+                with a key 'success' (like get_metadata_from_crossref).
+        keys: An iterable of keys (DOIs, for example).
+        workers: The maximum number of concurrent lookups.
+    Returns:
+        A generator of (key, result) tuples, in order of completion.
+        Network errors, invalid responses and unparsable data are reported
+        as failed results, so a single key cannot abort the other lookups.
+        Keys are consumed lazily, lookups start before an iterator of keys
+        is exhausted.
+    """
+    def run(key):
+        try:
+            return key, lookup(key)
+        except IOError as ioe:
+            msg = u"Lookup failed: {}".format(getattr(ioe, "reason", ioe))
+        except ET.ParseError as pe:
+            msg = u"Lookup failed, invalid XML response: {}".format(pe)
+        except httplib.HTTPException as he:
+            msg = u"Lookup failed, invalid HTTP response: {}".format(repr(he))
+        except ValueError as ve:
+            msg = u"Lookup failed: {}".format(ve)
+        return key, {"success": False, "error_msg": msg}
+    pool = ThreadPool(workers)
+    try:
+        for key_result in pool.imap_unordered(run, keys):
+            yield key_result
+    finally:
+        pool.terminate()
+
+def bulk_lookup(lookup, file_name, workers=8, key_name="doi"):
+    """
+    Look up the keys in a file concurrently and print the results.
+
+    Used by the bulk modes of crossref_test.py and pubmed_test.py. Every
+    result is printed as a JSON object on a single line as soon as it
+    arrives, the key is added to it under key_name.
+
+    Args:
+        lookup: A lookup function (see lookup_concurrently).
+        file_name: A file with one key per line, '-' for stdin. Lookups
+                   start while the file is still being read, so results are
+                   printed for keys piped in by a running process.
+        workers: The maximum number of concurrent lookups.
+        key_name: The name of the key in the printed JSON objects.
+    """
+    def read_keys(key_file):
+        seen = set()
+        # readline instead of iteration, which reads ahead on pipes
+        for line in iter(key_file.readline, ""):
+            key = line.decode("utf-8").strip()
+            if key and key not in seen:
+                seen.add(key)
+                yield key
+    key_file = sys.stdin if file_name == "-" else open(file_name, "r")
+    try:
+        for key, res in lookup_concurrently(lookup, read_keys(key_file),
+                                            workers):
+            record = OrderedDict([(key_name, key)])
+            record.update(res)
+            print json.dumps(record)
+            sys.stdout.flush()
+    finally:
+        if key_file is not sys.stdin:
+            key_file.close()
+
 def get_column_type_from_whitelist(column_name):
     """
     Identify a CSV column type by looking up the name in a whitelist.
@@ -393,28 +2343,9 @@ def get_column_type_from_whitelist(column_name):
         An APC-normed column type (as a string) if the column name was found in
         a whitelist, None otherwise.
     """
-    column_names = {
-        "institution": ["institution"],
-        "doi": ["doi"],
-        "euro": ["apc", "kosten", "cost", "euro", "eur"],
-        "period": ["period", "jahr"],
-        "is_hybrid": ["is_hybrid"],
-        "publisher": ["publisher"],
-        "journal_full_title": ["journal_full_title", "journal", "journal title"],
-        "issn": ["issn"],
-        "issn_print": ["issn_print"],
-        "issn_electronic": ["issn_electronic"],
-        "license_ref": ["license_ref"],
-        "indexed_in_crossref": ["indexed_in_crossref"],
-        "pmid": ["pmid"],
-        "pmcid": ["pmcid"],
-        "ut": ["ut"],
-        "url": ["url"],
-        "doaj": ["doaj"]
-    }
-    for key, whitelist in column_names.iteritems():
-        if column_name.lower() in whitelist:
-            return key
+    for column in OPENAPC_SCHEMA:
+        if column_name.lower() in column.aliases:
+            return column.name
     return None
     
 def get_unified_publisher_name(publisher):
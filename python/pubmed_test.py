@@ -5,18 +5,41 @@
 Look up a DOI in PubMed.
 
 This script looks up a DOI in pubmed.
+
+In bulk mode (-f), DOIs are read from a file or stdin and looked up
+concurrently. Every result is printed as a JSON object on a single line as
+soon as it arrives.
 """
 
 import argparse
 
+from openapc_toolkit import bulk_lookup
+from openapc_toolkit import EnrichmentServiceClient
 from openapc_toolkit import get_metadata_from_pubmed as gmfp
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("doi", help="A DOI to look up in pubmed.")
+    parser.add_argument("doi", nargs="?", help="A DOI to look up in pubmed.")
+    parser.add_argument("-f", "--file", help="Look up all DOIs in a file " +
+                        "(one per line, '-' for stdin) and print the results " +
+                        "as JSON lines in the order they arrive.")
+    parser.add_argument("-w", "--workers", type=int, default=8,
+                        help="Number of concurrent lookups in bulk mode " +
+                        "(default: 8)")
+    parser.add_argument("-s", "--service", help="The URL of a running " +
+                        "enrichment service (see enrichment_service.py) to " +
+                        "send the lookup to.")
     args = parser.parse_args()
 
-    res = gmfp(args.doi)
+    lookup = gmfp
+    if args.service:
+        lookup = EnrichmentServiceClient(args.service).get_metadata_from_pubmed
+    if args.file:
+        bulk_lookup(lookup, args.file, args.workers)
+        return
+    if not args.doi:
+        parser.error("Either a DOI or a file (-f) is required.")
+    res = lookup(args.doi)
     if res["success"]:
         for key, value in res["data"].iteritems():
             print key, ":", value
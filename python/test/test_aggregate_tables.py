@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import random
+
+from aggregate_tables import AggregateEngine
+
+HEADER = (u'"institution","period","euro","doi","is_hybrid","publisher",' +
+          u'"journal_full_title"\n')
+
+def _row(number):
+    return {"institution": u"Uni " + u"ABC"[number % 3],
+            "period": unicode(2013 + number % 4),
+            "euro": unicode(500 + (number * 37) % 1500),
+            "doi": u"10.1234/{}".format(number),
+            "is_hybrid": u"TRUE" if number % 5 == 0 else u"FALSE",
+            "publisher": u"Publisher " + unicode(number % 7),
+            "journal_full_title": u"Journal " + unicode(number % 11)}
+
+def _line(row):
+    columns = ["institution", "period", "euro", "doi", "is_hybrid",
+               "publisher", "journal_full_title"]
+    return u",".join(u'"{}"'.format(row[column]) for column in columns) + u"\n"
+
+def _build(rows):
+    engine = AggregateEngine()
+    for row in rows:
+        engine.add_row(row)
+    return engine
+
+def _tables(engine):
+    return {name: engine.get_table(name) for name in engine.tables}
+
+def test_add_and_remove_rows():
+    rows = [_row(number) for number in range(200)]
+    engine = _build(rows[:150])
+    for row in rows[150:]:
+        engine.add_row(row)
+    assert _tables(engine) == _tables(_build(rows))
+
+    removed = random.Random(42).sample(rows, 80)
+    for row in removed:
+        engine.remove_row(row)
+    remaining = [row for row in rows if row not in removed]
+    assert _tables(engine) == _tables(_build(remaining))
+    # Empty groups disappear
+    for row in remaining:
+        engine.remove_row(row)
+    assert _tables(engine) == {name: [] for name in engine.tables}
+
+def test_incremental_update_from_csv(tmpdir):
+    rows = [_row(number) for number in range(60)]
+    csv_file = tmpdir.join("apc.csv")
+    csv_file.write_text(HEADER + u"".join(_line(row) for row in rows[:40]),
+                        "utf-8")
+    state_path = str(tmpdir.join("state.json"))
+    engine = AggregateEngine()
+    assert engine.update_from_csv(str(csv_file)) == 40
+    engine.save(state_path)
+    # Appended rows and an incomplete last line
+    csv_file.write_text(HEADER + u"".join(_line(row) for row in rows) +
+                        u'"Uni A","2015"', "utf-8")
+    engine = AggregateEngine.load(state_path)
+    assert engine.update_from_csv(str(csv_file)) == 20
+    full = AggregateEngine()
+    full.update_from_csv(str(csv_file))
+    assert _tables(engine) == _tables(full) == _tables(_build(rows))
+    # Changed content triggers a full recomputation
+    csv_file.write_text(HEADER + u"".join(_line(row) for row in rows[1:]),
+                        "utf-8")
+    assert engine.update_from_csv(str(csv_file)) == 59
+    assert _tables(engine) == _tables(_build(rows[1:]))
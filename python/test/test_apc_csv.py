@@ -1,7 +1,9 @@
+import os
 import pytest
 import re
 
 import openapc_toolkit as oat
+import validation_index
 
 # A Whitelist for denoting publisher identity (Possible consequence of business buy outs or fusions)
 # If one publisher name is stored in the left list of an entry and another in the right one,
@@ -12,16 +14,42 @@ PUBLISHERS_WHITELIST = [
     (["Pion Ltd"], ["SAGE Publications"])
 ]
 
-csv_file = open("data/apc_de.csv", "r")
-reader = oat.UnicodeDictReader(csv_file)
-apc_data = []
-doi_list = []
-for row in reader:
-    apc_data.append(row)
-    doi_list.append(row["doi"])
+ISSN_COLUMN_NAMES = ["ISSN", "Print ISSN", "Electronic ISSN"]
 
 def has_value(field):
     return len(field) > 0 and field != "NA"
+
+# ISSNs are compared by their ISSN-L (or in normalized form if the ISSN-L
+# table is not available), so spelling variants do not hide inconsistencies
+ISSNL_TABLE = "data/issn_l.tsv"
+issnl_index = oat.load_issnl_index(ISSNL_TABLE)
+cache_tag = ""
+if os.path.isfile(ISSNL_TABLE):
+    stat = os.stat(ISSNL_TABLE)
+    cache_tag = "-issnl-{}-{}".format(stat.st_size, int(stat.st_mtime))
+
+# With OPENAPC_CHANGED_SINCE set to a git revision, only rows added or
+# modified since then are tested (see validation_index.py)
+change_scope = None
+changed_since = os.environ.get(validation_index.ENV_VARIABLE)
+if changed_since:
+    change_scope = validation_index.load_change_scope(
+        "data/apc_de.csv", changed_since, issnl_index.get_issn_l, cache_tag)
+    if change_scope is None:
+        print ("Changes since {} cannot be validated in isolation, " +
+               "validating all rows.").format(changed_since)
+
+if change_scope is not None:
+    apc_data = [row for _, row in change_scope.rows]
+    apc_ids = ["line{}".format(line_num) for line_num, _ in change_scope.rows]
+    apc_index = change_scope.index
+else:
+    with open("data/apc_de.csv", "r") as csv_file:
+        apc_data = list(oat.UnicodeRecordReader(csv_file))
+    apc_ids = None
+    apc_index = validation_index.ValidationIndex(issnl_index.get_issn_l)
+    for row in apc_data:
+        apc_index.update(row)
     
 def in_whitelist(first_publisher, second_publisher):
     for entry in PUBLISHERS_WHITELIST:
@@ -31,12 +59,12 @@ def in_whitelist(first_publisher, second_publisher):
             return True
     return False
 
-@pytest.mark.parametrize("row", apc_data)
+@pytest.mark.parametrize("row", apc_data, ids=apc_ids)
 class TestAPCRows(object):
     
     # Set of tests to run on every single row
     def test_row_format(self, row):
-        assert len(row) == 17, 'row must consist of exactly 17 items'
+        assert len(row) == len(oat.OPENAPC_COLUMNS), 'row must consist of exactly {} items'.format(len(oat.OPENAPC_COLUMNS))
         assert row['doaj'] in ["TRUE", "FALSE"], 'value in row "doaj" must either be TRUE or FALSE'
         assert row['indexed_in_crossref'] in ["TRUE", "FALSE"], 'value in row "indexed_in_crossref" must either be TRUE or FALSE'
         assert row['is_hybrid'] in ["TRUE", "FALSE"], 'value in row "is_hybrid" must either be TRUE or FALSE'
@@ -50,22 +78,15 @@ class TestAPCRows(object):
     def test_doi_duplicates(self, row):
         doi = row["doi"]
         if doi and doi != "NA":
-            doi_list.remove(doi)
-            assert doi not in doi_list, 'Duplicate: A DOI was encountered more than one time'
+            assert apc_index.doi_count(doi) == 1, 'Duplicate: A DOI was encountered more than one time'
             
     def test_name_consistency(self, row):
-        issn = row["issn"] if has_value(row["issn"]) else None
-        issn_p = row["issn_print"] if has_value(row["issn_print"]) else None
-        issn_e = row["issn_electronic"] if has_value(row["issn_electronic"]) else None
         journal_full_title = row["journal_full_title"]
         publisher = row["publisher"]
-        for other_row in apc_data:
-            if issn is not None and other_row["issn"] == issn:
-                assert other_row["publisher"] == publisher or in_whitelist(publisher, other_row["publisher"]), 'Two entries share a common ISSN, but the publisher name differs'
-                assert other_row["journal_full_title"] == journal_full_title, 'Two entries share a common ISSN, but the journal title differs'
-            elif issn_p is not None and other_row["issn_print"] == issn_p:
-                assert other_row["publisher"] == publisher or in_whitelist(publisher, other_row["publisher"]), 'Two entries share a common Print ISSN, but the publisher name differs'
-                assert other_row["journal_full_title"] == journal_full_title, 'Two entries share a common Print ISSN, but the journal title differs'
-            elif issn_e is not None and other_row["issn_electronic"] == issn_e:
-                assert other_row["publisher"] == publisher or in_whitelist(publisher, other_row["publisher"]), 'Two entries share a common Electronic ISSN, but the publisher name differs'
-                assert other_row["journal_full_title"] == journal_full_title, 'Two entries share a common Electronic ISSN, but the journal title differs'
+        for column, key in enumerate(apc_index.get_issn_keys(row)):
+            if key is None:
+                continue
+            issn_name = ISSN_COLUMN_NAMES[column]
+            for other_publisher, other_title in apc_index.get_journals(column, key):
+                assert other_publisher == publisher or in_whitelist(publisher, other_publisher), 'Two entries share a common {}, but the publisher name differs'.format(issn_name)
+                assert other_title == journal_full_title, 'Two entries share a common {}, but the journal title differs'.format(issn_name)
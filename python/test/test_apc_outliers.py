@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import apc_outliers
+
+def _row(euro, journal, publisher="Publisher A"):
+    return {"euro": euro, "journal_full_title": journal,
+            "publisher": publisher, "doi": "10.1000/test",
+            "institution": "Test U"}
+
+REFERENCE = ([_row(str(1000 + i * 10), "Journal A") for i in range(10)] +
+             [_row("2000", "Journal B", "Publisher B") for _ in range(3)] +
+             [_row(str(1500 + i), "Journal C", "Publisher B")
+              for i in range(5)])
+
+def test_journal_outliers():
+    detector = apc_outliers.OutlierDetector(REFERENCE)
+    rows = [_row("1040", "Journal A"), _row("104000", "Journal A"),
+            _row("NA", "Journal A")]
+    outliers = detector.find_outliers(rows)
+    assert [(index, basis) for index, _, _, basis in outliers] == \
+           [(1, "journal")]
+    assert outliers[0][2] == 1045.0
+
+def test_publisher_fallback():
+    detector = apc_outliers.OutlierDetector(REFERENCE)
+    # Journal B has too few reference values, Journal D is unknown
+    rows = [_row("2000", "Journal B", "Publisher B"),
+            _row("9000", "Journal D", "Publisher B"),
+            _row("9000", "Journal D", "Publisher C")]
+    scores, medians, basis = detector.score(rows)
+    assert list(basis) == ["publisher", "publisher", ""]
+    assert np.isnan(scores[2])
+    assert [o[0] for o in detector.find_outliers(rows)] == [1]
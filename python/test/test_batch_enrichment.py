@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import batch_enrichment
+
+def test_expand_inputs(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    for path in ["data/uni/apc_2015.csv", "data/uni/apc_2016.csv",
+                 "data/unikassel/apc_2015.csv"]:
+        tmpdir.join(path).write("a", ensure=True)
+    tmpdir.join("data/uni/apc_dir.csv").ensure(dir=True)
+    inputs = batch_enrichment.expand_inputs(["data/*/apc_2015.csv",
+                                             "data/uni/*.csv",
+                                             "data/missing/*.csv"])
+    assert inputs == ["data/uni/apc_2015.csv", "data/uni/apc_2016.csv",
+                      "data/unikassel/apc_2015.csv"]
+
+def test_get_output_paths(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    outputs = batch_enrichment.get_output_paths(
+        ["data/uni/apc_2015.csv", "data/unikassel/apc_2015.csv"], "out")
+    assert outputs == {"data/uni/apc_2015.csv": "out/uni/apc_2015.csv",
+                       "data/unikassel/apc_2015.csv":
+                           "out/unikassel/apc_2015.csv"}
+    # Common prefixes of file names are no directories
+    outputs = batch_enrichment.get_output_paths(
+        ["data/uni/apc.csv", "data/uni/apc_2016.csv"], "out")
+    assert outputs == {"data/uni/apc.csv": "out/apc.csv",
+                       "data/uni/apc_2016.csv": "out/apc_2016.csv"}
+    outputs = batch_enrichment.get_output_paths(
+        ["data/uni/a/apc.csv", "data/uni/a/b/apc.csv", "data/uni/apc.csv"],
+        "out")
+    assert sorted(outputs.values()) == ["out/a/apc.csv", "out/a/b/apc.csv",
+                                        "out/apc.csv"]
+    assert (batch_enrichment.get_output_paths(["apc.csv"], "out") ==
+            {"apc.csv": "out/apc.csv"})
+    assert (batch_enrichment.get_output_paths(["/apc.csv", "/tmp/a.csv"],
+                                              "out") ==
+            {"/apc.csv": "out/apc.csv", "/tmp/a.csv": "out/tmp/a.csv"})
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import os
+import sys
+
+import csv_diff
+import openapc_toolkit as oat
+
+HEADER = [u"institution", u"period", u"euro", u"doi", u"journal_full_title",
+          u"issn", u"url"]
+
+def _write_csv(tmpdir, name, rows):
+    path = str(tmpdir.join(name))
+    with open(path, "w") as csv_file:
+        writer = oat.OpenAPCUnicodeWriter(csv_file)
+        writer.write_rows([HEADER] + rows)
+    return path
+
+def _rows(count):
+    return [[u"Uni A", u"2015", unicode(1000 + i), u"10.1234/{}".format(i),
+             u"Jöurnal", u"1234-5678", u"NA"] for i in range(count)]
+
+def _diff(tmpdir, old_rows, new_rows, chunk_size=4, fan_in=2):
+    old_path = _write_csv(tmpdir, "old.csv", old_rows)
+    new_path = _write_csv(tmpdir, "new.csv", new_rows)
+    temp_dir = str(tmpdir.mkdir("runs"))
+    results = list(csv_diff.diff_files(old_path, new_path, temp_dir,
+                                       chunk_size, fan_in))
+    # All runs are removed after merging
+    assert os.listdir(temp_dir) == []
+    return [result for result in results if result[0] != "unchanged"]
+
+def test_get_row_key():
+    row = {"doi": u" http://dx.doi.org/10.1234/ABC", "institution": u"Uni A"}
+    assert csv_diff.get_row_key(row) == u"doi:10.1234/abc"
+    row = {"doi": u"NA", "institution": u"Uni A", "period": u"2015",
+           "issn": u"12345679", "url": u"http://example.org"}
+    assert (csv_diff.get_row_key(row) ==
+            u"row:Uni A|2015|1234-5679|http://example.org")
+
+def test_external_sort(tmpdir):
+    rows = _rows(23)
+    rows.reverse()
+    path = _write_csv(tmpdir, "apc.csv", rows)
+    temp_dir = str(tmpdir.mkdir("runs"))
+    # 6 runs and a fan-in of 2 need several merge passes
+    sorter = csv_diff.ExternalSorter(temp_dir, chunk_size=4, fan_in=2)
+    header, entries = sorter.sort(path)
+    entries = list(entries)
+    assert header == HEADER
+    assert [entry[0] for entry in entries] == sorted(
+        u"doi:10.1234/{}".format(i) for i in range(23))
+    assert entries[0][1:] == (24, rows[-1])
+    assert os.listdir(temp_dir) == []
+
+def test_diff_reordered(tmpdir):
+    rows = _rows(10)
+    assert _diff(tmpdir, rows, list(reversed(rows))) == []
+
+def test_diff_changes(tmpdir):
+    old_rows = _rows(10)
+    new_rows = [list(row) for row in old_rows[1:]]
+    new_rows[0][2] = u"999"
+    # Quotes and line breaks survive the temporary files
+    new_rows[4][4] = u'The "Jöurnal",\r\nof X'
+    new_rows.append([u"Uni B", u"2016", u"500", u"NA", u"Journal Y", u"NA",
+                     u"http://example.org"])
+    changes = _diff(tmpdir, old_rows, new_rows)
+    assert [(change, key) for change, key, _, _, _ in changes] == [
+        ("removed", u"doi:10.1234/0"),
+        ("changed", u"doi:10.1234/1"),
+        ("changed", u"doi:10.1234/5"),
+        ("added", u"row:Uni B|2016|journal y|http://example.org")
+    ]
+    assert changes[1][4] == [(u"euro", u"1001", u"999")]
+    assert changes[2][4] == [(u"journal_full_title", u"Jöurnal",
+                              u'The "Jöurnal",\r\nof X')]
+    assert changes[2][3][1] == 6
+
+def test_diff_duplicate_keys(tmpdir):
+    row = _rows(1)[0]
+    changes = _diff(tmpdir, [row], [row, row])
+    assert [(change, new[1]) for change, _, _, new, _ in changes] == [
+        ("added", 3)]
+
+def test_diff_reordered_duplicate_keys(tmpdir):
+    rows = _rows(3)
+    for institution in [u"Uni B", u"Uni C"]:
+        rows.append([institution] + rows[1][1:])
+    new_rows = list(reversed(rows))
+    new_rows[0] = [u"Uni D"] + new_rows[0][1:]
+    changes = _diff(tmpdir, rows, new_rows)
+    assert [(change, key, old[1], new[1], fields)
+            for change, key, old, new, fields in changes] == [
+        ("changed", u"doi:10.1234/1", 6, 2,
+         [(u"institution", u"Uni C", u"Uni D")])]
+
+def test_report_file(tmpdir, monkeypatch):
+    old_rows = _rows(3)
+    new_rows = [list(row) for row in old_rows[1:]]
+    new_rows[0][2] = u"999"
+    new_rows[0][6] = u"http://example.org"
+    old_path = _write_csv(tmpdir, "old.csv", old_rows)
+    new_path = _write_csv(tmpdir, "new.csv", new_rows)
+    report_path = str(tmpdir.join("changes.csv"))
+    monkeypatch.setattr(sys, "argv", ["csv_diff.py", old_path, new_path,
+                                      "-o", report_path, "-q"])
+    csv_diff.main()
+    with open(report_path, "r") as report_file:
+        report = list(oat.UnicodeReader(report_file))
+    assert report == [
+        csv_diff.REPORT_HEADER,
+        [u"removed", u"doi:10.1234/0", u"2", u"", u"", u"", u""],
+        [u"changed", u"doi:10.1234/1", u"3", u"2", u"euro", u"1001", u"999"],
+        [u"changed", u"doi:10.1234/1", u"3", u"2", u"url", u"NA",
+         u"http://example.org"]
+    ]
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import sys
+
+import doaj_refresh
+
+HEADER = (u'"institution","period","euro","doi","is_hybrid","publisher",' +
+          u'"journal_full_title","issn","issn_print","issn_electronic",' +
+          u'"license_ref","indexed_in_crossref","pmid","pmcid","ut","url",' +
+          u'"doaj"\n')
+
+ROWS = [
+    # Journal added to DOAJ, the title spans two lines
+    u'"Uni A",2015,1000,"10.1234/1",FALSE,"P","Journal\nof X","1234-5679",' +
+    u'NA,NA,NA,TRUE,NA,NA,NA,NA,FALSE\n',
+    # Journal removed from DOAJ, the URL contains commas
+    u'"Uni B",2015,1200,"10.1234/2",FALSE,"P, Inc.","Journal of Y",' +
+    u'"2049-3630",NA,NA,NA,TRUE,NA,NA,NA,"http://example.org/a,b,c",TRUE\n',
+    # Unaffected
+    u'"Uni C",2016,900,"10.1234/3",FALSE,"P","Journal of Z","0378-5955",NA,' +
+    u'NA,NA,TRUE,NA,NA,NA,NA,FALSE\n'
+]
+
+DOAJ_HEADER = u'"Title","ISSN","EISSN"\n'
+
+def _run(monkeypatch, tmpdir, old_issns, new_issns):
+    tmpdir.join("old.csv").write(DOAJ_HEADER + u"".join(
+        u'"J","{}",""\n'.format(issn) for issn in old_issns))
+    tmpdir.join("new.csv").write(DOAJ_HEADER + u"".join(
+        u'"J","{}",""\n'.format(issn) for issn in new_issns))
+    argv = ["doaj_refresh.py", str(tmpdir.join("old.csv")),
+            str(tmpdir.join("new.csv")), "-c", str(tmpdir.join("apc.csv")),
+            "-x", str(tmpdir.join("apc.idx"))]
+    monkeypatch.setattr(sys, "argv", argv)
+    doaj_refresh.main()
+
+def test_refresh(tmpdir, monkeypatch):
+    csv_file = tmpdir.join("apc.csv")
+    csv_file.write_text(HEADER + u"".join(ROWS), "utf-8")
+    _run(monkeypatch, tmpdir, ["2049-3630", "0378-5955"],
+         ["1234-5679", "0378-5955"])
+    expected = (HEADER + ROWS[0].replace(u"NA,FALSE\n", u"NA,TRUE\n") +
+                ROWS[1].replace(u",TRUE\n", u",FALSE\n") + ROWS[2])
+    assert csv_file.read_text("utf-8") == expected
+
+def test_no_changes(tmpdir, monkeypatch):
+    csv_file = tmpdir.join("apc.csv")
+    csv_file.write_text(HEADER + u"".join(ROWS), "utf-8")
+    mtime = csv_file.mtime()
+    # 0378-5955 was removed, but the row is not in DOAJ anyway
+    _run(monkeypatch, tmpdir, ["2049-3630", "0378-5955"], ["2049-3630"])
+    assert csv_file.read_text("utf-8") == HEADER + u"".join(ROWS)
+    assert csv_file.mtime() == mtime
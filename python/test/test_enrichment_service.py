@@ -0,0 +1,147 @@
+# -*- coding: UTF-8 -*-
+
+import os
+import socket
+import threading
+import time
+import urllib2
+import xml.etree.ElementTree as ET
+
+import pytest
+
+import enrichment_service as es
+import openapc_toolkit as oat
+
+METADATA = {"publisher": u"MDPI AG", "journal_full_title": u"Chemosensors",
+            "issn": u"2227-9040", "issn_print": None,
+            "issn_electronic": u"2227-9040", "license_ref": None}
+
+@pytest.fixture
+def client(tmpdir):
+    store_path = str(tmpdir.join("crossref.db"))
+    store = oat.CrossrefStore(store_path)
+    store.add_many([(u"10.3390/chemosensors3010001", METADATA)])
+    store.close()
+    doaj_list = tmpdir.join("doaj.csv")
+    doaj_list.write("Journal title,ISSN,EISSN\nChemosensors,,2227-9040\n")
+    service = es.EnrichmentService(store_path, str(doaj_list),
+                                   str(tmpdir.join("jobs")))
+    server = es.EnrichmentServer(("127.0.0.1", 0), service)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield oat.EnrichmentServiceClient(service.url)
+    server.shutdown()
+    server.server_close()
+
+def test_lookups(client):
+    for _ in range(2):
+        res = client.get_metadata_from_crossref(u"doi:10.3390/CHEMOSENSORS3010001")
+        assert res == {"success": True, "data": METADATA}
+    stats = client.get_stats()
+    assert (stats["requests"], stats["hits"]) == (2, 1)
+
+    res = client.get_metadata_from_crossref(u"no doi")
+    assert not res["success"]
+    assert "Parse Error" in res["error_msg"]
+
+    res = client.lookup_journal_in_doaj(u"2227-9040")
+    assert res == {"data_received": True,
+                   "data": {"in_doaj": True, "title": u""}}
+    res = client.batch(doaj=[u"2227-9040", u"1234-5678"])
+    assert res["doaj"][u"1234-5678"]["data"] == {"in_doaj": False}
+    assert res["crossref"] == {} and res["pubmed"] == {}
+
+def test_unreachable_service():
+    client = oat.EnrichmentServiceClient("http://127.0.0.1:1")
+    res = client.lookup_journal_in_doaj(u"2227-9040")
+    assert not res["data_received"]
+    assert "not reachable" in res["error_msg"]
+
+def test_job_paths(tmpdir, monkeypatch):
+    calls = []
+    def call(command, cwd, **kwargs):
+        calls.append((command, cwd))
+        return 0
+    monkeypatch.setattr(es.subprocess, "call", call)
+    monkeypatch.chdir(tmpdir)
+    tmpdir.join("apc.csv").write("institution,period,euro\n")
+    service = es.EnrichmentService(jobs_dir="jobs")
+    service.url = "http://127.0.0.1:1"
+    job = service.submit_job("apc.csv", ["--no-journal-kb"])
+    while service.get_job(job["id"])["status"] == "running":
+        time.sleep(0.01)
+    command, cwd = calls[0]
+    # The defaults of apc_csv_processing.py resolve in the repository
+    assert cwd == es.REPO_DIR
+    assert os.path.isfile(os.path.join(cwd, "python", "apc_csv_processing.py"))
+    job_dir = str(tmpdir.join("jobs", "1"))
+    assert command[2] == str(tmpdir.join("apc.csv"))
+    assert command[command.index("-o") + 1] == os.path.join(job_dir, "out.csv")
+    assert (command[command.index("-r") + 1] ==
+            os.path.join(job_dir, "review.csv"))
+    assert command[-1] == "--no-journal-kb"
+    assert service.get_job(job["id"])["status"] == "finished"
+
+def test_failing_lookup(client, monkeypatch):
+    def lookup(doi, crossref_store=None):
+        raise ET.ParseError("not well-formed (invalid token)")
+    monkeypatch.setattr(es.oat, "get_metadata_from_crossref", lookup)
+    monkeypatch.setattr(es.oat, "get_metadata_from_pubmed", lookup)
+    res = client.get_metadata_from_crossref(u"10.1234/abc")
+    assert not res["success"]
+    assert "500" in res["error_msg"] and "ParseError" in res["error_msg"]
+    res = client.batch(pubmed=[u"10.1234/abc"])
+    assert not res["pubmed"][u"10.1234/abc"]["success"]
+    # The service keeps working
+    assert client.lookup_journal_in_doaj(u"2227-9040")["data_received"]
+
+def test_broken_connection():
+    # A server closing connections without a response
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+    def serve():
+        connection = server.accept()[0]
+        connection.recv(1024)
+        connection.close()
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    client = oat.EnrichmentServiceClient(
+        "http://127.0.0.1:{}".format(server.getsockname()[1]))
+    res = client.get_metadata_from_pubmed(u"10.1234/abc")
+    assert not res["success"]
+    assert "connection failed" in res["error_msg"]
+    server.close()
+
+@pytest.mark.parametrize("options", [
+    ["-o", "/tmp/elsewhere.csv"],
+    ["-o/tmp/elsewhere.csv"],
+    ["--output=/tmp/elsewhere.csv"],
+    ["--rev", "/tmp/review.csv"],
+    ["-y", "--service", "http://example.org"],
+    ["--doi-ut-file", "/tmp/doi_ut.csv"],
+    ["--save-profile"]
+])
+def test_reserved_job_options(tmpdir, options):
+    tmpdir.join("apc.csv").write("institution,period,euro\n")
+    service = es.EnrichmentService(jobs_dir=str(tmpdir.join("jobs")))
+    with pytest.raises(ValueError) as excinfo:
+        service.submit_job(str(tmpdir.join("apc.csv")), options)
+    assert "cannot be set for jobs" in str(excinfo.value)
+    assert service.get_stats()["jobs"] == 0
+
+def test_rejected_job_request(client, tmpdir):
+    tmpdir.join("apc.csv").write("institution,period,euro\n")
+    with pytest.raises(urllib2.HTTPError) as excinfo:
+        client.submit_job(str(tmpdir.join("apc.csv")), ["-o", "/tmp/x.csv"])
+    assert excinfo.value.getcode() == 400
+
+def test_get_reserved_option():
+    assert es.get_reserved_option("--out") == "--output"
+    assert es.get_reserved_option("-r") == "-r"
+    # Options which are only similar
+    for arg in ["--outliers", "--journal-kb-source", "--no-journal-kb",
+                "-y", "--"]:
+        assert es.get_reserved_option(arg) is None
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import sys
+
+import apc_csv_processing as acp
+import openapc_toolkit as oat
+
+SOURCE_TYPES = ["institution", "period", "euro", "doi"]
+
+def _row(**values):
+    row = {column: u"NA" for column in oat.OPENAPC_COLUMNS}
+    row.update(values)
+    return oat.OpenAPCRecord([row[column] for column in oat.OPENAPC_COLUMNS])
+
+def test_row_fingerprint():
+    row = _row(institution=u"Uni A", period=u"2015", euro=u"1000",
+               doi=u"10.1234/abc")
+    fingerprint = acp.get_row_fingerprint(row, SOURCE_TYPES)
+    same = _row(institution=u"Uni A", period=u"2015", euro=u"1000",
+                doi=u"10.1234/abc", publisher=u"Enriched Publisher")
+    assert acp.get_row_fingerprint(same, SOURCE_TYPES) == fingerprint
+    changed = _row(institution=u"Uni A", period=u"2015", euro=u"1001",
+                   doi=u"10.1234/abc")
+    assert acp.get_row_fingerprint(changed, SOURCE_TYPES) != fingerprint
+    # Values are separated, so shifting characters between columns matters
+    shifted = _row(institution=u"Uni A2", period=u"015", euro=u"1000",
+                   doi=u"10.1234/abc")
+    assert acp.get_row_fingerprint(shifted, SOURCE_TYPES) != fingerprint
+    # A different column mapping invalidates all fingerprints
+    assert acp.get_row_fingerprint(row, SOURCE_TYPES[:3]) != fingerprint
+
+def _write_output(path, rows):
+    with open(path, "w") as out:
+        writer = oat.OpenAPCUnicodeWriter(out, oat.OPENAPC_QUOTEMASK)
+        writer.write_rows([list(oat.OPENAPC_COLUMNS)] + rows)
+
+def test_load_previous_output(tmpdir):
+    row = _row(institution=u"Uni A", period=u"2015", euro=u"1000",
+               doi=u"10.1234/ABC", publisher=u"Enriched Publisher")
+    path = str(tmpdir.join("out.csv"))
+    _write_output(path, [row])
+    # Without a fingerprint file, fingerprints are computed from the output
+    rows, dois = acp.load_previous_output(path, SOURCE_TYPES)
+    fingerprint = acp.get_row_fingerprint(row, SOURCE_TYPES)
+    assert rows.keys() == [fingerprint]
+    assert rows[fingerprint]["publisher"] == u"Enriched Publisher"
+    assert dois == set([u"10.1234/abc"])
+    # The fingerprint file holds the fingerprints of the source values,
+    # which can differ from the output (for example a normalised euro)
+    tmpdir.join("out.csv" + acp.FINGERPRINT_SUFFIX).write("abc\n")
+    rows, _ = acp.load_previous_output(path, SOURCE_TYPES)
+    assert rows.keys() == ["abc"]
+
+def _run(monkeypatch, csv_path, output, *args):
+    argv = ["apc_csv_processing.py", csv_path, "--yes", "--no-profile",
+            "-o", output] + list(args)
+    monkeypatch.setattr(sys, "argv", argv)
+    acp.main()
+
+def test_incremental_run(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    # Rows without DOI and journal need no network lookups
+    header = u"institution,period,euro,doi,is_hybrid\n"
+    tmpdir.join("v1.csv").write(header + u"Uni A,2015,1000,NA,FALSE\n" +
+                                u"Uni B,2015,500,NA,FALSE\n")
+    _run(monkeypatch, "v1.csv", "out1.csv")
+    assert len(tmpdir.join("out1.csv.fingerprints").readlines()) == 2
+    # Simulate metadata added by the enrichment
+    with open("out1.csv", "r") as out:
+        rows = list(oat.UnicodeRecordReader(out))
+    for row in rows:
+        row["publisher"] = u"Enriched Publisher"
+    _write_output("out1.csv", rows)
+
+    tmpdir.join("v2.csv").write(header + u"Uni A,2015,1000,NA,FALSE\n" +
+                                u"Uni B,2015,550,NA,FALSE\n")
+    _run(monkeypatch, "v2.csv", "out2.csv", "--previous", "out1.csv")
+    with open("out2.csv", "r") as out:
+        rows = list(oat.UnicodeRecordReader(out))
+    # The unchanged row is reused, the changed one enriched again
+    assert [row["publisher"] for row in rows] == [u"Enriched Publisher",
+                                                  u"NA"]
+    assert rows[1]["euro"] == u"550"
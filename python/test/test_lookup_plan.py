@@ -0,0 +1,41 @@
+from collections import OrderedDict
+
+import apc_csv_processing as acp
+from apc_csv_processing import CSVColumn
+import openapc_toolkit as oat
+
+def _column_map(**indices):
+    return OrderedDict((ct, CSVColumn(ct, CSVColumn.NONE, indices.get(ct)))
+                       for ct in oat.OPENAPC_COLUMNS)
+
+ROWS = [
+    [u"institution", u"doi", u"issn"],
+    [u"A", u"10.1000/a", u"1234-5678"],
+    [],
+    [u"B", u"doi:10.1000/A", u"1234-5678"],
+    [u"C", u"NA", u"2345-6789"],
+    [u"D", u"10.1000/b"],
+    [u"E", u"10.1000/c", u""]
+]
+
+def test_plan_lookups():
+    column_map = _column_map(institution=0, doi=1, issn=2)
+    plan = acp.plan_lookups(iter(ROWS), True, 3, column_map, {})
+    assert plan["rows"] == 4
+    assert plan["crossref"] == OrderedDict([(u"10.1000/a", u"10.1000/a"),
+                                            (u"10.1000/c", u"10.1000/c")])
+    assert plan["naive"] == {"crossref": 3, "pubmed": 3, "doaj": 3}
+    assert plan["doaj"].keys() == [u"1234-5678", u"2345-6789"]
+    plan = acp.plan_lookups(iter(ROWS), True, 3, column_map, {},
+                            row_range=(3, 5))
+    assert plan["crossref"].keys() == [u"10.1000/c"]
+
+def test_memoize_lookup():
+    calls = []
+    def lookup(doi, flag=False):
+        calls.append(doi)
+        return {"success": False}
+    memoized = acp.memoize_lookup(lookup, lambda doi: doi.lower())
+    for doi in [u"10.1000/a", u"10.1000/A", u"10.1000/b"]:
+        memoized(doi, True)
+    assert calls == [u"10.1000/a", u"10.1000/b"]
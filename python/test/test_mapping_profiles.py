@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import csv
+import sys
+
+import apc_csv_processing as acp
+from apc_csv_processing import CSVColumn
+import openapc_toolkit as oat
+
+DELIVERY = ("Einrichtung;Jahr;Kosten;DOI;is_hybrid\r\n" +
+            "Uni A;2015;1.234,50;10.1234/abc;FALSE\r\n" +
+            "Uni A;2016;980,00;10.1234/def;TRUE\r\n")
+
+def test_header_fingerprint(tmpdir):
+    first = tmpdir.join("first.csv")
+    first.write(DELIVERY)
+    # Same header, other rows and leading blank lines
+    second = tmpdir.join("second.csv")
+    second.write("\r\n" + DELIVERY.splitlines(True)[0] +
+                 "Uni B;2017;1;NA;FALSE\r\n")
+    other = tmpdir.join("other.csv")
+    other.write(DELIVERY.replace("Jahr", "Periode"))
+    fingerprint = oat.get_header_fingerprint(str(first))
+    assert fingerprint == oat.get_header_fingerprint(str(second))
+    assert fingerprint != oat.get_header_fingerprint(str(other))
+    assert oat.get_header_fingerprint(str(tmpdir.join("missing.csv"))) is None
+
+def test_dialect_round_trip():
+    dialect = csv.Sniffer().sniff(DELIVERY)
+    restored = oat.dialect_from_dict(oat.dialect_to_dict(dialect))
+    assert oat.dialect_to_dict(restored) == oat.dialect_to_dict(dialect)
+    # Profiles are stored as JSON, which returns unicode strings
+    as_json = {key: unicode(value) if isinstance(value, str) else value
+               for key, value in oat.dialect_to_dict(dialect).iteritems()}
+    restored = oat.dialect_from_dict(as_json)
+    rows = list(csv.reader(DELIVERY.splitlines(), restored))
+    assert rows[1] == ["Uni A", "2015", "1.234,50", "10.1234/abc", "FALSE"]
+
+def test_save_and_load_profiles(tmpdir):
+    path = str(tmpdir.join("profiles.json"))
+    assert oat.load_mapping_profiles(path) == {}
+    oat.save_mapping_profile(path, "abc", {"name": "a.csv", "columns": {}})
+    oat.save_mapping_profile(path, "def", {"name": "b.csv", "columns": {}})
+    oat.save_mapping_profile(path, "abc", {"name": "c.csv", "columns": {}})
+    profiles = oat.load_mapping_profiles(path)
+    assert sorted(profiles) == ["abc", "def"]
+    assert profiles["abc"]["name"] == "c.csv"
+
+def test_apply_mapping_profile():
+    column_map = {ct: CSVColumn(ct, CSVColumn.MANDATORY)
+                  for ct in ["institution", "period", "euro", "doi"]}
+    # Set on the command line
+    column_map["doi"].index = 0
+    profile = {"columns": {"institution": 0, "period": 1, "euro": 2,
+                           "doi": 3, "unknown": 4}}
+    header = [u"Einrichtung", u"Jahr", u"Kosten", u"DOI"]
+    acp.apply_mapping_profile(profile, column_map, header)
+    assert column_map["period"].index == 1
+    assert column_map["period"].column_name == u"Jahr"
+    assert column_map["doi"].index == 0
+
+def _run_dry(monkeypatch, csv_path, *args):
+    argv = ["apc_csv_processing.py", csv_path, "--dry-run"] + list(args)
+    monkeypatch.setattr(sys, "argv", argv)
+    acp.main()
+
+def test_profile_is_applied_to_matching_file(tmpdir, monkeypatch, capsys):
+    monkeypatch.chdir(tmpdir)
+    first = tmpdir.join("uni_a_2015.csv")
+    first.write(DELIVERY)
+    # The German column names are not recognized by the header analysis
+    _run_dry(monkeypatch, str(first), "--save-profile", "-institution", "0",
+             "-period", "1", "-euro", "2", "-doi", "3")
+    profiles = oat.load_mapping_profiles("mapping_profiles.json")
+    profile = profiles[oat.get_header_fingerprint(str(first))]
+    assert profile["columns"]["euro"] == 2
+    assert profile["number_format"] == [",", "."]
+    assert profile["dialect"]["delimiter"] == ";"
+    capsys.readouterr()
+
+    second = tmpdir.join("uni_a_2016.csv")
+    second.write(DELIVERY.splitlines(True)[0] +
+                 "Uni A;2016;2.000,00;NA;FALSE\r\n")
+    _run_dry(monkeypatch, str(second))
+    out = capsys.readouterr()[0]
+    assert "Found mapping profile 'uni_a_2015.csv'" in out
+    # Neither the file nor its header are analyzed
+    assert "*****CSV file analysis*****" not in out
+    assert "Analyzing CSV header" not in out
+    assert "column number 2 (Kosten) is the mandatory column 'euro'" in out
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import near_duplicates
+
+def _row(institution, period, euro, journal, issn="NA", url="NA", doi="NA",
+         pmid="NA"):
+    return {"institution": institution, "period": period, "euro": euro,
+            "doi": doi, "journal_full_title": journal, "issn": issn,
+            "issn_print": "NA", "issn_electronic": "NA", "pmid": pmid,
+            "pmcid": "NA", "ut": "NA", "url": url}
+
+def test_normalize_url():
+    assert (near_duplicates.normalize_url(" HTTPS://www.Example.org/a/#top ")
+            == "example.org/a")
+
+def test_find_near_duplicates():
+    rows = [
+        _row("Uni A", "2015", "1000", "Journal X", "1234-5678",
+             "http://example.org/article/1"),
+        # Re-delivered by another institution, URL differs in scheme only
+        _row("Uni B", "2015", "1000", "Journal X", "NA",
+             "https://www.example.org/article/1/"),
+        # Same journal and price, but another article
+        _row("Uni A", "2015", "1000", "Journal X", "1234-5678",
+             "http://example.org/article/2"),
+        # Title variant without ISSN and URL, same period and price, but
+        # nothing identifies the article
+        _row("Uni C", "2016", "750.5", "The Journal of Y"),
+        _row("Uni D", "2016", "750.00", "Journal of Y"),
+        # Same PubMed ID, the second delivery has a shortened title
+        _row("Uni C", "2014", "1200", "Journal of Z", pmid="12345678"),
+        _row("Uni E", "2014", "1100", "J. of Z", pmid="12345678"),
+        # Rows with a DOI are covered by the DOI duplicate check
+        _row("Uni A", "2015", "1000", "Journal X", "1234-5678",
+             "http://example.org/article/1", doi="10.1000/1"),
+    ]
+    duplicates, compared, skipped = near_duplicates.find_near_duplicates(rows)
+    assert [(i, j) for _, i, j, _ in duplicates] == [(0, 1), (5, 6)]
+    assert duplicates[0][3] == ["url", "journal", "period", "euro"]
+    assert duplicates[1][3] == ["identifier", "period"]
+    assert duplicates[1][0] == 0.65
+    assert compared == 5
+    assert skipped == 0
+
+def test_same_journal_period_and_price():
+    # Different articles of a journal with a flat fee
+    first = _row("KIT", "2013", "500",
+                 "International Journal of Electrochemical Science",
+                 "1452-3981")
+    second = _row("KIT", "2013", "500",
+                  "International Journal of Electrochemical Science",
+                  "1452-3981")
+    score, evidence = near_duplicates.score_pair(first, second)
+    assert evidence == ["journal", "period", "euro"]
+    assert score == 0.0
+    duplicates, compared, _ = near_duplicates.find_near_duplicates(
+        [first, second])
+    assert duplicates == [] and compared == 1
+
+def test_identifier_blocking():
+    # A large journal: The ISSN and title blocks are oversized
+    rows = [_row("Uni A", "2015", unicode(1000 + i), "Journal X", "1234-5678")
+            for i in range(near_duplicates.MAX_BLOCK_SIZE)]
+    rows.append(_row("Uni B", "2015", "900", "Journal X", "1234-5678",
+                     pmid="12345678"))
+    rows.append(_row("Uni C", "2015", "910", "Journal X", "1234-5678",
+                     pmid="12345678"))
+    assert u"pmid:12345678" in near_duplicates.get_blocking_keys(rows[-1])
+    duplicates, compared, skipped = near_duplicates.find_near_duplicates(rows)
+    assert skipped > 0
+    assert compared == 1
+    assert [(i, j) for _, i, j, _ in duplicates] == [(len(rows) - 2,
+                                                      len(rows) - 1)]
@@ -0,0 +1,64 @@
+import json
+
+import apc_csv_processing as acp
+from apc_csv_processing import CSVColumn
+
+def _write_policy(tmpdir, content):
+    policy_file = tmpdir.join("policy.json")
+    policy_file.write(json.dumps(content))
+    return str(policy_file)
+
+def _column_map(*column_types):
+    return {ct: CSVColumn(ct, CSVColumn.NONE, None) for ct in column_types}
+
+def test_policy_rules(tmpdir):
+    path = _write_policy(tmpdir, {
+        "default": "never",
+        "columns": {
+            "license_ref": "always",
+            "publisher": {
+                "rule": "never",
+                "whitelist": {"Old Publisher": "New Publisher"}
+            }
+        }
+    })
+    result = acp.load_overwrite_policy(path)
+    assert result["success"]
+    column_map = _column_map("license_ref", "publisher", "pmid")
+    acp.apply_overwrite_policy(column_map, result["data"])
+    assert column_map["license_ref"].check_overwrite(u"a", u"b") == u"b"
+    assert column_map["pmid"].check_overwrite(u"1", u"2") == u"1"
+    publisher = column_map["publisher"]
+    assert (publisher.check_overwrite(u"Old Publisher", u"New Publisher") ==
+            u"New Publisher")
+    # The whitelist only allows the mapped replacement
+    assert publisher.check_overwrite(u"Old Publisher", u"X") == u"Old Publisher"
+    assert publisher.check_overwrite(u"Other", u"X") == u"Other"
+    assert publisher.check_overwrite(u"NA", u"X") == u"X"
+
+def test_invalid_rule(tmpdir):
+    path = _write_policy(tmpdir, {"columns": {"doi": "sometimes"}})
+    result = acp.load_overwrite_policy(path)
+    assert not result["success"]
+
+def test_unresolved_conflicts_are_recorded(tmpdir):
+    review = acp.ConflictReview()
+    column = CSVColumn("journal_full_title", CSVColumn.OPTIONAL, 2)
+    column.overwrite_blacklist = {u"PLOS ONE": u"PLoS ONE"}
+    column.conflict_review = review
+    review.line = 7
+    review.doi = u"10.1371/journal.pone.0000001"
+    assert column.check_overwrite(u"PLOS ONE", u"PLoS ONE") == u"PLOS ONE"
+    assert column.check_overwrite(u"Nature", u"Nature Physics") == u"Nature"
+    assert review.conflicts == [[u"7", u"10.1371/journal.pone.0000001",
+                                 u"journal_full_title", u"Nature",
+                                 u"Nature Physics"]]
+    out = tmpdir.join("review.csv")
+    review.write(str(out))
+    lines = out.read().splitlines()
+    assert lines[0] == '"line","doi","column","existing_value","new_value"'
+    assert len(lines) == 2
+
+def test_prefer_source_is_no_rule(tmpdir):
+    path = _write_policy(tmpdir, {"default": "prefer-source"})
+    assert not acp.load_overwrite_policy(path)["success"]
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import os
+import sys
+
+import pytest
+
+import apc_csv_processing as acp
+import openapc_toolkit as oat
+
+# Rows without DOI and journal need no network lookups
+DELIVERY = (u"institution,period,euro,doi,is_hybrid\n" +
+            u"".join(u"Uni A,2015,{},NA,FALSE\n".format(1000 + i)
+                     for i in range(6)))
+
+def _run(monkeypatch, *args):
+    argv = ["apc_csv_processing.py", "apc.csv", "--no-profile",
+            "--no-journal-kb", "-o", "out.csv"] + list(args)
+    monkeypatch.setattr(sys, "argv", argv)
+    acp.main()
+
+def test_stale_shards_are_removed(tmpdir, monkeypatch, capsys):
+    monkeypatch.chdir(tmpdir)
+    tmpdir.join("apc.csv").write(DELIVERY)
+    # Results of an earlier run with other rows
+    stale = acp.get_shard_path("out.csv", 2, 2)
+    tmpdir.join(stale).write(u"institution\nOld Uni\n")
+    tmpdir.join(stale + acp.FINGERPRINT_SUFFIX).write("abc\n")
+    tmpdir.join(stale + ".report").write('{"errors": [], "conflicts": []}')
+    _run(monkeypatch, "--shards", "2", "--save-profile")
+    assert "--save-profile is ignored" in capsys.readouterr()[0]
+    with open("out.csv", "r") as out:
+        rows = list(oat.UnicodeRecordReader(out))
+    assert [row["euro"] for row in rows] == [unicode(1000 + i)
+                                             for i in range(6)]
+    assert not tmpdir.join("mapping_profiles.json").check()
+
+class FailingProcess(object):
+
+    def __init__(self, command, **kwargs):
+        self.command = command
+
+    def wait(self):
+        return 1 if self.command[-1] == "2/2" else 0
+
+def test_failed_shard_aborts(tmpdir, monkeypatch, capsys):
+    monkeypatch.chdir(tmpdir)
+    tmpdir.join("apc.csv").write(DELIVERY)
+    monkeypatch.setattr(acp.subprocess, "Popen", FailingProcess)
+    with pytest.raises(SystemExit):
+        _run(monkeypatch, "--shards", "2")
+    out = capsys.readouterr()[0]
+    assert "Shard 2 of 2 failed with exit code 1" in out
+    assert "no results were merged" in out
+    assert not os.path.isfile("out.csv")
@@ -0,0 +1,516 @@
+# -*- coding: UTF-8 -*-
+
+import BaseHTTPServer
+import bz2
+from collections import OrderedDict
+import gzip
+import hashlib
+import httplib
+import json
+import math
+import os
+import sys
+import threading
+import xml.etree.ElementTree as ET
+import zipfile
+
+import pytest
+
+import apc_csv_processing as acp
+import openapc_toolkit as oat
+
+@pytest.mark.parametrize("values, number_format", [
+    ([u"1200", u"980"], (u".", u"")),
+    ([u"1200.50", u"980"], (u".", u"")),
+    ([u"1200,50", u"1.300,00"], (u",", u".")),
+    ([u"1.300", u"2.000"], (u",", u".")),
+    ([u"1,300.00", u"2,000"], (u".", u",")),
+    ([u"1 300,00", u"980,5"], (u",", u" "))
+])
+def test_infer_number_format(values, number_format):
+    assert oat.infer_number_format(values) == number_format
+
+def test_number_parser():
+    parse = oat.compile_number_parser(u",", u".")
+    assert parse(u"1.300,50") == 1300.5
+    assert parse(u" 980 ") == 980.0
+    for malformed in [u"13.5", u"1,300.00", u"abc", u""]:
+        with pytest.raises(ValueError):
+            parse(malformed)
+
+def test_locale_number_parser(monkeypatch):
+    # Like fr_FR.UTF-8, which groups digits with a narrow no-break space
+    monkeypatch.setattr(oat.locale, "localeconv", lambda: {
+        "decimal_point": ",", "thousands_sep": "\xe2\x80\xaf"})
+    monkeypatch.setattr(oat.locale, "getpreferredencoding",
+                        lambda do_setlocale=True: "UTF-8")
+    number_format = oat.get_locale_number_format()
+    assert number_format == (u",", u"\u202f")
+    parse = oat.compile_number_parser(*number_format)
+    assert parse(u"1200,50") == 1200.5
+    assert parse(u"1\u202f200,50") == 1200.5
+    with pytest.raises(ValueError):
+        parse(u"1.200,50")
+
+def test_period_parser():
+    values = [u"2014", u"01.03.2015", u"15.12.2015"]
+    period_format = oat.infer_period_format(values)
+    assert period_format == "DD.MM.YYYY"
+    parse = oat.compile_period_parser(period_format)
+    assert parse(u"15.12.2015") == u"2015"
+    with pytest.raises(ValueError):
+        parse(u"2014")
+
+def _write_crossref_dump(tmpdir):
+    works = [
+        {"DOI": "10.1234/ABC.1", "publisher": "Test Publisher",
+         "container-title": ["Journal of Tests"],
+         "ISSN": ["1234-5678", "8765-4321"],
+         "issn-type": [{"value": "1234-5678", "type": "print"},
+                       {"value": "8765-4321", "type": "electronic"}],
+         "license": [{"URL": "http://creativecommons.org/licenses/by/4.0/"}]},
+        {"DOI": "10.1234/abc.2", "publisher": "Test Publisher"},
+        {"publisher": "Record without DOI"}
+    ]
+    dump = tmpdir.join("dump.jsonl.gz")
+    with gzip.open(str(dump), "wb") as dump_file:
+        for work in works:
+            dump_file.write(json.dumps(work) + "\n")
+    return str(dump)
+
+def test_crossref_store(tmpdir):
+    store = oat.CrossrefStore(str(tmpdir.join("crossref.db")))
+    count = oat.import_crossref_dump(_write_crossref_dump(tmpdir), store,
+                                     batch_size=1)
+    assert count == 2
+    assert len(store) == 2
+    data = store.get(u"doi:10.1234/abc.1")
+    assert data == {
+        "publisher": u"Test Publisher",
+        "journal_full_title": u"Journal of Tests",
+        "issn": u"1234-5678",
+        "issn_print": u"1234-5678",
+        "issn_electronic": u"8765-4321",
+        "license_ref": u"http://creativecommons.org/licenses/by/4.0/"
+    }
+    assert store.get(u"10.1234/ABC.2")["journal_full_title"] is None
+    assert store.get(u"10.1234/unknown") is None
+    # Store hits must not cause any network access
+    result = oat.get_metadata_from_crossref(u"http://dx.doi.org/10.1234/abc.1",
+                                            store)
+    assert result == {"success": True, "data": data}
+    store.close()
+
+APC_HEADER = (u'"institution","period","euro","doi","is_hybrid","publisher",' +
+              u'"journal_full_title","issn","issn_print","issn_electronic",' +
+              u'"license_ref","indexed_in_crossref","pmid","pmcid","ut",' +
+              u'"url","doaj"\r\n')
+
+def _write_apc_csv(tmpdir, rows):
+    csv_file = tmpdir.join("apc_de.csv")
+    csv_file.write_text(APC_HEADER + u"".join(rows), "utf-8")
+    return str(csv_file)
+
+def test_apc_index(tmpdir):
+    csv_path = _write_apc_csv(tmpdir, [
+        u'"Uni A",2014,1000,"10.1234/ABC",FALSE,"P","Jöurnal",' +
+        u'"1234-5678",NA,"1234-5678",NA,TRUE,NA,NA,NA,NA,FALSE\r\n',
+        u'"Uni B",2015,1200,NA,FALSE,"P","Jöurnal","1234-5678",NA,' +
+        u'NA,NA,FALSE,NA,NA,NA,"http://example.com",FALSE\r\n'
+    ])
+    index_path = str(tmpdir.join("apc_de.idx"))
+    assert oat.build_apc_index(csv_path, index_path) == 3
+    index = oat.APCIndex(index_path, csv_path)
+    assert index.is_current()
+    offsets = index.lookup_doi(u"doi:10.1234/abc")
+    assert len(offsets) == 1
+    assert index.get_row(offsets[0])["institution"] == u"Uni A"
+    rows = [index.get_row(o) for o in index.lookup_issn(u"1234-5678")]
+    assert [row["institution"] for row in rows] == [u"Uni A", u"Uni B"]
+    assert rows[1]["journal_full_title"] == u"Jöurnal"
+    assert not index.contains_doi(u"10.1234/other")
+    assert index.lookup_issn(u"0000-0000") == []
+    index.close()
+
+class _AMRStubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers AMR requests, only DOIs starting with 10.1234 are known.
+    """
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        request = ET.fromstring(body)
+        cites = ""
+        for cite in request.iter("{http://www.isinet.com/xrpc41}map"):
+            doi = cite.find("{http://www.isinet.com/xrpc41}val")
+            if cite.get("name") is None or doi is None:
+                continue
+            cites += '<map name="{}"><map name="WOS">'.format(cite.get("name"))
+            if doi.text.startswith("10.1234"):
+                ut = doi.text.split("/")[1].zfill(15)
+                cites += '<val name="ut">{}</val>'.format(ut)
+            cites += '</map></map>'
+        response = ('<?xml version="1.0" encoding="UTF-8" ?><response ' +
+                    'xmlns="http://www.isinet.com/xrpc41"><fn name=' +
+                    '"LinksAMR.retrieve" rc="OK"><map>' + cites +
+                    '</map></fn></response>')
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def amr_stub():
+    server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), _AMRStubHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield "http://127.0.0.1:{}/".format(server.server_address[1])
+    server.shutdown()
+
+def test_get_uts_from_wos(amr_stub):
+    dois = [u"10.1234/1", u"10.9999/<unknown>", u"10.1234/42"]
+    result = oat.get_uts_from_wos(dois, amr_stub)
+    assert result["success"]
+    assert result["data"] == {u"10.1234/1": "ut:000000000000001",
+                              u"10.9999/<unknown>": None,
+                              u"10.1234/42": "ut:000000000000042"}
+
+def test_doi_ut_mapping(tmpdir):
+    mapping_file = tmpdir.join("doi_ut.csv")
+    mapping_file.write('"doi","ut"\r\n"10.1234/ABC","ut:000000000000001"\r\n')
+    oat.append_doi_ut_mapping(str(mapping_file), [(u"10.1234/def", u"NA")])
+    assert oat.load_doi_ut_mapping(str(mapping_file)) == {
+        u"10.1234/abc": u"ut:000000000000001",
+        u"10.1234/def": u"NA"
+    }
+    assert mapping_file.read("rb").endswith('"10.1234/def","NA"\r\n')
+
+def test_new_doi_ut_mapping(tmpdir):
+    mapping_file = tmpdir.join("doi_ut.csv")
+    oat.append_doi_ut_mapping(str(mapping_file), [(u"10.1234/1", u"NA")])
+    oat.append_doi_ut_mapping(str(mapping_file), [(u"10.1234/2", u"NA")])
+    assert mapping_file.read("rb") == ('"doi","ut"\n"10.1234/1","NA"\n' +
+                                       '"10.1234/2","NA"\n')
+    assert len(oat.load_doi_ut_mapping(str(mapping_file))) == 2
+
+def test_new_doi_ut_mapping_keeps_doi_case(tmpdir, monkeypatch):
+    mapping_file = tmpdir.join("doi_ut.csv")
+    mapping_file.write('"doi","ut"\n"10.2147/JPR.S45097","NA"\n')
+    def get_uts(dois):
+        # Web of Science is queried with normalized DOIs
+        assert dois == [u"10.1000/abc.def"]
+        return {"success": True, "data": {u"10.1000/abc.def": u"ut:1"}}
+    monkeypatch.setattr(oat, "get_uts_from_wos", get_uts)
+    column_map = OrderedDict((column, None) for column in oat.OPENAPC_COLUMNS)
+    rows = []
+    for doi in [u"10.1000/ABC.Def", u"10.2147/jpr.s45097"]:
+        row = [u"NA"] * len(oat.OPENAPC_COLUMNS)
+        row[oat.OPENAPC_COLUMNS.index("doi")] = doi
+        rows.append(row)
+    assert acp.add_ut_identifiers(rows, column_map, str(mapping_file),
+                                  True) == []
+    assert rows[0][oat.OPENAPC_COLUMNS.index("ut")] == u"ut:1"
+    assert mapping_file.read("rb") == ('"doi","ut"\n"10.2147/JPR.S45097",' +
+                                       '"NA"\n"10.1000/ABC.Def","ut:1"\n')
+
+def test_columnar_export(tmpdir):
+    csv_path = _write_apc_csv(tmpdir, [
+        u'"Uni A",2014,1000.5,"10.1234/ABC",FALSE,"P","Jöurnal",' +
+        u'"1234-5678",NA,"1234-5678",NA,TRUE,NA,NA,NA,NA,FALSE\r\n',
+        u'"Uni B",2015,1200,NA,FALSE,"P","Jöurnal","1234-5678",NA,' +
+        u'NA,NA,FALSE,NA,NA,NA,"http://example.com",FALSE\r\n'
+    ])
+    export_dir = str(tmpdir.join("columns"))
+    # Exports in an older format are rebuilt
+    os.makedirs(export_dir)
+    with open(os.path.join(export_dir, "schema.json"), "w") as schema_file:
+        json.dump({"source_sha1": hashlib.sha1(open(csv_path, "rb").read())
+                   .hexdigest()}, schema_file)
+    assert oat.export_columnar(csv_path, export_dir)
+    assert not oat.export_columnar(csv_path, export_dir)
+    columns = oat.read_columnar(export_dir, ["period", "euro", "doi",
+                                             "journal_full_title"])
+    assert columns.keys() == ["period", "euro", "doi", "journal_full_title"]
+    assert list(columns["period"]) == [2014, 2015]
+    assert list(columns["euro"]) == [1000.5, 1200.0]
+    assert columns["doi"] == [u"10.1234/ABC", u"NA"]
+    assert columns["journal_full_title"] == [u"Jöurnal", u"Jöurnal"]
+
+def test_lookup_concurrently():
+    errors = {u"10.1000/offline": IOError("no network"),
+              u"10.1000/xml": ET.ParseError("no element found"),
+              u"10.1000/http": httplib.BadStatusLine(""),
+              u"10.1000/json": ValueError("No JSON object could be decoded")}
+    def lookup(doi):
+        if doi in errors:
+            raise errors[doi]
+        return {"success": True, "data": doi.upper()}
+    dois = [u"10.1000/a", u"10.1000/b"] + sorted(errors)
+    results = dict(oat.lookup_concurrently(lookup, dois, workers=2))
+    assert results[u"10.1000/a"] == {"success": True, "data": u"10.1000/A"}
+    assert "no network" in results[u"10.1000/offline"]["error_msg"]
+    assert "invalid XML" in results[u"10.1000/xml"]["error_msg"]
+    assert "BadStatusLine" in results[u"10.1000/http"]["error_msg"]
+    assert "No JSON" in results[u"10.1000/json"]["error_msg"]
+    assert all(not results[doi]["success"] for doi in errors)
+    assert len(results) == 6
+
+def test_bulk_lookup(monkeypatch, capsys):
+    started = threading.Event()
+    def lookup(doi):
+        started.set()
+        return {"success": True, "data": doi.upper()}
+    read_fd, write_fd = os.pipe()
+    monkeypatch.setattr(sys, "stdin", os.fdopen(read_fd, "r"))
+    thread = threading.Thread(target=oat.bulk_lookup, args=(lookup, "-", 2))
+    thread.start()
+    with os.fdopen(write_fd, "w") as pipe:
+        pipe.write("10.1000/a\n")
+        pipe.flush()
+        # The first lookup starts before the input is complete
+        assert started.wait(5)
+        pipe.write("10.1000/b\n\n10.1000/a\n")
+    thread.join()
+    records = [json.loads(line) for line in capsys.readouterr()[0].splitlines()]
+    records.sort(key=lambda record: record["doi"])
+    assert records == [
+        {"doi": u"10.1000/a", "success": True, "data": u"10.1000/A"},
+        {"doi": u"10.1000/b", "success": True, "data": u"10.1000/B"}
+    ]
+
+def test_lookup_cache(tmpdir):
+    calls = []
+    def lookup(doi):
+        calls.append(doi)
+        return {"success": doi != u"10.1000/unknown", "data": {}}
+    cache_path = str(tmpdir.join("cache.db"))
+    cache = oat.LookupCache(cache_path)
+    cached = cache.wrap("crossref", lookup, normalize=oat.normalize_doi)
+    for doi in [u"10.1000/A", u"doi:10.1000/a", u"10.1000/unknown",
+                u"10.1000/unknown"]:
+        cached(doi)
+    assert calls == [u"10.1000/A", u"10.1000/unknown", u"10.1000/unknown"]
+    # A second connection (another process) sees the cached results
+    other = oat.LookupCache(cache_path)
+    assert other.get("crossref", u"10.1000/a") == {"success": True, "data": {}}
+    assert other.get("pubmed", u"10.1000/a") is None
+    other.close()
+    cache.close()
+
+def test_journal_kb(tmpdir):
+    csv_path = _write_apc_csv(tmpdir, [
+        u'"Uni A",2014,1000,"10.1/a",FALSE,"Pub","Journal X","1234-5678",' +
+        u'NA,"1234-5678",NA,TRUE,NA,NA,NA,NA,FALSE\r\n',
+        u'"Uni B",2015,1200,"10.1/b",FALSE,"Pub Ltd","Journal X",' +
+        u'"1234-5678","2345-6789",NA,NA,TRUE,NA,NA,NA,NA,TRUE\r\n',
+        u'"Uni C",2013,900,"10.1/c",FALSE,"Pub","Journal X","2345-6789",' +
+        u'"2345-6789",NA,NA,TRUE,NA,NA,NA,NA,FALSE\r\n',
+        u'"Uni D",2015,500,"10.1/d",FALSE,"Other","Journal Y","9999-999x",' +
+        u'NA,NA,NA,TRUE,NA,NA,NA,NA,FALSE\r\n',
+        # Several ISSNs in one column
+        u'"Uni E",2016,700,"10.1/e",FALSE,"Hindawi","Journal Z",' +
+        u'"2090-004X;2090-0058",NA,NA,NA,TRUE,NA,NA,NA,NA,TRUE\r\n'
+    ])
+    kb = oat.build_journal_kb(csv_path)
+    assert len(kb) == 3
+    assert sorted(kb.issns) == [u"1234-5678", u"2090-004X", u"2090-0058",
+                                u"2345-6789", u"9999-999X"]
+    assert kb.lookup(u"2090-0058")["journal_full_title"] == u"Journal Z"
+    journal = kb.lookup(u"2345-6789")
+    assert journal == kb.lookup(u" 1234-5678 ")
+    assert journal["publisher"] == u"Pub"
+    assert journal["issn_print"] == u"2345-6789"
+    assert journal["issn_electronic"] == u"1234-5678"
+    assert journal["doaj"] == u"TRUE"
+    assert kb.lookup(u"9999-999X")["journal_full_title"] == u"Journal Y"
+    assert kb.lookup(u"0000-0000") is None
+
+    kb_path = str(tmpdir.join("journal_kb.json"))
+    kb = oat.load_journal_kb(kb_path, csv_path)
+    loaded = oat.JournalKnowledgeBase.load(kb_path)
+    assert loaded.is_current(csv_path)
+    assert loaded.lookup(u"1234-5678") == journal
+
+def test_journal_title_index():
+    assert (oat.normalize_journal_title(u"The Journal of Ecology & Évolution.")
+            == u"journal of ecology and evolution")
+    index = oat.JournalTitleIndex()
+    index.add(u"Journal of Pain Research", u"Dove", [u"1178-7090"])
+    index.add(u"Journal of Pathogens", u"Hindawi", [u"2090-3065"])
+    index.add(u"Nucleic Acids Research", u"OUP", [u"0305-1048; 13624962"])
+    index.add(u"The Journal of Pain Research", u"NA", [u"1178-7090", u"NA"])
+    assert len(index) == 3
+    assert index.query(u"Nucleic Acids Research")[0]["issns"] == [
+        u"0305-1048", u"1362-4962"]
+    assert index.query(u"journal of pain research")[0]["score"] == 1.0
+    matches = index.query(u"J. of Pain Research")
+    assert [m["journal_full_title"] for m in matches] == [
+        u"Journal of Pain Research"]
+    assert 0.7 < matches[0]["score"] < 1.0
+    assert index.query(u"Nucleic Acids Res", min_score=0.9) == []
+    assert index.query(u"Zeitschrift für Soziologie") == []
+
+@pytest.mark.parametrize("issn, normalized, valid", [
+    (u"2045-7758", u"2045-7758", True),
+    (u" 20457758 ", u"2045-7758", True),
+    (u"1868596x", u"1868-596X", True),
+    (u"0028–3908", u"0028-3908", True),
+    (u"283908", u"0028-3908", True),
+    (u"1748-8090", u"1748-8090", False),
+    (u"0305-1048;1362-4962", u"0305-1048;1362-4962", False),
+])
+def test_normalize_issn(issn, normalized, valid):
+    assert oat.normalize_issn(issn) == normalized
+    assert oat.is_valid_ISSN(issn) == valid
+
+def test_issnl_index(tmpdir):
+    table = tmpdir.join("issn_l.tsv")
+    table.write("ISSN\tISSN-L\n0305-1048\t0305-1048\n1362-4962\t0305-1048\n")
+    index = oat.ISSNLIndex.load(str(table))
+    assert index.get_issn_l(u"13624962") == u"0305-1048"
+    assert index.get_issn_l(u"2045-7758") == u"2045-7758"
+    index.link([u"1234-5679", u"1362-4962"])
+    assert index.get_issn_l(u"1234-5679") == u"0305-1048"
+    index.save(str(table))
+    assert oat.ISSNLIndex.load(str(table)).mapping == index.mapping
+
+    kb_path = str(tmpdir.join("journal_kb.json"))
+    kb = oat.JournalKnowledgeBase([[u"Nucleic Acids Research", u"OUP",
+                                    u"0305-1048", u"NA", u"NA", u"FALSE"]],
+                                  {u"0305-1048": 0})
+    kb.save(kb_path)
+    kb = oat.JournalKnowledgeBase.load(kb_path)
+    assert kb.lookup(u"1362-4962") is None
+    kb.issnl_index = index
+    assert kb.lookup(u"1362-4962")["publisher"] == u"OUP"
+
+def test_records(tmpdir):
+    assert oat.get_column_type_from_whitelist(u"Kosten") == "euro"
+    assert oat.OPENAPC_QUOTEMASK[:4] == [True, False, False, True]
+    assert oat.make_record_type(oat.OPENAPC_COLUMNS) is oat.OpenAPCRecord
+
+    csv_path = _write_apc_csv(tmpdir, [
+        u'"Uni A",2014,1000,"10.1/a",FALSE,"Pub","Journal X","1234-5678",' +
+        u'NA,NA,NA,TRUE,NA,NA,NA,NA,FALSE\r\n',
+        u'"Uni B",2015\r\n'
+    ])
+    with open(csv_path, "r") as csv_file:
+        rows = list(oat.UnicodeRecordReader(csv_file))
+    assert isinstance(rows[0], oat.OpenAPCRecord)
+    assert len(rows[0]) == 17
+    assert rows[0]["doi"] == u"10.1/a"
+    assert dict(rows[0].iteritems())["journal_full_title"] == u"Journal X"
+    assert rows[1]["doaj"] is None
+    assert rows[1].get("unknown", u"NA") == u"NA"
+    rows[0]["doaj"] = u"TRUE"
+    assert rows[0].values()[-1] == u"TRUE"
+
+    out_path = str(tmpdir.join("out.csv"))
+    with open(out_path, "w") as out:
+        writer = oat.OpenAPCUnicodeWriter(out, oat.OPENAPC_QUOTEMASK, True,
+                                          True)
+        writer.write_rows([oat.OPENAPC_COLUMNS, rows[0]])
+    with open(out_path, "r") as out:
+        assert out.readlines()[1] == ('"Uni A",2014,1000,"10.1/a",FALSE,' +
+                                      '"Pub","Journal X","1234-5678",NA,NA,' +
+                                      'NA,TRUE,NA,NA,NA,NA,TRUE\r\n')
+    assert rows[0]["institution"] == u"Uni A"
+
+XLSX_SHEET = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/'
+    '2006/main"><sheetData>'
+    '<row r="1"><c r="A1" t="s"><v>0</v></c><c r="B1" t="s"><v>1</v></c>'
+    '<c r="C1" t="inlineStr"><is><t>is_hybrid</t></is></c>'
+    '<c r="D1" t="s"><v>2</v></c></row>'
+    '<row r="2"><c r="A2" t="s"><v>3</v></c><c r="B2"><v>1199.9999999999998'
+    '</v></c><c r="C2" t="b"><v>0</v></c></row>'
+    '<row r="3"><c r="A3"/></row>'
+    '<row r="4"><c r="A4" t="s"><v>3</v></c><c r="C4" t="b"><v>1</v></c>'
+    '<c r="D4" t="str"><v>a,"b"</v></c></row>'
+    '</sheetData></worksheet>')
+
+XLSX_STRINGS = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<sst xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<si><t>institution</t></si><si><t>euro</t></si><si><t>note</t></si>'
+    '<si><r><t>Universit\xc3\xa4t </t></r><r><t>A</t></r></si></sst>')
+
+def _write_xlsx(path):
+    with zipfile.ZipFile(path, "w") as xlsx:
+        xlsx.writestr("xl/worksheets/sheet1.xml", XLSX_SHEET)
+        xlsx.writestr("xl/sharedStrings.xml", XLSX_STRINGS)
+
+def test_xlsx_input(tmpdir):
+    path = str(tmpdir.join("apc.xlsx"))
+    _write_xlsx(path)
+    assert list(oat.iter_xlsx_rows(path)) == [
+        [u"institution", u"euro", u"is_hybrid", u"note"],
+        [u"Universität A", u"1200", u"FALSE", u""],
+        [u"Universität A", u"", u"TRUE", u'a,"b"']
+    ]
+    analysis = oat.analyze_csv_file(path)["data"]
+    assert analysis.enc == "utf-8"
+    assert analysis.dialect.delimiter == ","
+    csv_file = oat.open_input_file(path)
+    rows = list(oat.UnicodeReader(csv_file, dialect=analysis.dialect))
+    assert rows[2][3] == u'a,"b"'
+    csv_file.seek(0)
+    assert list(oat.UnicodeReader(csv_file)) == rows
+
+@pytest.mark.parametrize("name", ["apc.csv.gz", "apc.tsv.bz2", "apc.zip"])
+def test_compressed_input(tmpdir, name):
+    delimiter = "\t" if ".tsv" in name else ","
+    content = "".join(delimiter.join(row) + "\r\n" for row in
+                      [["institution", "period", "euro"],
+                       ["Uni A", "2015", "1000"], ["Uni B", "2016", "1500"]])
+    path = str(tmpdir.join(name))
+    if name.endswith(".gz"):
+        with gzip.open(path, "wb") as compressed:
+            compressed.write(content)
+    elif name.endswith(".bz2"):
+        with bz2.BZ2File(path, "wb") as compressed:
+            compressed.write(content)
+    else:
+        with zipfile.ZipFile(path, "w") as archive:
+            archive.writestr("__MACOSX/._apc.csv", "")
+            archive.writestr("export/apc.csv", content)
+        assert oat.get_input_name(path) == "export/apc.csv"
+    analysis = oat.analyze_csv_file(path)["data"]
+    assert analysis.dialect.delimiter == delimiter
+    csv_file = oat.open_input_file(path)
+    reader = oat.UnicodeReader(csv_file, dialect=analysis.dialect,
+                               encoding=analysis.enc)
+    assert reader.next() == [u"institution", u"period", u"euro"]
+    csv_file.seek(0)
+    reader = oat.UnicodeReader(csv_file, dialect=analysis.dialect,
+                               encoding=analysis.enc)
+    assert len(list(reader)) == 3
+    plain_path = tmpdir.join("plain.csv")
+    plain_path.write(content)
+    assert (oat.get_header_fingerprint(path) ==
+            oat.get_header_fingerprint(str(plain_path)))
+
+def test_invalid_archive(tmpdir):
+    path = tmpdir.join("apc.zip")
+    path.write("no archive")
+    result = oat.analyze_csv_file(str(path))
+    assert not result["success"]
+    assert "no valid ZIP archive" in result["error_msg"]
+
+def test_columnar_export_na_periods(tmpdir):
+    csv_path = _write_apc_csv(tmpdir, [
+        u'"Uni A",NA,NA,NA,FALSE,"P","J",NA,NA,NA,NA,TRUE,NA,NA,NA,NA,FALSE\r\n',
+        u'"Uni B",0,0,NA,FALSE,"P","J",NA,NA,NA,NA,TRUE,NA,NA,NA,NA,FALSE\r\n',
+        # Empty values are treated like NA
+        u'"Uni C",,,NA,FALSE,"P","J",NA,NA,NA,NA,TRUE,NA,NA,NA,NA,FALSE\r\n'
+    ])
+    export_dir = str(tmpdir.join("columns"))
+    oat.export_columnar(csv_path, export_dir)
+    columns = oat.read_columnar(export_dir, ["period", "euro"])
+    assert columns["period"] == [u"NA", 0, u"NA"]
+    assert math.isnan(columns["euro"][0]) and columns["euro"][1] == 0.0
+    assert math.isnan(columns["euro"][2])
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import os
+import subprocess
+
+import validation_index
+
+DIFF = """diff --git a/data/apc_de.csv b/data/apc_de.csv
+index 1111111..2222222 100644
+--- a/data/apc_de.csv
++++ b/data/apc_de.csv
+@@ -3 +3 @@
+-"Uni A",2015,1000,"10.1/b",FALSE,"Pub","Journal X","1234-5679",NA,NA,NA,TRUE,NA,NA,NA,NA,FALSE
++"Uni A",2015,1000,"10.1/b",FALSE,"Pub Ltd","Journal X","1234-5679",NA,NA,NA,TRUE,NA,NA,NA,NA,FALSE
+@@ -10,0 +11,2 @@
++"Uni B",2016,900,"10.1/c",FALSE,"Pub","Journal X","12345679",NA,NA,NA,TRUE,NA,NA,NA,NA,FALSE
++"Uni B",2016,900,"10.1/a",FALSE,"Pub","Journal Y",NA,NA,NA,NA,TRUE,NA,NA,NA,NA,FALSE
+"""
+
+def _row(doi, publisher, issn):
+    return {"doi": doi, "publisher": publisher, "journal_full_title": "Journal X",
+            "issn": issn, "issn_print": "NA", "issn_electronic": "NA"}
+
+def test_parse_diff():
+    added, removed, header_changed = validation_index.parse_diff(DIFF)
+    assert [line_num for line_num, _ in added] == [3, 11, 12]
+    assert len(removed) == 1
+    assert not header_changed
+    header_diff = "@@ -1 +1 @@\n-a,b\n+a,c\n"
+    assert validation_index.parse_diff(header_diff)[2]
+    new_file_diff = "@@ -0,0 +1,2 @@\n+a,b\n+1,2\n"
+    assert validation_index.parse_diff(new_file_diff)[2]
+
+def test_validation_index(tmpdir):
+    index = validation_index.ValidationIndex()
+    index.update(_row("10.1/a", "Pub", "1234-5679"))
+    index.update(_row("10.1/b", "Pub", "12345679"))
+    assert index.doi_count("10.1/a") == 1
+    assert index.get_journals(0, "1234-5679") == [("Pub", "Journal X")]
+
+    path = str(tmpdir.join("index.json"))
+    index.save(path)
+    index = validation_index.ValidationIndex.load(path)
+    index.update(_row("10.1/b", "Pub", "12345679"), -1)
+    index.update(_row("10.1/b", "Pub Ltd", "1234-5679"))
+    index.update(_row("10.1/a", "Pub", "NA"))
+    assert index.doi_count("10.1/a") == 2
+    assert index.get_journals(0, "1234-5679") == [("Pub", "Journal X"),
+                                                  ("Pub Ltd", "Journal X")]
+
+HEADER = ('"institution","period","euro","doi","is_hybrid","publisher",' +
+          '"journal_full_title","issn","issn_print","issn_electronic",' +
+          '"license_ref","indexed_in_crossref","pmid","pmcid","ut","url",' +
+          '"doaj"\n')
+
+ROWS = [
+    '"Uni A",2015,1000,"10.1/a",FALSE,"Pub","Journal X","1234-5679",NA,NA,' +
+    'NA,TRUE,NA,NA,NA,NA,FALSE\n',
+    '"Uni A",2015,1000,"10.1/b",FALSE,"Pub","Journal X","1234-5679",NA,NA,' +
+    'NA,TRUE,NA,NA,NA,NA,FALSE\n',
+    '"Uni B",2016,900,"10.1/c",FALSE,"Pub","Journal X","12345679",NA,NA,' +
+    'NA,TRUE,NA,NA,NA,NA,FALSE\n'
+]
+
+def _git(repo, *args):
+    subprocess.check_call(["git", "-c", "user.name=Test",
+                           "-c", "user.email=test@example.org"] + list(args),
+                          cwd=str(repo), stdout=open(os.devnull, "w"))
+
+def test_load_change_scope(tmpdir):
+    repo = tmpdir.join("repo")
+    csv_file = repo.join("data", "apc_de.csv")
+    csv_file.write(HEADER + "".join(ROWS[:2]), ensure=True)
+    repo.join("python", "rules.py").write("RULES = 1\n", ensure=True)
+    _git(repo, "init", "-q")
+    _git(repo, "add", ".")
+    _git(repo, "commit", "-q", "-m", "Initial")
+    cache_dir = str(tmpdir.join("cache"))
+    code_dir = str(repo.join("python"))
+
+    # One row modified, one appended
+    csv_file.write(HEADER + ROWS[0] + ROWS[1].replace('"Pub"', '"Pub Ltd"') +
+                   ROWS[2])
+    scope = validation_index.load_change_scope(str(csv_file), "HEAD",
+                                               cache_dir=cache_dir,
+                                               code_dir=code_dir)
+    assert [line_num for line_num, _ in scope.rows] == [3, 4]
+    assert scope.rows[0][1]["publisher"] == u"Pub Ltd"
+    assert scope.index.doi_count(u"10.1/a") == 1
+    assert scope.index.get_journals(0, u"1234-5679") == [
+        (u"Pub", u"Journal X"), (u"Pub Ltd", u"Journal X")]
+    # The cached base index is tied to the code that built it
+    cached = os.listdir(cache_dir)
+    assert len(cached) == 1
+    assert validation_index.get_code_hash() in cached[0]
+
+    assert validation_index.load_change_scope(
+        str(csv_file), "unknown-revision", cache_dir=cache_dir,
+        code_dir=code_dir) is None
+    # Changed rules have to be applied to all rows
+    repo.join("python", "rules.py").write("RULES = 2\n")
+    assert validation_index.load_change_scope(
+        str(csv_file), "HEAD", cache_dir=cache_dir, code_dir=code_dir) is None
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import os
+
+import watch_deliveries
+
+def _write(tmpdir, path, content, mtime):
+    target = tmpdir.join(path)
+    target.write(content, ensure=True)
+    os.utime(str(target), (mtime, mtime))
+    return str(target)
+
+def test_get_output_path():
+    assert (watch_deliveries.get_output_path("data/tum/tum2016.csv.gz") ==
+            "data/tum/tum2016_enriched.csv")
+    assert (watch_deliveries.get_output_path("data/kit/APC 2016.xlsx") ==
+            "data/kit/APC 2016_enriched.csv")
+
+def test_get_ready_files(tmpdir):
+    now = 1000000.0
+    drop_dir = str(tmpdir)
+    old = _write(tmpdir, "uni_a/apc_2015.csv", "a", now - 100)
+    _write(tmpdir, "uni_a/apc_2015_enriched.csv", "b", now - 100)
+    _write(tmpdir, "uni_a/README.md", "c", now - 100)
+    _write(tmpdir, "apc_de.csv", "d", now - 100)
+    watcher = watch_deliveries.DeliveryWatcher(drop_dir, settle_time=10)
+    assert watcher.mark_existing() == 1
+
+    new = _write(tmpdir, "uni_b/apc_2016.tsv.gz", "e", now - 100)
+    # Still being written
+    writing = _write(tmpdir, "uni_b/apc_2017.xlsx", "f", now - 1)
+    ready = watcher.get_ready_files(now)
+    assert [path for path, _ in ready] == [new]
+    watcher.queued.add(new)
+    assert watcher.get_ready_files(now) == []
+
+    # Size changed since the last poll, wait for another one
+    _write(tmpdir, "uni_b/apc_2017.xlsx", "ff", now - 50)
+    assert watcher.get_ready_files(now) == []
+    assert [path for path, _ in watcher.get_ready_files(now)] == [writing]
+
+    watcher.mark_processed(new, ready[0][1], watcher.observed[new], True)
+    # Touched without changes
+    _write(tmpdir, "uni_b/apc_2016.tsv.gz", "e", now - 20)
+    watcher.observed = {}
+    assert [path for path, _ in watcher.get_ready_files(now)] == [writing]
+    assert watcher.state[new]["mtime"] == now - 20
+
+    # Changed, the state survives a restart
+    _write(tmpdir, "uni_a/apc_2015.csv", "a2", now - 20)
+    watcher = watch_deliveries.DeliveryWatcher(drop_dir, settle_time=10)
+    assert [path for path, _ in watcher.get_ready_files(now)] == [old, writing]
+
+def test_excludes_and_relative_paths(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    now = 1000000.0
+    _write(tmpdir, "data/issn_l.tsv", "a", now - 100)
+    _write(tmpdir, "data/doi_ut.csv", "b", now - 100)
+    delivery = _write(tmpdir, "data/uni_a/apc_2015.csv", "c", now - 100)
+    watcher = watch_deliveries.DeliveryWatcher("data", settle_time=10)
+    ready = watcher.get_ready_files(now)
+    assert [path for path, _ in ready] == [delivery]
+    watcher.mark_processed(delivery, ready[0][1], watcher.observed[delivery],
+                           True)
+    # The same directory given in another way shares the state
+    watcher = watch_deliveries.DeliveryWatcher("./data", settle_time=10)
+    assert watcher.state.keys() == [delivery]
+    assert watcher.get_ready_files(now) == []
@@ -0,0 +1,279 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+"""
+Support for change-scoped validation of apc_de.csv.
+
+The tests in test/test_apc_csv.py check every row of apc_de.csv, and the
+duplicate and ISSN/name consistency checks compare rows with each other. A
+typical change only appends the rows of one institution, so most of that
+work re-validates unchanged rows.
+
+If the environment variable OPENAPC_CHANGED_SINCE is set to a git revision,
+test_apc_csv.py only validates the rows added or modified since that
+revision. The cross-row checks use a ValidationIndex of the whole file,
+which is derived from the index of the file at that revision (cached in
+.validation_cache by the git blob id of the file) and the lines removed and
+added by the diff. The run time of the tests thus depends on the size of
+the change, not on the size of the data set. If the validation code (the
+python directory) has changed since the revision, all rows are validated,
+as changed rules may reject rows which passed before.
+
+This script prints the changed rows of a CSV file:
+
+    python/validation_index.py data/apc_de.csv HEAD~1
+"""
+
+import argparse
+import hashlib
+import json
+import os
+from StringIO import StringIO
+import subprocess
+import sys
+
+import openapc_toolkit as oat
+
+ENV_VARIABLE = "OPENAPC_CHANGED_SINCE"
+
+DEFAULT_CACHE_DIR = ".validation_cache"
+
+ISSN_COLUMNS = ["issn", "issn_print", "issn_electronic"]
+
+# Changes to these paths since the revision require a full validation
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Cached indexes are only valid for the code that built them
+INDEX_CODE_FILES = [os.path.join(CODE_DIR, name) for name in
+                    ["validation_index.py", "openapc_toolkit.py"]]
+
+class ValidationIndex(object):
+    """
+    Counts of the values compared across rows of an OpenAPC CSV file.
+
+    For DOIs the number of rows containing them is counted, for every ISSN
+    column the number of rows per ISSN key and (publisher, journal title)
+    pair. Rows can be added and removed, so the index of a changed file can
+    be derived from the index of an earlier version.
+
+    Args:
+        issn_key: A function mapping an ISSN to the key it is compared by
+                  (like openapc_toolkit.normalize_issn).
+    """
+
+    def __init__(self, issn_key=oat.normalize_issn):
+        self.issn_key = issn_key
+        self.dois = {}
+        self.journals = [{} for _ in ISSN_COLUMNS]
+
+    def get_issn_keys(self, row):
+        """
+        Return the ISSN keys of a row, None for columns without an ISSN.
+        """
+        return [self.issn_key(row[column]) if _has_value(row[column]) else None
+                for column in ISSN_COLUMNS]
+
+    def update(self, row, count=1):
+        """
+        Add a row to the index (count=-1 removes it).
+        """
+        doi = row["doi"]
+        if _has_value(doi):
+            self.dois[doi] = self.dois.get(doi, 0) + count
+        # Short (invalid) rows contain None values
+        journal = ((row["publisher"] or u"") + u"\x1f" +
+                   (row["journal_full_title"] or u""))
+        for column, key in enumerate(self.get_issn_keys(row)):
+            if key is not None:
+                journals = self.journals[column].setdefault(key, {})
+                journals[journal] = journals.get(journal, 0) + count
+
+    def doi_count(self, doi):
+        return self.dois.get(doi, 0)
+
+    def get_journals(self, column, key):
+        """
+        Return the (publisher, journal_full_title) pairs of all rows with an
+        ISSN key in an ISSN column (given as index into ISSN_COLUMNS).
+        """
+        journals = self.journals[column].get(key, {})
+        return [tuple(journal.split(u"\x1f")) for journal, count in
+                sorted(journals.iteritems()) if count > 0]
+
+    def save(self, path):
+        with open(path, "w") as index_file:
+            json.dump({"dois": self.dois, "journals": self.journals},
+                      index_file, separators=(",", ":"))
+
+    @classmethod
+    def load(cls, path, issn_key=oat.normalize_issn):
+        with open(path, "r") as index_file:
+            content = json.load(index_file)
+        index = cls(issn_key)
+        index.dois = content["dois"]
+        index.journals = content["journals"]
+        return index
+
+class ChangeScope(object):
+    """
+    The rows of a CSV file changed since a revision and the ValidationIndex
+    of the current file.
+
+    Attributes:
+        rows: A list of (line number, record) tuples of added or modified
+              rows.
+        index: A ValidationIndex of all rows of the current file.
+    """
+
+    def __init__(self, rows, index):
+        self.rows = rows
+        self.index = index
+
+def _has_value(value):
+    return value is not None and len(value) > 0 and value != "NA"
+
+def _git(args, csv_path):
+    """
+    Run a git command in the directory of a file, return its output.
+    """
+    directory = os.path.dirname(os.path.abspath(csv_path))
+    with open(os.devnull, "w") as devnull:
+        return subprocess.check_output(["git"] + args, cwd=directory,
+                                       stderr=devnull)
+
+def parse_diff(diff):
+    """
+    Parse the output of 'git diff -U0' for a single file.
+
+    Returns:
+        A tuple (added, removed, header_changed). added is a list of (line
+        number, line) tuples of lines in the new version, removed a list of
+        lines of the old version.
+    """
+    added = []
+    removed = []
+    header_changed = False
+    line_num = None
+    for line in diff.splitlines():
+        if line.startswith("@@"):
+            # @@ -old_start[,old_count] +new_start[,new_count] @@
+            old_range, new_range = line.split(" ")[1:3]
+            old_start = int(old_range[1:].split(",")[0])
+            line_num = int(new_range[1:].split(",")[0])
+            removes = "," not in old_range or not old_range.endswith(",0")
+            adds = "," not in new_range or not new_range.endswith(",0")
+            if (old_start <= 1 and removes) or (line_num <= 1 and adds):
+                header_changed = True
+        elif line_num is None:
+            # File header lines (diff --git, index, ---, +++)
+            continue
+        elif line.startswith("+"):
+            added.append((line_num, line[1:]))
+            line_num += 1
+        elif line.startswith("-"):
+            removed.append(line[1:])
+    return added, removed, header_changed
+
+def _parse_line(line, record_type):
+    row = oat.UnicodeReader(StringIO(line)).next()
+    if len(row) < len(record_type.fields):
+        row += [None] * (len(record_type.fields) - len(row))
+    return record_type(row)
+
+def get_code_hash(paths=INDEX_CODE_FILES):
+    """
+    Return a short SHA-1 hex digest of the content of some files.
+    """
+    digest = hashlib.sha1()
+    for path in paths:
+        with open(path, "rb") as code_file:
+            digest.update(code_file.read())
+    return digest.hexdigest()[:12]
+
+def load_base_index(csv_path, revision, issn_key, cache_tag="",
+                    cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Return the ValidationIndex of a CSV file at a git revision.
+
+    Indexes are cached by the git blob id of the file and a hash of the
+    code building them (see INDEX_CODE_FILES). cache_tag has to identify
+    the issn_key function if different ones are used.
+    """
+    relative_path = "./" + os.path.basename(csv_path)
+    blob = _git(["rev-parse", revision + ":" + relative_path], csv_path).strip()
+    cache_path = os.path.join(cache_dir, blob + "-" + get_code_hash() +
+                              cache_tag + ".json")
+    if os.path.isfile(cache_path):
+        return ValidationIndex.load(cache_path, issn_key)
+    content = _git(["show", revision + ":" + relative_path], csv_path)
+    index = ValidationIndex(issn_key)
+    for row in oat.UnicodeRecordReader(StringIO(content)):
+        index.update(row)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    index.save(cache_path)
+    return index
+
+def load_change_scope(csv_path, revision, issn_key=oat.normalize_issn,
+                      cache_tag="", cache_dir=DEFAULT_CACHE_DIR,
+                      code_dir=CODE_DIR):
+    """
+    Determine the rows of a CSV file changed since a git revision.
+
+    Returns:
+        A ChangeScope or None if the changes cannot be validated in
+        isolation (the revision is unknown, the file did not exist, its
+        header has changed or files in code_dir have changed).
+    """
+    try:
+        changed_code = _git(["diff", "--name-only", revision, "--",
+                             code_dir], csv_path)
+        if changed_code.strip():
+            return None
+        diff = _git(["diff", "-U0", "--no-color", "--no-ext-diff", revision,
+                     "--", os.path.basename(csv_path)], csv_path)
+        added, removed, header_changed = parse_diff(diff)
+        if header_changed:
+            return None
+        index = load_base_index(csv_path, revision, issn_key, cache_tag,
+                                cache_dir)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    with open(csv_path, "r") as csv_file:
+        header = oat.UnicodeReader(csv_file).next()
+    record_type = oat.make_record_type(header)
+    for line in removed:
+        index.update(_parse_line(line, record_type), -1)
+    rows = []
+    for line_num, line in added:
+        if not line.strip():
+            continue
+        row = _parse_line(line, record_type)
+        index.update(row)
+        rows.append((line_num, row))
+    return ChangeScope(rows, index)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("csv_file", help="A CSV file in a git repository")
+    parser.add_argument("revision", help="The git revision to compare with")
+    parser.add_argument("-c", "--cache-dir", default=DEFAULT_CACHE_DIR,
+                        help="Directory for cached indexes (default: " +
+                        DEFAULT_CACHE_DIR + ")")
+    args = parser.parse_args()
+
+    scope = load_change_scope(args.csv_file, args.revision,
+                              cache_dir=args.cache_dir)
+    if scope is None:
+        print ("The changes to {} cannot be validated in isolation, the " +
+               "whole file has to be validated.").format(args.csv_file)
+        sys.exit(1)
+    for line_num, row in scope.rows:
+        msg = u"{}: {}, {}, {}".format(line_num, row["institution"],
+                                       row["period"], row["doi"])
+        print msg.encode("utf-8")
+    print "{} rows added or modified since {}.".format(len(scope.rows),
+                                                      args.revision)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,283 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+"""
+Watch a drop directory and enrich new or changed deliveries automatically.
+
+The directory (default: data) is polled for CSV files and the other input
+formats apc_csv_processing.py reads (TSV, .xlsx, .gz, .bz2, .zip). A file
+is processed once it is stable: Its size and modification time have not
+changed since the last poll and it has not been modified for --settle
+seconds, so files still being copied or written are not picked up. Files
+are fingerprinted (SHA-1 of their content) and only processed again if
+their content has changed; the fingerprints are kept in a state file in
+the drop directory, by absolute path, so 'data' and './data' share them.
+
+Stable files are queued for an unattended apc_csv_processing.py run (see
+batch_enrichment.py), which analyzes, validates and enriches them. The
+results are written next to each input: <name>_enriched.csv, together with
+a log (.log) and a conflict review file (.review.csv).
+
+When the watcher is started for the first time, the files already in the
+drop directory are recorded without processing them (use
+--process-existing to process them). Additional arguments for
+apc_csv_processing.py can be given after '--':
+
+    watch_deliveries.py data -i 60 -- --policy policy.json
+"""
+
+import argparse
+import fnmatch
+import hashlib
+import json
+from multiprocessing.pool import ThreadPool
+import os
+import sys
+import time
+
+import batch_enrichment
+import openapc_toolkit as oat
+
+ARG_HELP_STRINGS = {
+    "drop_dir": "The directory to watch (default: data)",
+    "interval": "Seconds between two polls of the drop directory (default: " +
+                "30)",
+    "settle": "Minimum number of seconds since the last modification of a " +
+              "file before it is processed (default: 10)",
+    "workers": "Number of files enriched in parallel (default: 2)",
+    "cache": "The lookup cache shared by all jobs (default: " +
+             "lookup_cache.db)",
+    "state": "Where to keep the fingerprints of processed files (default: " +
+             ".watch_state.json in the drop directory)",
+    "exclude": "A glob pattern (relative to the drop directory) of files " +
+               "to ignore, can be given several times (default: " +
+               "apc_de.csv, doi_ut.csv, issn_l.tsv, doaj/*, template/*)",
+    "process_existing": "Also process the files found in the drop " +
+                        "directory when it is watched for the first time",
+    "once": "Poll only once, wait for the jobs to finish and exit"
+}
+
+INPUT_SUFFIXES = (".csv", ".tsv", ".tab", ".xlsx", ".gz", ".bz2", ".zip")
+
+# Results of apc_csv_processing.py, which are written next to the input
+# files, contain this in their names and are never processed
+OUTPUT_SUFFIX = "_enriched.csv"
+
+DEFAULT_STATE_FILE = ".watch_state.json"
+
+DEFAULT_EXCLUDES = ["apc_de.csv", "doi_ut.csv", "issn_l.tsv", "doaj/*",
+                    "template/*"]
+
+def get_output_path(input_path):
+    """
+    Return the path of the enriched version of an input file.
+    """
+    base, ext = os.path.splitext(input_path)
+    if ext.lower() in oat.COMPRESSED_INPUT_TYPES:
+        base = os.path.splitext(base)[0]
+    return base + OUTPUT_SUFFIX
+
+def get_file_fingerprint(file_path, block_size=1 << 20):
+    """
+    Compute the SHA-1 hex digest of a file's content.
+    """
+    digest = hashlib.sha1()
+    with open(file_path, "rb") as input_file:
+        for block in iter(lambda: input_file.read(block_size), ""):
+            digest.update(block)
+    return digest.hexdigest()
+
+class DeliveryWatcher(object):
+    """
+    Detect new, changed and stable input files in a drop directory.
+
+    All paths are absolute.
+
+    Attributes:
+        state: A dict mapping the paths of processed files to their size,
+               modification time, fingerprint and the success of the job.
+        observed: A dict mapping paths to their (size, mtime) at the last
+                  poll.
+        queued: The paths of files waiting for or being processed.
+    """
+
+    def __init__(self, drop_dir, state_path=None, settle_time=10,
+                 excludes=DEFAULT_EXCLUDES):
+        self.drop_dir = os.path.abspath(drop_dir)
+        self.state_path = state_path or os.path.join(self.drop_dir,
+                                                     DEFAULT_STATE_FILE)
+        self.settle_time = settle_time
+        self.excludes = excludes
+        self.state = {}
+        if os.path.isfile(self.state_path):
+            with open(self.state_path, "r") as state_file:
+                state = json.load(state_file)
+            # Older state files hold the paths as given on the command line
+            self.state = {os.path.abspath(path): entry
+                          for path, entry in state.iteritems()}
+        self.observed = {}
+        self.queued = set()
+
+    def _is_input(self, path):
+        name = os.path.basename(path)
+        if name.startswith(".") or OUTPUT_SUFFIX in name:
+            return False
+        if not name.lower().endswith(INPUT_SUFFIXES):
+            return False
+        relative_path = os.path.relpath(path, self.drop_dir)
+        return not any(fnmatch.fnmatch(relative_path, pattern)
+                       for pattern in self.excludes)
+
+    def scan(self):
+        """
+        Return a dict mapping the paths of all input files in the drop
+        directory to their (size, mtime).
+        """
+        files = {}
+        for dir_path, dir_names, file_names in os.walk(self.drop_dir):
+            dir_names[:] = [name for name in dir_names
+                            if not name.startswith(".")]
+            for name in file_names:
+                path = os.path.join(dir_path, name)
+                if not self._is_input(path):
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    # Removed in the meantime
+                    continue
+                files[path] = (stat.st_size, stat.st_mtime)
+        return files
+
+    def get_ready_files(self, now=None):
+        """
+        Poll the drop directory.
+
+        Returns:
+            A list of (path, fingerprint) tuples of new or changed files
+            which are stable and not queued yet.
+        """
+        now = time.time() if now is None else now
+        files = self.scan()
+        ready = []
+        for path, stat in sorted(files.iteritems()):
+            previous = self.observed.get(path)
+            if path in self.queued or (previous and previous != stat):
+                continue
+            if now - stat[1] < self.settle_time:
+                continue
+            known = self.state.get(path)
+            if known and [known["size"], known["mtime"]] == list(stat):
+                continue
+            fingerprint = get_file_fingerprint(path)
+            if known and known["fingerprint"] == fingerprint:
+                # Touched, but not changed
+                self.mark_processed(path, fingerprint, stat, known["success"])
+                continue
+            ready.append((path, fingerprint))
+        self.observed = files
+        return ready
+
+    def mark_processed(self, path, fingerprint, stat, success):
+        self.state[path] = {"size": stat[0], "mtime": stat[1],
+                            "fingerprint": fingerprint, "success": success}
+        self.queued.discard(path)
+        self.save_state()
+
+    def mark_existing(self):
+        """
+        Record all files currently in the drop directory as processed.
+
+        Returns:
+            The number of recorded files.
+        """
+        files = self.scan()
+        for path, stat in files.iteritems():
+            self.state[path] = {"size": stat[0], "mtime": stat[1],
+                                "fingerprint": get_file_fingerprint(path),
+                                "success": None}
+        self.save_state()
+        return len(files)
+
+    def save_state(self):
+        with open(self.state_path, "w") as state_file:
+            json.dump(self.state, state_file, indent=2, sort_keys=True)
+
+def main():
+    if "--" in sys.argv:
+        split = sys.argv.index("--")
+        argv, processing_args = sys.argv[1:split], sys.argv[split + 1:]
+    else:
+        argv, processing_args = sys.argv[1:], []
+    parser = argparse.ArgumentParser(
+        usage="%(prog)s [-h] [options] [drop_dir] [-- PROCESSING_ARGS]")
+    parser.add_argument("drop_dir", nargs="?", default="data",
+                        help=ARG_HELP_STRINGS["drop_dir"])
+    parser.add_argument("-i", "--interval", type=float, default=30,
+                        help=ARG_HELP_STRINGS["interval"])
+    parser.add_argument("-s", "--settle", type=float, default=10,
+                        help=ARG_HELP_STRINGS["settle"])
+    parser.add_argument("-w", "--workers", type=int, default=2,
+                        help=ARG_HELP_STRINGS["workers"])
+    parser.add_argument("-c", "--cache", default="lookup_cache.db",
+                        help=ARG_HELP_STRINGS["cache"])
+    parser.add_argument("--state", help=ARG_HELP_STRINGS["state"])
+    parser.add_argument("-e", "--exclude", action="append",
+                        help=ARG_HELP_STRINGS["exclude"])
+    parser.add_argument("--process-existing", action="store_true",
+                        help=ARG_HELP_STRINGS["process_existing"])
+    parser.add_argument("--once", action="store_true",
+                        help=ARG_HELP_STRINGS["once"])
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.drop_dir):
+        print "Error: '{}' is no directory.".format(args.drop_dir)
+        sys.exit()
+    excludes = args.exclude if args.exclude is not None else DEFAULT_EXCLUDES
+    watcher = DeliveryWatcher(args.drop_dir, args.state, args.settle, excludes)
+    if not os.path.isfile(watcher.state_path) and not args.process_existing:
+        count = watcher.mark_existing()
+        msg = "Recorded {} existing files in {}, only new or changed files " + \
+              "will be processed."
+        print msg.format(count, args.drop_dir)
+    # Create the cache before the jobs start, so they do not race to set it up
+    oat.LookupCache(args.cache).close()
+
+    print "Watching {} (polling every {}s).".format(args.drop_dir, args.interval)
+    pool = ThreadPool(args.workers)
+    jobs = {}
+    try:
+        while True:
+            for path, fingerprint in watcher.get_ready_files():
+                oat.print_b("Queueing {}".format(path))
+                job = (path, get_output_path(path), args.cache,
+                       processing_args)
+                stat = watcher.observed[path]
+                result = pool.apply_async(batch_enrichment.run_job, (job,))
+                jobs[path] = (result, fingerprint, stat)
+                watcher.queued.add(path)
+            for path, (result, fingerprint, stat) in jobs.items():
+                if not result.ready():
+                    continue
+                del jobs[path]
+                _, output, success, duration = result.get()
+                watcher.mark_processed(path, fingerprint, stat, success)
+                if success:
+                    msg = "{} -> {} ({:.1f}s)".format(path, output, duration)
+                    oat.print_g(msg)
+                else:
+                    msg = "{} failed, see {} for details.".format(
+                        path, output + ".log")
+                    oat.print_r(msg)
+            if args.once and not jobs:
+                break
+            time.sleep(args.interval if not args.once else 1)
+    except KeyboardInterrupt:
+        print "Stopped, {} queued files will be processed on the next " \
+              "start.".format(len(jobs))
+    finally:
+        pool.terminate()
+        pool.join()
+
+if __name__ == '__main__':
+    main()